@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accuracy report of the float32 mode (dtype = np.float32) against the
+float64 path on real SHARP pairs, to choose the precision per campaign.
+
+For each pair i, i+1 of the HARP directory (with the Br, Bp and Bt fits 
+files, as used by execute.py) the velocities and the Poynting flux are 
+computed in both precisions and the following is reported: the time of 
+each run, the largest difference of U0, V0 and W0 relative to their 
+largest value, the median relative difference over the pixels where the
+velocity is above 1% of its largest value, the same median over the weak
+field pixels (|B| below 100 G), where the round-off of the FFTs of the 
+strong field weighs the most, and the relative difference of the 
+integrated Poynting flux.
+
+Run from the repository root, with pydave4vm and sunpy installed, as:
+    python benchmarks/accuracy_float32.py path [first [npairs [wsize]]]
+path ending with a slash, like in the configuration files.
+
+@author: andrechicrala
+"""
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from pydave4vm import do_dave4vm
+from pydave4vm.addons import cubitos3
+from pydave4vm.addons.poyntingflux import poyntingflux
+
+
+def load_pair(path, i):
+    '''
+    Reads the pair i, i+1 like execute.process_pair, returning the time 
+    interval, the fields of both frames and the pixel size in km.
+    '''
+    data_cube_Br, data_cube_Bp, data_cube_Bt,\
+    meta_cube_Bp = cubitos3.create_cube(path, i)
+    
+    fields = (data_cube_Bp[1], data_cube_Bp[0],
+              np.multiply(-1,data_cube_Bt[1]), np.multiply(-1,data_cube_Bt[0]),
+              data_cube_Br[1], data_cube_Br[0])
+    
+    t1, t2 = (datetime.strptime(meta['t_rec'], '%Y.%m.%d_%H:%M:%S_TAI')
+              for meta in meta_cube_Bp)
+    dt = (t2 - t1).total_seconds()
+    dx = (2*np.pi*6.955e8*meta_cube_Bp[0]['CDELT2']/360)/1000
+    
+    return(dt, fields, dx)
+
+
+def compare(path, i, wsize):
+    '''
+    Runs the pair in float64 and float32 and prints the differences.
+    '''
+    dt, fields, dx = load_pair(path, i)
+    
+    results = {}
+    for dtype in (np.float64, np.float32):
+        start = time.perf_counter()
+        magvm, vel4vm = do_dave4vm.do_dave4vm(dt, *fields, dx, dx, wsize,
+                                              solver = 'cholesky',
+                                              dtype = dtype)
+        elapsed = time.perf_counter() - start
+        
+        if vel4vm['solved'] is False:
+            print(f'pair {i}: not solved')
+            return
+        
+        flux = poyntingflux(dx, magvm['bx'], magvm['by'], magvm['bz'],
+                            vel4vm['U0'], vel4vm['V0'], vel4vm['W0'])
+        results[dtype] = (elapsed, vel4vm, flux)
+        
+        # The weak field pixels, from the average field.
+        weak = np.sqrt(magvm['bx']**2 + magvm['by']**2 + 
+                       magvm['bz']**2) < 100
+    
+    (t64, v64, f64), (t32, v32, f32) = results[np.float64], \
+                                       results[np.float32]
+    
+    print(f'pair {i}: shape {fields[0].shape}, float64 {t64:.2f} s, '
+          f'float32 {t32:.2f} s')
+    
+    for key in ('U0', 'V0', 'W0'):
+        reference = np.nan_to_num(v64[key])
+        difference = np.abs(np.nan_to_num(v32[key]) - reference)
+        largest = np.abs(reference).max()
+        strong = np.abs(reference) > 0.01*largest
+        relative = difference/np.maximum(np.abs(reference), 1e-300)
+        
+        print(f'    {key}: max {difference.max()/largest:.2e}, median '
+              f'{np.median(relative[strong]):.2e}, weak field median '
+              f'{np.median(relative[weak]):.2e}')
+    
+    for name, n in (('int_Sn', 3), ('int_St', 4), ('int_Ss', 5)):
+        print(f'    {name}: {abs(f32[n] - f64[n])/abs(f64[n]):.2e}')
+
+
+if __name__ == '__main__':
+    
+    path = sys.argv[1]
+    first = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    npairs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    wsize = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+    
+    for i in range(first, first + npairs):
+        compare(path, i, wsize)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the two layouts of the packed DAVE4VM matrix: the planes
+(55,ny,nx), where the entries of a pixel are ny*nx values apart, and the
+pixel-major (ny,nx,55) written by assemble_matrix(pixel_major = True),
+where they are contiguous. The time to assemble the matrix, compute the
+trace and solve all the pixels is reported for each layout and solver.
+
+Run from the repository root, with pydave4vm installed, as:
+    python benchmarks/bench_matrix_layout.py [ny nx]
+
+@author: andrechicrala
+"""
+import sys
+import time
+
+import numpy as np
+
+from pydave4vm import dave4vm, dave4vm_matrix
+from pydave4vm.convolution import FFTConvolver
+from bench_multi_window import synthetic_magvm
+
+
+if __name__ == '__main__':
+    
+    shape = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 \
+            else (300, 600)
+    magvm = synthetic_magvm(shape)
+    kernel = dave4vm.build_kernel(20, magvm['dx'], magvm['dy'])
+    
+    engine = FFTConvolver(kernel, shape)
+    handles = [engine.forward(product) 
+               for product in dave4vm_matrix.matrix_products(magvm)]
+    
+    print(f'Shape: {shape}')
+    
+    for pixel_major in (False, True):
+        start = time.perf_counter()
+        AM = dave4vm_matrix.assemble_matrix(handles, engine, 
+                                            pixel_major = pixel_major)
+        assembled = time.perf_counter() - start
+        
+        # The trace, from the diagonal entries of each layout.
+        start = time.perf_counter()
+        if pixel_major:
+            trc = AM[:,:,dave4vm_matrix.DIAGONAL].sum(axis = -1)
+        else:
+            trc = AM[dave4vm_matrix.DIAGONAL].sum(axis = 0)
+        index = np.where(trc > 1)
+        traced = time.perf_counter() - start
+        
+        name = 'pixel-major (ny,nx,55)' if pixel_major else 'planes (55,ny,nx)'
+        print(f'{name}: assemble {assembled:.2f} s, trace {traced:.3f} s')
+        
+        for solver in ('lu', 'cholesky'):
+            start = time.perf_counter()
+            dave4vm.solve_pixels(AM, index, solver = solver,
+                                 pixel_major = pixel_major)
+            elapsed = time.perf_counter() - start
+            
+            print(f'    {solver}: {elapsed:.2f} s, '
+                  f'{index[0].size/elapsed/1e6:.2f} Mpixels/s')
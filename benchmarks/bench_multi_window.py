@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of calculate_dave4vm_multi against independent calls of
+calculate_dave4vm for several window sizes on the same pair.
+
+Synthetic smooth fields are used, the timings only depend on the shape.
+Run from the repository root, with pydave4vm installed, as:
+    python benchmarks/bench_multi_window.py [ny nx]
+
+@author: andrechicrala
+"""
+import sys
+import time
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from pydave4vm import odiffxy5, dave4vm
+
+
+def synthetic_magvm(shape):
+    '''
+    Builds the magvm dictionary of a synthetic pair of magnetograms.
+    '''
+    rng = np.random.RandomState(0)
+    fields = [gaussian_filter(rng.standard_normal(shape), 3)*3000
+              for i in range(6)]
+    fields[5] = fields[4] + 0.05*fields[5]
+    
+    bx = (fields[0] + fields[1])/2
+    by = (fields[2] + fields[3])/2
+    bz = (fields[4] + fields[5])/2
+    
+    # Calculating the differentials like do_dave4vm.
+    bxx, bxy = odiffxy5.odiff(bx)
+    byx, byy = odiffxy5.odiff(by)
+    bzx, bzy = odiffxy5.odiff(bz)
+    dx = dy = 364.3
+    
+    magvm = {'bzt': (fields[5] - fields[4])/720., 'bx': bx, 'bxx': bxx/dx,
+             'bxy': bxy/dy, 'by': by, 'byx': byx/dx, 'byy': byy/dy,
+             'bz': bz, 'bzx': bzx/dx, 'bzy': bzy/dy, 'dx': dx, 'dy': dy,
+             'dt': 720.}
+    
+    return(magvm)
+
+
+if __name__ == '__main__':
+    
+    shape = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 \
+            else (300, 600)
+    wsizes = [40, 32, 26, 20, 14, 10]
+    magvm = synthetic_magvm(shape)
+    
+    print(f'Shape: {shape}')
+    
+    # Independent runs.
+    single = {}
+    for wsize in wsizes:
+        start = time.perf_counter()
+        dave4vm.calculate_dave4vm(magvm, wsize)
+        single[wsize] = time.perf_counter() - start
+    
+    print(f'{len(wsizes)} independent runs: {sum(single.values()):.2f} s')
+    
+    # Sweeps sharing the products, with an increasing number of windows.
+    previous = 0
+    for n in range(1, len(wsizes) + 1):
+        start = time.perf_counter()
+        dave4vm.calculate_dave4vm_multi(magvm, wsizes[:n])
+        elapsed = time.perf_counter() - start
+        
+        print(f'sweep of {n} windows: {elapsed:.2f} s '
+              f'(extra window: {elapsed - previous:.2f} s, '
+              f'single run of {wsizes[n-1]}: {single[wsizes[n-1]]:.2f} s)')
+        previous = elapsed
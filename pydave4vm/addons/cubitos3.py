@@ -16,15 +16,80 @@ V3:
 This version is a little more optmized to do only pairs of fits per time.
 The counter from the for loop is imported to keep track of the changes
 
+FrameIndex:
+The directory is listed only once and the files are grouped by their T_REC,
+instead of globbing and sorting the whole directory for every pair.
+stream_pairs reads a series decoding each observation only once, keeping
+only the last one in memory.
+scan_headers reads only the headers of the observations into a table kept in
+a sidecar file of the directory, so that their metadata is known without
+decoding the images.
+
 
 @author: andrechicrala
 """
 #importing the 3rd party modules
 import sunpy
 import sunpy.map
-import glob
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+class FrameIndex:
+    '''
+    Index of the observations of a HARP directory, built by listing it 
+    once. The files, named like 
+    hmi.sharp_cea_720s.2587.20130103_000000_TAI.Br.fits, are grouped by 
+    their T_REC (the third field from the end) and only the T_RECs with
+    the three components Br, Bp and Bt are kept, in time order. The 
+    bitmap segment is optional.
+    '''
     
-def create_cube(path, i):
+    # The segments that make an observation.
+    COMPONENTS = ('Br', 'Bp', 'Bt')
+    
+    def __init__(self, path):
+        self.path = path
+        
+        #grouping the files of each T_REC
+        frames = {}
+        for name in os.listdir(path):
+            fields = name.split('.')
+            if len(fields) < 3 or fields[-1] != 'fits':
+                continue
+            frames.setdefault(fields[-3], {})[fields[-2]] = path + name
+        
+        #keeping the complete observations, in time order
+        self.t_recs = sorted(t_rec for t_rec, files in frames.items()
+                             if all(key in files for key in self.COMPONENTS))
+        self.frames = [frames[t_rec] for t_rec in self.t_recs]
+    
+    def __len__(self):
+        return(len(self.frames))
+    
+    def __getitem__(self, i):
+        '''
+        The dictionary with the path of each segment of observation i.
+        '''
+        return(self.frames[i])
+    
+    def paths(self, segment, i, n = 2):
+        '''
+        The paths of the segment for the n observations from i on, None 
+        where the segment is missing.
+        '''
+        return([frame.get(segment) for frame in self.frames[i:i+n]])
+    
+    def pairs(self):
+        '''
+        Iterates over the pairs of consecutive observations, yielding 
+        (i, start, stop) with the dictionaries of paths of i and i+1.
+        '''
+        for i in range(len(self.frames) - 1):
+            yield(i, self.frames[i], self.frames[i+1])
+    
+def create_cube(path, i, index = None):
     '''
     This module uses sunpy.map objects to 
     create datacubes with the information
@@ -32,16 +97,17 @@ def create_cube(path, i):
     These cubes will be returned so that
     the data analisys can begin in other
     modules.
+    index is the FrameIndex of path, made here if not given. It should
+    be made once and passed on when a series of pairs is read.
     '''
-    #adapting the paths
-    path_Br = [sorted(glob.glob(path+'*.Br.fits'))[i],
-               sorted(glob.glob(path+'*.Br.fits'))[i+1]]
+    #listing the directory only if needed
+    if index is None:
+        index = FrameIndex(path)
     
-    path_Bp = [sorted(glob.glob(path+'*.Bp.fits'))[i],
-               sorted(glob.glob(path+'*.Bp.fits'))[i+1]]
-    
-    path_Bt = [sorted(glob.glob(path+'*.Bt.fits'))[i],
-               sorted(glob.glob(path+'*.Bt.fits'))[i+1]]
+    #adapting the paths
+    path_Br = index.paths('Br', i)
+    path_Bp = index.paths('Bp', i)
+    path_Bt = index.paths('Bt', i)
     
     #Defining the paths for files
     cube_Br = sunpy.map.Map(path_Br, sequence=True)
@@ -70,6 +136,142 @@ def create_cube(path, i):
     return(data_cube_Br, data_cube_Bp, data_cube_Bt, 
            meta_cube_Bp)
 
+def create_bitmaps(path, i, index = None):
+    '''
+    Returns the data of the HARP bitmap segments of the observations i and
+    i+1, of the same T_REC as their Br files. None is returned for a 
+    missing bitmap. index is the FrameIndex of path, as in create_cube.
+    '''
+    if index is None:
+        index = FrameIndex(path)
+    
+    return([read_bitmap(file) for file in index.paths('bitmap', i)])
+
+def read_bitmap(file):
+    '''
+    Returns the data of a bitmap segment, or None if file is None.
+    '''
+    if file is None:
+        return(None)
+    
+    return(sunpy.map.Map(file).data)
+
+def read_frame(frame, bitmap = False):
+    '''
+    Decodes the observation given by a dictionary of paths of FrameIndex,
+    returning a dictionary with the data of 'Br', 'Bp' and 'Bt', the 
+    metadata of Bp as 'meta' and, if bitmap, the data of the bitmap 
+    segment as 'bitmap' (None if it is missing).
+    '''
+    data = {key: sunpy.map.Map(frame[key]) for key in FrameIndex.COMPONENTS}
+    
+    result = {key: data[key].data for key in FrameIndex.COMPONENTS}
+    result['meta'] = data['Bp'].meta
+    result['bitmap'] = None
+    if bitmap:
+        result['bitmap'] = read_bitmap(frame.get('bitmap'))
+    
+    return(result)
+
+def stream_pairs(path, index = None, bitmap = False, first = 0, 
+                 pairs = None):
+    '''
+    Generator over the pairs of consecutive observations of path, from 
+    the pair first on or only those listed in pairs (in increasing 
+    order), yielding (i, start, stop) with the dictionaries of read_frame
+    of the observations i and i+1. 
+    Each observation is decoded once and kept only until the next pair,
+    so a series is read with half the decoding of create_cube and with 
+    two observations in memory. The observations of the pairs left out
+    are not read. index is the FrameIndex of path, made here if not 
+    given.
+    '''
+    if index is None:
+        index = FrameIndex(path)
+    if pairs is None:
+        pairs = range(first, len(index) - 1)
+    
+    previous = None
+    for i in pairs:
+        #reusing the stop observation of the previous pair
+        if previous is not None and previous[0] == i:
+            start = previous[1]
+        else:
+            start = read_frame(index[i], bitmap = bitmap)
+        stop = read_frame(index[i+1], bitmap = bitmap)
+        
+        yield(i, start, stop)
+        
+        previous = (i + 1, stop)
+
+# The keywords kept by scan_headers, in lower case like the sunpy metadata.
+HEADER_KEYS = ('t_rec', 'date-obs', 'cdelt1', 'cdelt2', 'naxis1', 'naxis2',
+               'harpnum', 'lat_min', 'lat_max', 'lon_min', 'lon_max')
+
+# The sidecar file of the header table in the HARP directory.
+HEADER_SIDECAR = 'headers.json'
+
+def read_header(file):
+    '''
+    Reads only the header of the image in file, without its data, and 
+    returns the HEADER_KEYS (None for the missing ones). The image is 
+    the last HDU, the compressed SHARP segments being in the extension 1.
+    '''
+    with fits.open(file) as hdul:
+        header = hdul[-1].header
+        return({key: header.get(key.upper()) for key in HEADER_KEYS})
+
+def scan_headers(path, index = None, workers = None, segment = 'Bp', 
+                 sidecar = HEADER_SIDECAR):
+    '''
+    Returns the table of the headers of the segment of every observation
+    of path: a dictionary with a list for each of the HEADER_KEYS, in the
+    order of index (the FrameIndex of path, made here if not given), and
+    'frame' with the T_RECs of the file names.
+    The table is saved as the sidecar file of path and read from it by 
+    the next runs, being scanned again only if the observations changed.
+    The headers are read by workers threads, one by default. sidecar 
+    None neither reads nor writes the file.
+    '''
+    if index is None:
+        index = FrameIndex(path)
+    
+    #taking the table of a previous run if it is still current
+    file = None if sidecar is None else path + sidecar
+    if file is not None and os.path.exists(file):
+        try:
+            with open(file) as stream:
+                table = json.load(stream)
+        except (OSError, ValueError):
+            table = {}
+        if table.get('frame') == index.t_recs:
+            return(table)
+    
+    #reading the headers, in parallel if asked to
+    files = [frame[segment] for frame in index.frames]
+    if workers is not None and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            headers = list(pool.map(read_header, files))
+    else:
+        headers = [read_header(item) for item in files]
+    
+    #organizing them by column
+    table = {key: [header[key] for header in headers] for key in HEADER_KEYS}
+    table['frame'] = list(index.t_recs)
+    
+    if file is not None:
+        with open(file, 'w') as stream:
+            json.dump(table, stream)
+    
+    return(table)
+
+def header_row(table, i):
+    '''
+    The metadata of the observation i in the table of scan_headers, as a
+    dictionary like the sunpy metadata.
+    '''
+    return({key: column[i] for key, column in table.items()})
+
 if __name__ == '__main__':
     '''
     The classical testing zone
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module converts the Br, Bp and Bt segments of a HARP directory into a
+single (T,3,H,W) cube saved as a .npy file, which is memory mapped by the
+next runs instead of decoding the FITS files again. A sidecar JSON file
+keeps the T_REC and the metadata of each observation.
+
+The ingestion is run once per directory:
+    python -m pydave4vm.addons.ingest /path/to/2587/
+
+and cube_pairs then yields the pairs of observations as views of the cube,
+like cubitos3.stream_pairs. The observations whose shape differs from the
+first one are left out of the cube and listed in the sidecar. The bitmaps
+are not ingested, they are read from their FITS files when asked for.
+
+@author: andrechicrala
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+
+from pydave4vm.addons import cubitos3
+
+# The files of the cube and of its sidecar in the HARP directory.
+CUBE_FILE = 'fields.npy'
+CUBE_SIDECAR = 'fields.json'
+
+# The cubes already opened in this process, by path.
+_cubes = {}
+
+def ingest(path, index = None, workers = None):
+    '''
+    Decodes every observation of path once and writes the cube of its
+    fields, (T,3,H,W) in the order of cubitos3.FrameIndex.COMPONENTS,
+    with the dtype of the images in native byte order. The shapes are 
+    taken from the headers (see cubitos3.scan_headers, read by workers
+    threads) so that the cube is made at once. The sidecar of a previous
+    ingestion is removed first and the new one written last, after the 
+    cube was moved into place from a temporary file, so an interrupted
+    ingestion is never used.
+    Returns the cube, opened read only, and the sidecar table.
+    '''
+    if index is None:
+        index = cubitos3.FrameIndex(path)
+    if len(index) == 0:
+        raise ValueError('There are no observations in ' + path)
+
+    # Keeping the observations of the shape of the first one.
+    headers = cubitos3.scan_headers(path, index, workers = workers)
+    shapes = list(zip(headers['naxis2'], headers['naxis1']))
+    keep = [n for n, shape in enumerate(shapes) if shape == shapes[0]]
+    kept = set(keep)
+
+    # Forgetting the previous cube before it is replaced.
+    _cubes.pop(path, None)
+    if os.path.exists(path + CUBE_SIDECAR):
+        os.remove(path + CUBE_SIDECAR)
+
+    cube = None
+    temporary = path + CUBE_FILE + '.' + str(os.getpid())
+    meta = []
+    for k, n in enumerate(keep):
+        frame = cubitos3.read_frame(index[n])
+
+        # Creating the file with the dtype of the images, in the byte
+        # order of the machine instead of the big endian of FITS.
+        if cube is None:
+            cube = np.lib.format.open_memmap(
+                    temporary, mode = 'w+',
+                    dtype = frame['Br'].dtype.newbyteorder('='),
+                    shape = (len(keep), 3) + tuple(shapes[0]))
+
+        for c, key in enumerate(cubitos3.FrameIndex.COMPONENTS):
+            if np.shape(frame[key]) != cube.shape[2:]:
+                raise ValueError('The shape of ' + index[n][key] +
+                                 ' does not match its header.')
+            cube[k,c] = frame[key]
+        meta.append(dict(frame['meta']))
+
+    cube.flush()
+    del cube
+    os.replace(temporary, path + CUBE_FILE)
+
+    table = {'frame': [index.t_recs[n] for n in keep],
+             'skipped': [t_rec for n, t_rec in enumerate(index.t_recs)
+                         if n not in kept],
+             'components': list(cubitos3.FrameIndex.COMPONENTS),
+             'meta': meta}
+
+    # Writing the sidecar through a temporary file.
+    temporary = path + CUBE_SIDECAR + '.' + str(os.getpid())
+    with open(temporary, 'w') as stream:
+        json.dump(table, stream)
+    os.replace(temporary, path + CUBE_SIDECAR)
+
+    return(open_cube(path))
+
+def open_cube(path, index = None):
+    '''
+    Returns the cube of path, memory mapped read only, and its sidecar
+    table, or None if the directory was not ingested. If index, the
+    FrameIndex of path, is given None is also returned when the
+    observations changed after the ingestion. The cube is opened only
+    once per process.
+    '''
+    if path not in _cubes:
+        try:
+            with open(path + CUBE_SIDECAR) as stream:
+                table = json.load(stream)
+            cube = np.load(path + CUBE_FILE, mmap_mode = 'r')
+        except (OSError, ValueError):
+            return(None)
+        _cubes[path] = (cube, table)
+
+    cube, table = _cubes[path]
+    if index is not None and sorted(table['frame'] +
+                                    table['skipped']) != index.t_recs:
+        return(None)
+
+    return(cube, table)
+
+def cube_frame(cube, table, n, index = None):
+    '''
+    The observation n of the cube as the dictionary of
+    cubitos3.read_frame, whose images are views of the cube. If index, 
+    the FrameIndex of the directory, is given the bitmap of the same 
+    T_REC is read from its FITS file (None if it is missing), otherwise
+    the bitmap is None.
+    '''
+    frame = {key: cube[n,c] for c, key in enumerate(table['components'])}
+    frame['meta'] = table['meta'][n]
+    frame['bitmap'] = None
+    if index is not None:
+        position = index.t_recs.index(table['frame'][n])
+        frame['bitmap'] = cubitos3.read_bitmap(index[position].get('bitmap'))
+
+    return(frame)
+
+def cube_frames(path, i, index = None):
+    '''
+    The (start, stop) observations i and i+1 of the cube of path, with
+    their bitmaps if index is given (see cube_frame).
+    '''
+    cube, table = open_cube(path)
+
+    return(cube_frame(cube, table, i, index), 
+           cube_frame(cube, table, i+1, index))
+
+def cube_pairs(path, first = 0, pairs = None, index = None):
+    '''
+    Generator over the pairs of consecutive observations of the cube of
+    path, from the pair first on or only those listed in pairs, yielding
+    (i, start, stop) like cubitos3.stream_pairs, with the bitmaps if 
+    index is given (see cube_frame). Nothing is copied, the pages of the
+    file are read when the images are used.
+    '''
+    cube, table = open_cube(path)
+
+    if pairs is None:
+        pairs = range(first, cube.shape[0] - 1)
+
+    for i in pairs:
+        yield(i, cube_frame(cube, table, i, index), 
+              cube_frame(cube, table, i+1, index))
+
+if __name__ == '__main__':
+    '''
+    Ingesting the HARP directory given in the command line.
+    '''
+
+    path = sys.argv[1]
+    if not path.endswith('/'):
+        path += '/'
+
+    cube, table = ingest(path)
+    print(f'{cube.shape[0]} observations ingested into {path + CUBE_FILE}, '
+          f'{len(table["skipped"])} skipped.')
@@ -53,10 +53,11 @@ def poyntingflux(dx, Bx, By, Bz, Vx, Vy, Vz):
     # Summing the contributions from normal and tangenrial components.
     Ss = np.add(Sn,St)
     
-    # Integrating over the image space.
-    int_Sn = np.sum(Sn)
-    int_St = np.sum(St)
-    int_Ss = np.sum(Ss)
+    # Integrating over the image space, accumulating in float64 even if
+    # the fields are float32 and skipping the pixels masked with NaN.
+    int_Sn = np.nansum(Sn, dtype = np.float64)
+    int_St = np.nansum(St, dtype = np.float64)
+    int_Ss = np.nansum(Ss, dtype = np.float64)
     
     return(Sn, St, Ss, int_Sn, int_St, int_Ss)
 
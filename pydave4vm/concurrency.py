@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module holds the single concurrency setting of pydave4vm: a budget of
+cores shared between the two levels of parallelism, the processes working
+on different pairs of observations (execute.prepare) and the threads used
+inside each of them by the FFTs of the convolution engine and by the
+linear algebra of the solver.
+
+split_budget divides the cores so that processes*threads never exceeds
+the budget, and limit_threads applies the number of threads in a process,
+being used as the initializer of the process pool. The budget is the
+number of cores of the machine unless PYDAVE4VM_CORES is set.
+
+The BLAS threads are only limited if threadpoolctl is installed.
+
+bounded_map runs the pairs in the process pool keeping only a few of them
+submitted or finished and not yet consumed, bounding the memory taken by 
+their results.
+
+prefetch overlaps the reading of the observations with the work on them,
+running the reading in a background thread that stays a few items ahead.
+
+@author: andrechicrala
+"""
+
+import collections
+import os
+import queue
+import threading
+import time
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+# Number of threads used by the FFTs of this process.
+_fft_workers = 1
+
+# The BLAS limits in place, kept alive for the whole process.
+_blas_limits = None
+
+
+def core_budget(cores = None):
+    '''
+    Returns the number of cores to be used: cores if given, then the
+    PYDAVE4VM_CORES environment variable and then all of the machine.
+    '''
+
+    if cores is None:
+        cores = os.environ.get('PYDAVE4VM_CORES') or os.cpu_count() or 1
+
+    return(max(1, int(cores)))
+
+
+def split_budget(cores = None, tasks = None, processes = None):
+    '''
+    Divides the core budget between processes and threads per process,
+    returning (processes, threads) with processes*threads <= cores.
+    The independent pairs are the coarser and better parallelism, so by
+    default there is one process per core, as long as there are tasks
+    (pairs) for them, and the cores left over become threads. processes
+    can be given to fix the number of processes, within the budget.
+    '''
+
+    cores = core_budget(cores)
+
+    if processes is None:
+        processes = cores
+    processes = max(1, min(int(processes), cores))
+    if tasks is not None:
+        processes = max(1, min(processes, tasks))
+
+    return(processes, max(1, cores//processes))
+
+
+def fft_workers():
+    '''
+    Number of threads used by the FFTs of this process.
+    '''
+
+    return(_fft_workers)
+
+
+def limit_threads(threads):
+    '''
+    Sets the number of threads used inside this process by the FFTs and,
+    if threadpoolctl is installed, by the BLAS of the solver.
+    '''
+
+    global _fft_workers, _blas_limits
+
+    _fft_workers = max(1, int(threads))
+
+    if threadpool_limits is not None:
+        _blas_limits = threadpool_limits(limits = _fft_workers,
+                                         user_api = 'blas')
+
+
+def bounded_map(pool, function, items, window):
+    '''
+    Like pool.map, yielding function(item) for each of items in order, 
+    but with at most window items submitted to the pool and not yet 
+    yielded, instead of all of them at once. The results that wait for 
+    a slow consumer are then bounded to window.
+    '''
+    
+    items = iter(items)
+    futures = collections.deque()
+    
+    try:
+        while True:
+            # Keeping the window full.
+            for item in items:
+                futures.append(pool.submit(function, item))
+                if len(futures) >= window:
+                    break
+            
+            if not futures:
+                return
+            
+            yield(futures.popleft().result())
+    
+    finally:
+        # Not running the items left if the caller stopped early.
+        for future in futures:
+            future.cancel()
+
+
+# Kinds of the items passed by the prefetch thread.
+_ITEM, _ERROR, _DONE = range(3)
+
+
+def prefetch(iterable, depth = 2, counters = None):
+    '''
+    Generator over the items of iterable, which are produced in a
+    background thread while the caller works on the previous ones, e.g.
+    the FITS files of the next pairs being read and decoded while the 
+    current pair is solved. At most depth items are kept waiting in the 
+    queue, bounding the memory. An exception raised by iterable is raised
+    again here.
+    
+    counters is an optional dictionary where the number of 'items' and 
+    the seconds spent producing them ('read'), blocked waiting for them
+    ('wait') and working on them outside of this generator ('compute')
+    are written. A large wait means that the work is limited by the 
+    reading.
+    '''
+    
+    if counters is None:
+        counters = {}
+    counters.update({'items': 0, 'read': 0., 'wait': 0., 'compute': 0.})
+    
+    items = queue.Queue(maxsize = max(1, int(depth)))
+    stop = threading.Event()
+    
+    def put(item):
+        # Giving up if the caller is gone.
+        while not stop.is_set():
+            try:
+                items.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                pass
+    
+    def produce():
+        try:
+            iterator = iter(iterable)
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                counters['read'] += time.perf_counter() - start
+                put((_ITEM, item))
+        except BaseException as error:
+            put((_ERROR, error))
+        put((_DONE, None))
+    
+    thread = threading.Thread(target = produce, daemon = True)
+    thread.start()
+    
+    try:
+        while True:
+            start = time.perf_counter()
+            kind, item = items.get()
+            counters['wait'] += time.perf_counter() - start
+            
+            if kind == _DONE:
+                return
+            if kind == _ERROR:
+                raise item
+            
+            counters['items'] += 1
+            start = time.perf_counter()
+            yield(item)
+            counters['compute'] += time.perf_counter() - start
+    
+    finally:
+        # Stopping the thread if the caller stopped early.
+        stop.set()
+        thread.join()
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module holds the convolution engine used to build the DAVE4VM matrix.
+
+The matrix is made of more than a hundred convolutions, but there are only
+six different kernels (psf, psfx, psfy, psfxx, psfyy, psfxy) and each
+product image is convolved with several of them. Instead of calling
+scipy.signal.convolve for every term, which transforms both the image and
+the kernel every time, the kernels are transformed once, each product is
+transformed once and the convolutions are done as products in the
+frequency domain followed by a single inverse transform.
+
+Real FFTs are used and the images are padded to fast lengths, large
+enough to avoid wrap-around, so that the results match
+scipy.signal.convolve(image, kernel, mode='same').
+
+Since the DAVE4VM kernels are a top-hat window times polynomials in x and y,
+they can also be convolved exactly with cumulative sums of the images 
+weighted by powers of the pixel position (summed-area tables). The cost of
+this backend does not depend on the window size and needs no padding, 
+which pays off for large windows. The backend is chosen with the method 
+option of make_engine: 'fft', 'sat' or 'direct', the latter convolving 
+each term in the image domain, which can win for small windows and 
+patches. With 'auto' the fastest one is picked by tuning.py.
+
+The FFTs use the number of threads set by concurrency.limit_threads, one
+by default, so that they share the core budget with the process pool.
+
+The engines take a dtype, float64 by default, which is the precision of
+the product images and of their forward transforms. With float32 these 
+take half the memory and the forward FFTs are faster. The convolutions 
+are always accumulated and returned in float64: the kernel spectra are 
+float64, so the sums in the frequency domain and the inverse FFTs are 
+done in double precision, and the summed-area tables are accumulated in
+float64. The round-off of an FFT is relative to the largest values of 
+the whole image, so with the 3000 G of a sunspot next to a 30 G quiet 
+Sun the weak-field pixels would otherwise lose most of their digits.
+
+@author: andrechicrala
+"""
+
+import numpy as np
+from scipy import fft, signal
+
+from pydave4vm import concurrency
+from scipy.special import comb
+
+
+def padded_shape(shape, kshape):
+    '''
+    Shape, fast for the FFT, to which images of the given shape are padded
+    to be convolved with kernels of shape kshape without wrap-around.
+    '''
+
+    return(tuple(fft.next_fast_len(n + k - 1, True)
+                 for n, k in zip(shape, kshape)))
+
+
+def spectrum_shape(fshape):
+    '''
+    Shape of the real FFT of an image padded to fshape.
+    '''
+
+    return(tuple(fshape[:-1]) + (fshape[-1]//2 + 1,))
+
+
+def transform_kernel(kernel, fshape, dtype = np.float64):
+    '''
+    Returns the dictionary with the real FFT of each kernel array, padded
+    to fshape, in the precision dtype.
+    '''
+
+    return({name: fft.rfft2(np.asarray(value, dtype = dtype), s = fshape)
+            for name, value in kernel.items()})
+
+
+class FFTConvolver:
+    '''
+    Convolves images with the DAVE4VM kernels in the frequency domain.
+
+    kernel is the dictionary with the kernel arrays (psf, psfx, ...) and
+    shape is the shape of the images that will be convolved. fshape forces
+    the padded shape of the transforms, so that engines of different 
+    window sizes can share the spectra of the same images, as long as it
+    is large enough for the largest window. dtype is the precision of 
+    the images and of their spectra, the results being float64. spectra
+    optionally gives the float64 kernel transforms already computed for 
+    fshape (see dave4vm.kernel_spectra), which are then not recomputed.
+    accumulator optionally gives the complex128 (2,) + spectrum shape 
+    buffer where combine sums the terms (see spectrum_shape), e.g. from 
+    a dave4vm.Dave4vmWorkspace; otherwise the engine makes its own the 
+    first time it is needed.
+    '''
+
+    def __init__(self, kernel, shape, fshape = None, dtype = np.float64,
+                 spectra = None, accumulator = None):
+
+        # Shape of the images and of the kernels.
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        kshape = kernel['psf'].shape
+
+        # The linear convolution has the full size of image + kernel - 1.
+        # Padding it to lengths that are fast for the FFT.
+        if fshape is None:
+            fshape = padded_shape(self.shape, kshape)
+        elif any(f < n + k - 1 for f, n, k in zip(fshape, self.shape, kshape)):
+            raise ValueError('The padded shape ' + str(tuple(fshape)) +
+                             ' is too small for this window.')
+        self.fshape = tuple(fshape)
+
+        # Where the 'same' output starts inside the full convolution.
+        self.start = tuple((k - 1)//2 for k in kshape)
+
+        # Transforming each of the kernels only once.
+        if spectra is None:
+            spectra = transform_kernel(kernel, self.fshape)
+        self.kernels = spectra
+        self.accumulator = accumulator
+
+    def buffers(self, shape):
+        '''
+        The accumulator and the temporary spectrum used for the terms of
+        spectra of the given shape, made again only when the shape
+        changes, e.g. for a stack of images.
+        '''
+
+        if self.accumulator is None or self.accumulator.shape[1:] != shape:
+            self.accumulator = np.empty((2,) + tuple(shape), 
+                                        dtype = np.complex128)
+
+        return(self.accumulator[0], self.accumulator[1])
+
+    def forward(self, image):
+        '''
+        Returns the spectrum of an image, padded to the engine shape. A 
+        stack of images (...,ny,nx) is transformed in a single call over
+        the last two axes.
+        '''
+
+        return(fft.rfft2(np.asarray(image, dtype = self.dtype), 
+                         s = self.fshape, 
+                         workers = concurrency.fft_workers()))
+
+    def inverse(self, spectrum):
+        '''
+        Transforms a spectrum back and crops it to the image shape like
+        the 'same' mode of scipy.signal.convolve.
+        '''
+
+        full = fft.irfft2(spectrum, s = self.fshape, 
+                          workers = concurrency.fft_workers())
+
+        return(full[...,self.start[0]:self.start[0] + self.shape[0],
+                    self.start[1]:self.start[1] + self.shape[1]])
+
+    def convolve(self, spectrum, name):
+        '''
+        Convolves the image whose spectrum is given with the kernel name.
+        '''
+
+        product, _ = self.buffers(np.shape(spectrum))
+
+        return(self.inverse(np.multiply(spectrum, self.kernels[name], 
+                                        out = product)))
+
+    def combine(self, terms):
+        '''
+        Returns the sum of the convolutions given as a list of
+        (coefficient, spectrum, kernel name), accumulated in the frequency
+        domain so that a single inverse transform is needed. The terms are
+        summed in place into the complex128 accumulator, so the sum and 
+        the inverse transform are float64 and no spectrum is allocated.
+        '''
+
+        spectrum, term = self.buffers(np.shape(terms[0][1]))
+        
+        coef, handle, name = terms[0]
+        np.multiply(handle, self.kernels[name], out = spectrum)
+        spectrum *= coef
+        
+        for coef, handle, name in terms[1:]:
+            np.multiply(handle, self.kernels[name], out = term)
+            term *= coef
+            spectrum += term
+
+        return(self.inverse(spectrum))
+
+
+def window_sum(image, axis, power, c):
+    '''
+    Sums image*m**power over the windows of 2c+1 pixels along axis, with
+    m the pixel position (centred in the axis to keep the sums small) and
+    zeros outside the image. The sums come from the differences of a 
+    cumulative sum, so their cost does not depend on the window size.
+    '''
+
+    L = image.shape[axis]
+
+    # Slices selecting a range of the axis.
+    def along(start, stop):
+        return((slice(None),)*axis + (slice(start, stop),))
+
+    # Padding the image with zeros so that every window fits in it, plus
+    # a leading zero for the cumulative sum.
+    shape = list(image.shape)
+    shape[axis] = L + 2*c + 1
+    padded = np.zeros(shape)
+    padded[along(c+1, c+1+L)] = image
+    if power > 0:
+        bshape = [1]*image.ndim
+        bshape[axis] = L
+        padded[along(c+1, c+1+L)] *= np.reshape((np.arange(L) - L//2)**power,
+                                                bshape)
+
+    C = np.cumsum(padded, axis = axis, out = padded)
+
+    return(C[along(2*c+1, None)] - C[along(0, L)])
+
+
+def position(L, axis, ndim):
+    '''
+    Centred pixel positions of an axis, shaped to broadcast along it.
+    '''
+
+    bshape = [1]*ndim
+    bshape[axis] = L
+
+    return(np.reshape(np.arange(L) - L//2, bshape))
+
+
+def box_moment(sums, axis, order, start, step, c):
+    '''
+    Convolves an image along axis with the 1D kernel 
+    (step*(q - start))**order, q = 0..2c, in the 'same' mode of 
+    scipy.signal.convolve. sums is the list of window_sum of the image for
+    the powers 0..order.
+    '''
+
+    # The kernel position of pixel m in the window of p is p + c - m, so
+    # the kernel is step*(s - m) with s = p + c - start.
+    s = position(sums[0].shape[axis], axis, sums[0].ndim) + c - start
+
+    # Binomial expansion of (s - m)**order.
+    out = 0
+    for t in range(order + 1):
+        out = out + comb(order, t)*(-1)**t*s**(order - t)*sums[t]
+
+    return(out*step**order)
+
+
+def box_moments(images, axis, start, step, c):
+    '''
+    Returns the sum of the convolutions of images[order] with the kernels
+    (step*(q - start))**order along axis. Expanding (s - m)**order, the
+    terms sharing the same power of s are summed before the window sums, 
+    so at most one window sum is needed per power of s.
+    '''
+
+    first = list(images.values())[0]
+    L = first.shape[axis]
+    m = position(L, axis, first.ndim)
+    s = m + c - start
+
+    out = 0
+    for e in range(max(images) + 1):
+        # Weighting the images whose kernel has the power e of s.
+        weighted = 0
+        for order, image in images.items():
+            t = order - e
+            if t >= 0:
+                weighted = weighted + comb(order, t)*(-1)**t*step**order*\
+                           m**t*image
+        
+        if not np.isscalar(weighted):
+            out = out + s**e*window_sum(weighted, axis, 0, c)
+
+    return(out)
+
+
+class SummedAreaConvolver:
+    '''
+    Convolves images with the DAVE4VM kernels using summed-area tables.
+
+    The kernels must be the top-hat window built by dave4vm.build_kernel,
+    i.e. psf constant and psfx = -x*psf, psfy = -y*psf, psfxx = x*x*psf,
+    psfyy = y*y*psf and psfxy = x*y*psf. The window size, the pixel 
+    scale and the origin of x and y are read from the kernels. The sums
+    are accumulated and returned in float64, dtype being the precision 
+    of the images.
+    '''
+
+    # Powers of x and y and the sign of each kernel.
+    MOMENTS = {'psf': (0, 0, 1), 'psfx': (1, 0, -1), 'psfy': (0, 1, -1),
+               'psfxx': (2, 0, 1), 'psfyy': (0, 2, 1), 'psfxy': (1, 1, 1)}
+
+    def __init__(self, kernel, shape, dtype = np.float64):
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        psf = kernel['psf']
+
+        # The window must be square with an odd size.
+        if psf.shape[0] != psf.shape[1] or psf.shape[0] % 2 != 1:
+            raise ValueError('The summed-area backend needs a square window '
+                             'with an odd size.')
+        self.c = (psf.shape[0] - 1)//2
+        self.weight = psf[0,0]
+
+        # Reading the x and y positions of the window from the kernels.
+        x = -kernel['psfx'][0]/self.weight
+        y = -kernel['psfy'][:,0]/self.weight
+        self.dx = x[1] - x[0]
+        self.dy = y[1] - y[0]
+        self.x0 = -x[0]/self.dx
+        self.y0 = -y[0]/self.dy
+
+        # Checking that the kernels really have the expected form.
+        X, Y = np.meshgrid(x, y)
+        expected = {'psf': np.ones(psf.shape), 'psfx': -X, 'psfy': -Y,
+                    'psfxx': X*X, 'psfyy': Y*Y, 'psfxy': X*Y}
+        for name, value in kernel.items():
+            if not np.allclose(value, self.weight*expected[name], rtol = 1e-10,
+                               atol = 0):
+                raise ValueError('The summed-area backend needs the top-hat '
+                                 'DAVE4VM kernel, ' + name + ' does not match.')
+
+    def forward(self, image):
+        '''
+        Returns the handle of an image. The convolutions along x are
+        computed when first needed and shared among the kernels.
+        '''
+
+        return({'image': image})
+
+    def convolve(self, handle, name):
+        '''
+        Convolves the image of handle with the kernel name.
+        '''
+
+        return(self.combine([(1, handle, name)]))
+
+    def combine(self, terms):
+        '''
+        Returns the sum of the convolutions given as a list of
+        (coefficient, handle, kernel name). The terms are summed after the
+        convolution along x, so only one convolution along y is done for
+        each power of y.
+        '''
+
+        # Summing the terms by power of y.
+        partial = {}
+        for coef, handle, name in terms:
+            xorder, yorder, sign = self.MOMENTS[name]
+
+            # Convolving along x (axis 1) once per power of x.
+            if xorder not in handle:
+                sums = [self.xsum(handle, t) for t in range(xorder + 1)]
+                handle[xorder] = box_moment(sums, 1, xorder, self.x0,
+                                            self.dx, self.c)
+
+            partial[yorder] = partial.get(yorder, 0) + \
+                              coef*sign*handle[xorder]
+
+        # And then convolving along y (axis 0).
+        out = box_moments(partial, 0, self.y0, self.dy, self.c)
+
+        return(self.weight*out)
+
+    def xsum(self, handle, power):
+        '''
+        Window sums along x of the image of handle, kept in the handle so
+        that each power is only summed once.
+        '''
+
+        if ('sum', power) not in handle:
+            handle[('sum', power)] = window_sum(handle['image'], 1, power,
+                                                self.c)
+
+        return(handle[('sum', power)])
+
+
+class DirectConvolver:
+    '''
+    Convolves images with the DAVE4VM kernels in the image domain, with 
+    scipy.signal.convolve(method = 'direct'). Its cost grows with the 
+    area of the window but it needs no transforms nor padding. The 
+    images are kept in dtype and convolved with float64 kernels, giving
+    float64 results.
+    '''
+
+    def __init__(self, kernel, shape, dtype = np.float64):
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.kernels = {name: np.asarray(value, dtype = np.float64)
+                        for name, value in kernel.items()}
+
+    def forward(self, image):
+        '''
+        Returns the handle of an image, the image itself.
+        '''
+
+        return(np.asarray(image, dtype = self.dtype))
+
+    def convolve(self, image, name):
+        '''
+        Convolves the image with the kernel name.
+        '''
+
+        return(signal.convolve(image, self.kernels[name], mode = 'same',
+                               method = 'direct'))
+
+    def combine(self, terms):
+        '''
+        Returns the sum of the convolutions given as a list of
+        (coefficient, image, kernel name).
+        '''
+
+        out = 0
+        for coef, image, name in terms:
+            out = out + coef*self.convolve(image, name)
+
+        return(np.asarray(out, dtype = np.float64))
+
+
+# The available convolution backends.
+ENGINES = {'fft': FFTConvolver, 'sat': SummedAreaConvolver, 
+           'direct': DirectConvolver}
+
+
+def make_engine(method, kernel, shape, dtype = np.float64):
+    '''
+    Builds the convolution engine of the given method for images of
+    the given shape and precision dtype.
+    '''
+
+    if method not in ENGINES:
+        raise ValueError('Unknown convolution method ' + str(method) + 
+                         ', use one of ' + str(sorted(ENGINES)) + '.')
+
+    return(ENGINES[method](kernel, shape, dtype = dtype))
@@ -9,36 +9,21 @@ dave4vm.
 @author: andrechicrala
 """
 import numpy as np
-from pydave4vm import dave4vm_matrix
+from scipy.ndimage import maximum_filter
+from pydave4vm import dave4vm_matrix, tuning
+from pydave4vm.convolution import (FFTConvolver, make_engine, padded_shape,
+                                   spectrum_shape, transform_kernel)
 from numpy.linalg import solve
+import functools
 import copy
 
 
-#the actual thing
-def calculate_dave4vm(magvm,wsize):
+def build_kernel(wsize, dx, dy):
     '''
-    This is the main body of DAVE4VM. Here the kernel is built,
-    the convolutions performed and the system solutions are calculated
-    returning the dictionary with the values.
+    Builds the DAVE4VM kernel: the top-hat window psf and its moments
+    psfx, psfy, psfxx, psfyy and psfxy, returned as a dictionary.
     '''
     
-    # Copying the dictionary to a variable    
-    mag_dic = copy.copy(magvm)
-    
-    #Defining arrays taking the shape of bz to later create arrays with the same shape.
-    sz = mag_dic['bz'].shape
-    
-    # Creating lists to receive the data.
-    U0 = np.zeros((sz[0],sz[1]))
-    V0 = np.zeros((sz[0],sz[1]))
-    UX = np.zeros((sz[0],sz[1]))
-    VY = np.zeros((sz[0],sz[1]))
-    UY = np.zeros((sz[0],sz[1]))
-    VX = np.zeros((sz[0],sz[1]))
-    W0 = np.zeros((sz[0],sz[1]))
-    WX = np.zeros((sz[0],sz[1]))
-    WY = np.zeros((sz[0],sz[1]))
-        
     # Constructing the weighting functions.
     nw = int(2*int(wsize/2)+1)
         
@@ -46,8 +31,8 @@ def calculate_dave4vm(magvm,wsize):
     nw2 = np.subtract(np.array(range(0,nw)),10)
         
     # Creating the weighting functions.
-    x = np.array([nw2,]*nw)*mag_dic['dx']
-    y = np.matrix.transpose(np.array([nw2,]*nw))*mag_dic['dy']
+    x = np.array([nw2,]*nw)*dx
+    y = np.matrix.transpose(np.array([nw2,]*nw))*dy
         
     # Creating the kernel.
     psf = np.full((nw,nw), 1, dtype = 'float64')
@@ -64,64 +49,739 @@ def calculate_dave4vm(magvm,wsize):
               'psfy': psfy, 'psfxx': psfxx,
               'psfyy': psfyy, 'psfxy': psfxy}
     
-    # Calling the function that computes the matrix that spams the results.
-    AM = dave4vm_matrix.the_matrix(mag_dic['bx'], mag_dic['bxx'], 
-                                   mag_dic['bxy'], mag_dic['by'], 
-                                   mag_dic['byx'], mag_dic['byy'],
-                                   mag_dic['bz'], mag_dic['bzx'],
-                                   mag_dic['bzy'], mag_dic['bzt'],
-                                   kernel['psf'], kernel['psfx'], 
-                                   kernel['psfy'], kernel['psfxx'], 
-                                   kernel['psfyy'], kernel['psfxy'])
+    return(kernel)
+
+
+# Number of kernels and of sets of kernel spectra kept by the caches. A 
+# run uses one window size (a few for a sweep) and one image shape, but 
+# the tiles at the edges have other shapes. The kernels are small, but a 
+# set of spectra is six padded complex128 images, ~37 MB for a 600x1200
+# field, so only the few sets of the current run are kept, in every 
+# process of a pool.
+KERNEL_CACHE_SIZE = 32
+SPECTRA_CACHE_SIZE = 4
+
+
+def read_only(kernel):
+    '''
+    Marks the arrays of a kernel dictionary as read-only, since they are
+    shared by every caller of the caches.
+    '''
+    
+    for value in kernel.values():
+        value.flags.writeable = False
     
-    # Reshaping the matrix.
-    AM = np.reshape(AM,(10,10,sz[0],sz[1]))
+    return(kernel)
 
-    # Computing the trace with numpy.
-    trc = np.trace(AM, axis1 = 0, axis2 = 1)
+
+@functools.lru_cache(maxsize = KERNEL_CACHE_SIZE)
+def cached_kernel(wsize, dx, dy):
+    '''
+    build_kernel kept in a LRU cache, since the window size and the pixel
+    scale are the same for a whole HARP run. The arrays are read-only.
+    '''
     
-    # Indexing points where the trace is bigger than 1.
-    try:
-        index = np.where(trc > 1)
+    return(read_only(build_kernel(wsize, dx, dy)))
+
+
+@functools.lru_cache(maxsize = SPECTRA_CACHE_SIZE)
+def kernel_spectra(wsize, dx, dy, fshape):
+    '''
+    The float64 FFTs of cached_kernel padded to fshape, kept in a LRU
+    cache so that FFTConvolver does not transform the 
+    kernels again for every pair. The arrays are read-only.
+    '''
+    
+    return(read_only(transform_kernel(cached_kernel(wsize, dx, dy), 
+                                      fshape)))
+
+
+def kernel_cache_info():
+    '''
+    Returns the hits, misses and sizes of the kernel caches, as the 
+    functools cache_info of cached_kernel and kernel_spectra.
+    '''
+    
+    return({'kernels': cached_kernel.cache_info(),
+            'spectra': kernel_spectra.cache_info()})
+
+
+def clear_kernel_cache():
+    '''
+    Empties the kernel caches and resets their counters.
+    '''
+    
+    cached_kernel.cache_clear()
+    kernel_spectra.cache_clear()
+
+
+class Dave4vmWorkspace:
+    '''
+    Buffers for running DAVE4VM on many pairs of the same shape, e.g. a
+    whole HARP series: the averaged fields, their derivatives, the 
+    products, their spectra and the frequency domain accumulator of the
+    FFT engine, the packed matrix, the chunks of systems of solve_pixels
+    and the coefficients. It is made once
+    for the shape and dtype and given to do_dave4vm or calculate_dave4vm
+    through their workspace option, so that the pairs after the first do
+    not allocate these images again. Tiles smaller than the field use 
+    the beginning of the same buffers.
+    
+    The results are written in the workspace too, so the arrays of magvm
+    and vel4vm are overwritten by the next pair and should be copied if
+    they are needed after it.
+    
+    Some arrays are still made for every pair. scipy.fft can not write 
+    into given arrays, so each forward FFT is copied into the spectra and
+    released at once, and each of the 55 inverse FFTs returns a new 
+    padded image, released once its entry is in the matrix. The solver 
+    makes the (N,9) solutions and the positions of the N solved pixels, 
+    about a dozen floats per pixel, and the Cholesky solver its 
+    factorization of each chunk.
+    '''
+    
+    def __init__(self, shape, dtype = np.float64, nwindows = 1):
+        
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        ny, nx = self.shape
+        
+        # The inputs of the matrix, filled by do_dave4vm.
+        self.fields = np.empty((3, ny, nx), dtype = self.dtype)
+        self.derivatives = np.empty((4, ny, nx), dtype = self.dtype)
+        self.work = np.empty((2, ny, nx), dtype = self.dtype)
+        self.bzt = np.empty((ny, nx), dtype = self.dtype)
+        
+        # The products and the matrix, filled by calculate_dave4vm. The 
+        # matrix is always float64.
+        self._products = np.empty((len(dave4vm_matrix.PRODUCTS), ny, nx), 
+                                  dtype = self.dtype)
+        self._bd = np.empty((ny, nx), dtype = self.dtype)
+        self._matrix = np.empty(ny*nx*55)
         
-    except RuntimeWarning:
-        print('Run time warning exception triggered.')
+        # The spectra of the products and the accumulator, whose padded 
+        # shape depends on the window, made by the first pair.
+        self._spectra = np.empty(0, dtype = np.result_type(self.dtype, 
+                                                           np.complex64))
+        self._accumulator = np.empty(0, dtype = np.complex128)
+        
+        # The buffers of the chunks of systems, made by the first solve.
+        self._solve = np.empty(0)
+        
+        # The coefficients of each window size, always float64.
+        self._coefs = np.empty((nwindows, 9, ny, nx))
     
-    #testing if index is non-empty
-    if index[0].size != 0: 
+    def check(self, shape, dtype):
+        '''
+        Raises a ValueError if the workspace was not made for pairs of
+        this shape and dtype.
+        '''
         
-        for i,j in zip(index[0],index[1]):
-            # Taking a chunk of AM at the specified point
-            AA = AM[:,:,i,j]
-            
+        if tuple(shape) != self.shape or np.dtype(dtype) != self.dtype:
+            raise ValueError('The workspace was made for ' + str(self.shape)
+                             + ' ' + self.dtype.name + ' pairs, not ' + 
+                             str(tuple(shape)) + ' ' + np.dtype(dtype).name
+                             + '.')
+    
+    def products(self, shape):
+        '''
+        The buffers of the products and of bd for a tile of the given 
+        shape.
+        '''
+        
+        return(self._products[:,0:shape[0],0:shape[1]], 
+               self._bd[0:shape[0],0:shape[1]])
+    
+    def matrix(self, shape):
+        '''
+        A contiguous (ny,nx,55) buffer for the matrix of a tile of the 
+        given shape.
+        '''
+        
+        return(self._matrix[0:shape[0]*shape[1]*55].reshape(tuple(shape) 
+                                                             + (55,)))
+    
+    def spectra(self, fshape):
+        '''
+        A contiguous buffer for the spectra of the products padded to 
+        fshape. The buffer only grows if a larger padding than before is
+        asked for.
+        '''
+        
+        shape = (len(dave4vm_matrix.PRODUCTS),) + spectrum_shape(fshape)
+        if np.prod(shape) > self._spectra.size:
+            self._spectra = np.empty(np.prod(shape), 
+                                     dtype = self._spectra.dtype)
+        
+        return(self._spectra[0:np.prod(shape)].reshape(shape))
+    
+    def accumulator(self, fshape):
+        '''
+        The complex128 accumulator of FFTConvolver for spectra padded to
+        fshape, growing like the spectra.
+        '''
+        
+        shape = (2,) + spectrum_shape(fshape)
+        if np.prod(shape) > self._accumulator.size:
+            self._accumulator = np.empty(np.prod(shape), 
+                                         dtype = np.complex128)
+        
+        return(self._accumulator[0:np.prod(shape)].reshape(shape))
+    
+    def solve_work(self, chunk_size):
+        '''
+        The work buffer of solve_pixels for chunks of chunk_size pixels,
+        growing like the spectra.
+        '''
+        
+        if SOLVE_WORK*chunk_size > self._solve.size:
+            self._solve = np.empty(SOLVE_WORK*chunk_size)
+        
+        return(self._solve)
+    
+    def coefs(self, nwindows):
+        '''
+        The (nwindows,9,ny,nx) coefficients, zeroed. The buffer only grows
+        if more window sizes than before are asked for.
+        '''
+        
+        if nwindows > self._coefs.shape[0]:
+            self._coefs = np.empty((nwindows,) + self._coefs.shape[1:])
+        
+        coefs = self._coefs[0:nwindows]
+        coefs[...] = 0
+        
+        return(coefs)
+
+
+# Smallest pivot, relative to its diagonal entry, of a system that is
+# solved by the Cholesky factorization. Pixels below it are degenerate.
+PIVOT_RTOL = 1e-12
+
+
+def cholesky_factor(GA, rtol = PIVOT_RTOL):
+    '''
+    Cholesky factorization GA = L L^T of a stack of symmetric matrices,
+    vectorized over the pixels. The pixels are in the last axis, GA being
+    (9,9,n), so that every step works on contiguous rows of n values. 
+    Instead of raising for the whole stack like numpy.linalg.cholesky,
+    the pixels where a pivot is not larger than rtol times its diagonal 
+    entry, i.e. whose matrix is singular, not positive definite or too 
+    ill-conditioned, are flagged.
+    Returns L, the (n,) boolean mask of the flagged pixels and an (n,) 
+    estimate of the condition number of each matrix after scaling it to 
+    a unit diagonal: the inverse of the smallest relative pivot (inf for
+    the flagged pixels).
+    '''
+    
+    m, n = GA.shape[1:]
+    L = np.zeros(GA.shape)
+    bad = np.zeros(n, dtype = bool)
+    smallest = np.ones(n)
+    
+    # Factorizing one column at a time.
+    for j in range(m):
+        pivot = GA[j,j] - np.einsum('kn,kn->n', L[j,0:j], L[j,0:j])
+        
+        # Keeping the smallest pivot relative to the diagonal.
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            smallest = np.fmin(smallest, pivot/np.abs(GA[j,j]))
+        
+        # Flagging the degenerate pixels and giving them a unit pivot so
+        # that the factorization of the others is not disturbed.
+        failed = ~(pivot > rtol*np.abs(GA[j,j]))
+        bad |= failed
+        pivot[failed] = 1.
+        
+        L[j,j] = np.sqrt(pivot)
+        L[j+1:,j] = (GA[j+1:,j] - np.einsum('ikn,kn->in', L[j+1:,0:j],
+                                            L[j,0:j]))/L[j,j]
+    
+    condition = np.full(n, np.inf)
+    condition[~bad] = 1/smallest[~bad]
+    
+    return(L, bad, condition)
+
+
+def cholesky_solve(GA, FA, rtol = PIVOT_RTOL, factor = None):
+    '''
+    Solves the stack of symmetric systems GA x = FA, (9,9,n) and (9,n),
+    with the factorization of cholesky_factor, which can be given as 
+    factor if it was already computed.
+    Returns the (9,n) solutions and the (n,) boolean mask of the flagged
+    pixels, whose solutions are meaningless.
+    '''
+    
+    if factor is None:
+        factor = cholesky_factor(GA, rtol)
+    L, bad, condition = factor
+    m, n = FA.shape
+    
+    # Forward substitution, L y = FA.
+    y = np.zeros((m, n))
+    for j in range(m):
+        y[j] = (FA[j] - np.einsum('kn,kn->n', L[j,0:j], y[0:j]))/L[j,j]
+    
+    # Back substitution, L^T x = y.
+    x = np.zeros((m, n))
+    for j in range(m - 1, -1, -1):
+        x[j] = (y[j] - np.einsum('kn,kn->n', L[j+1:,j], x[j+1:]))/L[j,j]
+    
+    return(x, bad)
+
+
+def solve_pixels(AP, index, chunk_size = 65536, solver = 'lu', 
+                 singular = 'pinv', pixel_major = False, diagnostics = False,
+                 work = None):
+    '''
+    Solves the 9x9 systems of every pixel listed in index at once.
+    AP is the packed (55,ny,nx) matrix made by dave4vm_matrix.packed_matrix
+    and index the tuple returned by np.where. The systems are solved in 
+    chunks of chunk_size pixels to keep the memory bounded: the packed
+    entries of the pixels of a chunk are gathered into a buffer, (n,55) 
+    or (55,n), and expanded into a second one with the full systems, 
+    (n,100) or (100,n), the right hand sides taking a third one. The 
+    systems are solved in float64 whatever the precision of AP. With 
+    pixel_major AP is the (ny,nx,55) layout of 
+    dave4vm_matrix.assemble_matrix, whose entries are gathered as 
+    contiguous rows.
+    
+    work is an optional float64 array of at least SOLVE_WORK*chunk_size
+    values holding these buffers (see Dave4vmWorkspace.solve_work), made
+    for the call otherwise. The solutions, the pixel positions and the 
+    factorization of cholesky_solve are still new arrays.
+    
+    solver is 'lu' for numpy.linalg.solve, which raises if any system is
+    singular, or 'cholesky' for cholesky_solve, which takes advantage of 
+    the matrices being symmetric and flags the degenerate pixels. These 
+    are then solved with the pseudo-inverse if singular is 'pinv' or set
+    to NaN if it is 'nan'.
+    Returns a (N,9) array with the coefficients of each pixel.
+    
+    With diagnostics, a dictionary with the (N,) arrays 'condition', the
+    estimate of cholesky_factor, and 'chi2', the residual of the fit 
+    A[9,9] + A[9,0:9].x, is also returned, computed from the same 
+    gathered systems.
+    '''
+    
+    if solver not in ('lu', 'cholesky'):
+        raise ValueError('Unknown solver ' + str(solver) + 
+                         ", use 'lu' or 'cholesky'.")
+    if singular not in ('pinv', 'nan'):
+        raise ValueError('Unknown singular option ' + str(singular) + 
+                         ", use 'pinv' or 'nan'.")
+    
+    # Number of pixels to be solved.
+    npix = index[0].size
+    
+    # The buffers of the chunks.
+    if work is None:
+        work = np.empty(SOLVE_WORK*min(chunk_size, npix))
+    elif work.size < SOLVE_WORK*min(chunk_size, npix):
+        raise ValueError('The work buffer is too small for chunks of ' + 
+                         str(chunk_size) + ' pixels.')
+    
+    # The shape of the images of the matrix, whose pixels are gathered.
+    ishape = AP.shape[0:2] if pixel_major else AP.shape[1:3]
+    
+    # Creating the arrays to receive the answers.
+    vector = np.zeros((npix,9))
+    if diagnostics:
+        condition = np.zeros(npix)
+        chi2 = np.zeros(npix)
+    
+    for start in range(0, npix, chunk_size):
+        # Taking the pixels of this chunk.
+        rows = index[0][start:start+chunk_size]
+        cols = index[1][start:start+chunk_size]
+        
+        n = rows.size
+        chunk = slice(start, start + n)
+        
+        # Carving the buffers of this chunk out of work, in the layout of
+        # AP: the pixels first with pixel_major, last otherwise.
+        if pixel_major:
+            entries = work[0:55*n].reshape((n,55))
+            systems = work[55*n:155*n].reshape((n,100))
+            axis, flat = 0, (-1,55)
+        else:
+            entries = work[0:55*n].reshape((55,n))
+            systems = work[55*n:155*n].reshape((100,n))
+            axis, flat = 1, (55,-1)
+        rhs = work[155*n:164*n]
+        
+        # Gathering the packed entries of the chunk, always solving in 
+        # float64. np.take writes them into the buffer when AP can be 
+        # seen as a single (pixels,55) or (55,pixels) image.
+        if AP.flags.c_contiguous:
+            np.take(AP.reshape(flat), 
+                    np.ravel_multi_index((rows, cols), ishape), 
+                    axis = axis, out = entries, mode = 'clip')
+        elif pixel_major:
+            entries[...] = AP[rows,cols]
+        else:
+            entries[...] = AP[:,rows,cols]
+        
+        # Expanding them to the full systems, seen as (n,10,10) in both 
+        # layouts.
+        np.take(entries, dave4vm_matrix.PACKED.ravel(), axis = 1 - axis, 
+                out = systems, mode = 'clip')
+        if pixel_major:
+            AA = systems.reshape((n,10,10))
+        else:
+            AA = np.moveaxis(systems.reshape((10,10,n)), -1, 0)
+        
+        if solver == 'lu':
             # Taking the first 9 columns to build ''ax''.
-            GA = AA[0:9,0:9]
+            GA = AA[:,0:9,0:9]
             
-            # Taking the last column to build ''b''.
-            FA = -1*np.reshape(AA[9,0:9],9)
+            # Taking the last row to build ''b'' as a (n,9,1) stack.
+            FA = np.negative(AA[:,9,0:9], out = rhs.reshape((n,9)))
             
-            # Defining a vector to receive the answers.
-            vector = solve(GA,FA)
+            # Solving all the systems of the chunk in a single call.
+            vector[chunk] = solve(GA,FA[:,:,np.newaxis])[:,:,0]
             
-            # Assigning the values to the matrices.
-            U0[i,j] = vector[0]
-            V0[i,j] = vector[1]
-            UX[i,j] = vector[2]
-            VY[i,j] = vector[3]
-            UY[i,j] = vector[4]
-            VX[i,j] = vector[5]
-            W0[i,j] = vector[6]
-            WX[i,j] = vector[7]
-            WY[i,j] = vector[8]
+            # The condition estimate comes from the factorization.
+            if diagnostics:
+                condition[chunk] = cholesky_factor(
+                        np.moveaxis(AA[:,0:9,0:9], 0, -1))[2]
+        
+        else:
+            # Seeing them as (10,10,n).
+            GA = np.moveaxis(AA[:,0:9,0:9], 0, -1)
+            FA = np.negative(AA[:,9,0:9].T, out = rhs.reshape((9,n)))
+            
+            factor = cholesky_factor(GA)
+            x, bad = cholesky_solve(GA, FA, factor = factor)
+            x = x.T
+            
+            # Only the degenerate pixels go through the fallback.
+            if bad.any():
+                if singular == 'pinv':
+                    pinv = np.linalg.pinv(np.moveaxis(GA[:,:,bad], -1, 0))
+                    x[bad] = np.einsum('nij,jn->ni', pinv, FA[:,bad])
+                else:
+                    x[bad] = np.nan
+            
+            vector[chunk] = x
+            if diagnostics:
+                condition[chunk] = factor[2]
+        
+        # The residual of the fit, from the last row of the matrix.
+        if diagnostics:
+            chi2[chunk] = AA[:,9,9] + np.einsum('ni,ni->n', AA[:,9,0:9], 
+                                                vector[chunk])
+    
+    if diagnostics:
+        return(vector, {'condition': condition, 'chi2': chi2})
+    
+    return(vector)
+
+
+# Approximate number of float64 images held at once while building the
+# matrix with each convolution method and of floats per pixel while
+# solving a chunk of systems. Used to split the field to fit max_memory.
+MATRIX_IMAGES = {'fft': 100, 'sat': 200, 'direct': 100}
+SOLVE_FLOATS = 250
+
+# Floats per pixel of the buffers of a chunk of systems in solve_pixels:
+# the packed entries, the full systems and the right hand sides.
+SOLVE_WORK = 55 + 100 + 9
+
+
+def tiles(shape, halo, max_pixels = None, bounds = None):
+    '''
+    Splits a field of the given shape into tiles whose size, including a 
+    halo of halo pixels around them, is at most max_pixels. Strips with 
+    the full width are used when they are tall enough, otherwise square 
+    tiles. Yields, for each tile, the slices of its core and of the core
+    plus the halo (clipped to the field).
+    bounds is an optional tuple of slices with the part of the field to 
+    be covered by the cores, the halos still reaching out of it.
+    '''
+    
+    if bounds is None:
+        bounds = (slice(0, shape[0]), slice(0, shape[1]))
+    ny, nx = shape
+    oy, ox = bounds[0].start, bounds[1].start
+    by, bx = bounds[0].stop - oy, bounds[1].stop - ox
+    
+    # The size of the bounds with their halo, clipped to the field.
+    ry = min(oy + by + halo, ny) - max(oy - halo, 0)
+    rx = min(ox + bx + halo, nx) - max(ox - halo, 0)
+    
+    # Checking if the whole field fits at once.
+    if max_pixels is None or ry*rx <= max_pixels:
+        tile = (by, bx)
+    
+    # Trying strips with the full width.
+    elif max_pixels//rx - 2*halo >= max(halo, 1):
+        tile = (max_pixels//rx - 2*halo, bx)
+    
+    # Using square tiles otherwise.
+    else:
+        side = int(np.sqrt(max_pixels)) - 2*halo
+        if side < 1:
+            raise ValueError('max_memory is too small to hold a tile with '
+                             'the window halo.')
+        tile = (side, side)
+    
+    for y0 in range(oy, oy + by, tile[0]):
+        for x0 in range(ox, ox + bx, tile[1]):
+            y1 = min(y0 + tile[0], oy + by)
+            x1 = min(x0 + tile[1], ox + bx)
+            
+            core = (slice(y0, y1), slice(x0, x1))
+            region = (slice(max(y0 - halo, 0), min(y1 + halo, ny)),
+                      slice(max(x0 - halo, 0), min(x1 + halo, nx)))
+            
+            yield(core, region)
+
+
+def region_of_interest(mask, dilation):
+    '''
+    Dilates the boolean mask by dilation pixels with a square window, 
+    like the DAVE4VM one, returning the dilated mask and the slices of 
+    its bounding box (None if the mask is empty).
+    '''
+    
+    roi = maximum_filter(np.asarray(mask, dtype = np.uint8), 
+                         size = 2*dilation + 1, mode = 'constant') > 0
+    
+    # Finding the rows and columns touched by the mask.
+    rows = np.flatnonzero(roi.any(axis = 1))
+    cols = np.flatnonzero(roi.any(axis = 0))
+    if rows.size == 0:
+        return(roi, None)
+    
+    bounds = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    
+    return(roi, bounds)
+
+
+def calculate_dave4vm_multi(magvm,wsizes,chunk_size = 65536,method = 'fft',
+                            max_memory = None,solver = 'lu',
+                            singular = 'pinv',dtype = np.float64,
+                            mask = None,dilation = None,workspace = None,
+                            diagnostics = False):
+    '''
+    Runs DAVE4VM with several window sizes on the same pair of
+    observations, returning a list with the velocity dictionary of each
+    window size in wsizes.
+    
+    Only the kernels depend on the window size, so the products of the 
+    matrix are computed once and, with the FFT method, also transformed
+    once, with the padding of the largest window. Each window size then
+    only swaps the kernel spectra, assembles the matrix and solves it.
+    The other options are the same as in calculate_dave4vm, the tiles 
+    having the halo of the largest window.
+    '''
+    
+    # Copying the dictionary to a variable    
+    mag_dic = copy.copy(magvm)
+    
+    #Defining arrays taking the shape of bz to later create arrays with the same shape.
+    sz = mag_dic['bz'].shape
+    
+    # Creating the arrays to receive the data of each window size.
+    if workspace is None:
+        coefs = np.zeros((len(wsizes),9,sz[0],sz[1]))
+    else:
+        workspace.check(sz, dtype)
+        coefs = workspace.coefs(len(wsizes))
+        
+    # Taking the kernels from the cache.
+    kernels = [cached_kernel(wsize, mag_dic['dx'], mag_dic['dy']) 
+               for wsize in wsizes]
+    halo = max((kernel['psf'].shape[0] - 1)//2 for kernel in kernels)
+    largest = int(np.argmax([kernel['psf'].shape[0] for kernel in kernels]))
+    
+    # Working out the size of the tiles and of the chunks of systems. With
+    # 'auto' the tiles are sized for the backend needing the most memory,
+    # since the backend is picked for the shape of the tiles.
+    max_pixels = None
+    if max_memory is not None:
+        itemsize = np.dtype(dtype).itemsize
+        images = max(MATRIX_IMAGES.values()) if method == 'auto' else \
+                 MATRIX_IMAGES[method]
+        max_pixels = int(max_memory/(itemsize*images))
+        chunk_size = max(1, min(chunk_size, int(max_memory/(8*SOLVE_FLOATS))))
+    
+    # The buffers of the solver, kept by the workspace.
+    solve_work = None
+    if workspace is not None:
+        solve_work = workspace.solve_work(min(chunk_size, sz[0]*sz[1]))
+    
+    # Counting the solved pixels of each window size.
+    solved = np.zeros(len(wsizes), dtype = int)
+    
+    # The quality of the fit of each pixel, NaN where it was not solved.
+    if diagnostics:
+        condition = np.full((len(wsizes),sz[0],sz[1]), np.nan)
+        chi2 = np.full((len(wsizes),sz[0],sz[1]), np.nan)
+        good = np.zeros((len(wsizes),sz[0],sz[1]), dtype = bool)
+    
+    # Restricting the work to the bounding box of the dilated mask.
+    roi = None
+    pieces = tiles(sz, halo, max_pixels)
+    if mask is not None:
+        roi, bounds = region_of_interest(mask, halo if dilation is None 
+                                               else dilation)
+        pieces = [] if bounds is None else tiles(sz, halo, max_pixels, 
+                                                 bounds)
+    pieces = list(pieces)
+    
+    # Picking the fastest convolution backend, if asked to, for the shape
+    # of the first tile with its halo, for which the engines are built.
+    if pieces:
+        method = tuning.resolve_method(method, kernels[largest], 
+                                       tuple(r.stop - r.start 
+                                             for r in pieces[0][1]), 
+                                       kernels[largest]['psf'].shape[0], 
+                                       dtype)
+    
+    for core, region in pieces:
+        # Taking the fields within the tile and its halo.
+        tile = {key: np.asarray(mag_dic[key][region], dtype = dtype) 
+                for key in ('bx','by','bz','bxx','byy','bzx','bzy','bzt')}
+        shape = tile['bz'].shape
+        
+        # Computing the products of the matrix only once.
+        if workspace is None:
+            products = dave4vm_matrix.matrix_products(tile)
+        else:
+            out, work = workspace.products(shape)
+            products = dave4vm_matrix.matrix_products(tile, out = out, 
+                                                      work = work)
+        
+        # With the FFT the products are also transformed only once, with 
+        # the padding needed by the largest window.
+        if method == 'fft':
+            fshape = padded_shape(shape, kernels[largest]['psf'].shape)
+            spectra = kernel_spectra(wsizes[largest], mag_dic['dx'], 
+                                     mag_dic['dy'], fshape)
+            accumulator = None
+            if workspace is not None:
+                accumulator = workspace.accumulator(fshape)
+            engine = FFTConvolver(kernels[largest], shape, fshape = fshape, 
+                                  dtype = dtype, spectra = spectra,
+                                  accumulator = accumulator)
+            
+            # Copying the spectra into the workspace, one at a time.
+            if workspace is None:
+                handles = [engine.forward(product) for product in products]
+            else:
+                handles = workspace.spectra(fshape)
+                for n, product in enumerate(products):
+                    handles[n] = engine.forward(product)
             
-        # Organizing the variables in a dictionary.
+            # Releasing the product images, only the spectra are used.
+            del products
+        
+        # The part of the tile without the halo.
+        inner = tuple(slice(c.start - r.start, c.stop - r.start) 
+                      for c, r in zip(core, region))
+        
+        # The matrix of the core of the tile, shared by the window sizes
+        # and written pixel by pixel, ready for the solver.
+        cshape = tuple(c.stop - c.start for c in core)
+        if workspace is None:
+            AM = np.empty(cshape + (55,))
+        else:
+            AM = workspace.matrix(cshape)
+        
+        for n, kernel in enumerate(kernels):
+            # Swapping the kernel.
+            if method == 'fft':
+                spectra = kernel_spectra(wsizes[n], mag_dic['dx'], 
+                                         mag_dic['dy'], fshape)
+                engine = FFTConvolver(kernel, shape, fshape = fshape,
+                                      dtype = dtype, spectra = spectra,
+                                      accumulator = engine.accumulator)
+            else:
+                engine = make_engine(method, kernel, shape, dtype = dtype)
+                handles = [engine.forward(product) for product in products]
+            
+            # Calling the function that computes the matrix that spams the 
+            # results. Only the minimal set of convolutions is evaluated 
+            # (see dave4vm_matrix.fusion_plan) and, being the matrix 
+            # symmetric, only its upper triangle is stored, keeping only
+            # the core of the tile.
+            dave4vm_matrix.assemble_matrix(handles, engine, 
+                                           pixel_major = True, 
+                                           crop = inner, out = AM)
+        
+            # Computing the trace by summing the diagonal entries.
+            trc = AM[:,:,dave4vm_matrix.DIAGONAL].sum(axis = -1)
+            
+            # Indexing points where the trace is bigger than 1, within the
+            # region of interest if there is one.
+            valid = trc > 1
+            if roi is not None:
+                valid &= roi[core]
+            try:
+                index = np.where(valid)
+                
+            except RuntimeWarning:
+                print('Run time warning exception triggered.')
+            
+            #testing if index is non-empty
+            if index[0].size != 0: 
+                
+                # Solving the systems of all the valid pixels at once.
+                vector = solve_pixels(AM, index, chunk_size = chunk_size,
+                                      solver = solver, singular = singular,
+                                      pixel_major = True, 
+                                      diagnostics = diagnostics,
+                                      work = solve_work)
+                
+                # Keeping the quality of the fit of each pixel, which is 
+                # valid if its system was well conditioned and solved.
+                if diagnostics:
+                    vector, quality = vector
+                    condition[(n,) + core][index] = quality['condition']
+                    chi2[(n,) + core][index] = quality['chi2']
+                    good[(n,) + core][index] = (
+                        np.isfinite(vector).all(axis = 1) & 
+                        (quality['condition']*PIVOT_RTOL < 1))
+                
+                # Assigning the values to the matrices.
+                coefs[(n,slice(None)) + core][:,index[0],index[1]] = vector.T
+                solved[n] += index[0].size
+    
+    # Flagging the pixels out of the region of interest.
+    if roi is not None:
+        coefs[:,:,~roi] = np.nan
+    
+    # Organizing the variables of each window size in a dictionary.
+    results = [velocity_dict(coefs[n], solved[n]) for n in range(len(wsizes))]
+    
+    # Adding the diagnostics even if no pixel was solved.
+    if diagnostics:
+        for n, vel4vm in enumerate(results):
+            vel4vm.update({'condition': condition[n], 'chi2': chi2[n],
+                           'valid': good[n]})
+    
+    return(results)
+
+
+def velocity_dict(coefs, solved):
+    '''
+    Organizes the (9,ny,nx) coefficients in the vel4vm dictionary, with 
+    None for every variable if no pixel was solved.
+    '''
+    
+    U0, V0, UX, VY, UY, VX, W0, WX, WY = coefs
+    
+    #testing if any pixel was solved
+    if solved != 0:
         # Solved refers to the apperture problem being solved.
         vel4vm = {'U0': U0, 'UX': UX, 'UY': UY,
                   'V0': V0, 'VX': VX, 'VY': VY,
                   'W0': W0, 'WX': WX, 'WY': WY,
                   'solved': True}
             
-    if index[0].size == 0:
+    else:
         # If the equation can not be solved return None for each variable.
         vel4vm = {'U0': None, 'UX': None, 'UY': None,
                   'V0': None, 'VX': None, 'VY': None,
@@ -129,6 +789,165 @@ def calculate_dave4vm(magvm,wsize):
                   'solved': False}
     
     return(vel4vm)
+
+
+def calculate_dave4vm_batch(magvm_list,wsize,chunk_size = 65536,
+                            max_memory = None,solver = 'lu',
+                            singular = 'pinv',dtype = np.float64):
+    '''
+    Runs DAVE4VM on a list of pairs of the same shape and pixel scale,
+    e.g. consecutive pairs of a HARP series, returning the list of their
+    velocity dictionaries.
     
+    The pairs are processed in batches of K: each product of the matrix
+    is stacked over the pairs, (K,ny,nx), and transformed with a single
+    FFT over the last two axes, every entry of the matrix is assembled 
+    for the K pairs at once and their systems are solved together. K is
+    the number of pairs that fit max_memory (all of them if it is None).
+    If not even one pair fits, each pair is run by calculate_dave4vm 
+    with its own tiling. The other options are the same as in 
+    calculate_dave4vm; the FFT method is always used.
+    '''
     
+    if len(magvm_list) == 0:
+        return([])
+    
+    # Checking that all pairs can share the same engine.
+    first = magvm_list[0]
+    sz = first['bz'].shape
+    for magvm in magvm_list:
+        if magvm['bz'].shape != sz or (magvm['dx'], magvm['dy']) != \
+           (first['dx'], first['dy']):
+            raise ValueError('All the pairs of a batch must have the same '
+                             'shape and pixel size.')
+    
+    # Working out the number of pairs of each batch.
+    batch = len(magvm_list)
+    if max_memory is not None:
+        itemsize = np.dtype(dtype).itemsize
+        batch = int(max_memory/(itemsize*MATRIX_IMAGES['fft']*sz[0]*sz[1]))
+        chunk_size = max(1, min(chunk_size, int(max_memory/(8*SOLVE_FLOATS))))
+        
+        if batch < 1:
+            return([calculate_dave4vm(magvm, wsize, chunk_size = chunk_size,
+                                      max_memory = max_memory, 
+                                      solver = solver, singular = singular,
+                                      dtype = dtype) 
+                    for magvm in magvm_list])
+    
+    # Building the engine, shared by all the pairs.
+    kernel = cached_kernel(wsize, first['dx'], first['dy'])
+    fshape = padded_shape(sz, kernel['psf'].shape)
+    spectra = kernel_spectra(wsize, first['dx'], first['dy'], fshape)
+    engine = FFTConvolver(kernel, sz, fshape = fshape, dtype = dtype, 
+                          spectra = spectra)
+    
+    results = []
+    for start in range(0, len(magvm_list), batch):
+        group = magvm_list[start:start+batch]
+        K = len(group)
+        
+        # Stacking the fields of the pairs.
+        stack = {key: np.stack([np.asarray(magvm[key], dtype = dtype) 
+                                for magvm in group])
+                 for key in ('bx','by','bz','bxx','byy','bzx','bzy','bzt')}
+        
+        # Transforming each stack of products in a single call.
+        handles = [engine.forward(product) 
+                   for product in dave4vm_matrix.matrix_products(stack)]
+        del stack
+        
+        # Assembling the (K,ny,nx,55) matrix of all the pairs.
+        AM = dave4vm_matrix.assemble_matrix(handles, engine, 
+                                            pixel_major = True)
+        del handles
+        
+        # Seeing the pairs as rows of a single (K*ny,nx) field, so that
+        # their systems are solved together.
+        AM = AM.reshape((K*sz[0], sz[1], 55))
+        trc = AM[:,:,dave4vm_matrix.DIAGONAL].sum(axis = -1)
+        index = np.where(trc > 1)
+        
+        coefs = np.zeros((9, K*sz[0], sz[1]))
+        if index[0].size != 0:
+            vector = solve_pixels(AM, index, chunk_size = chunk_size,
+                                  solver = solver, singular = singular,
+                                  pixel_major = True)
+            coefs[:,index[0],index[1]] = vector.T
+        
+        # Splitting the pairs back.
+        coefs = coefs.reshape((9, K) + sz)
+        solved = np.bincount(index[0]//sz[0], minlength = K)
+        for k in range(K):
+            results.append(velocity_dict(coefs[:,k], solved[k]))
+    
+    return(results)
 
+
+#the actual thing
+def calculate_dave4vm(magvm,wsize,chunk_size = 65536,method = 'fft',
+                      max_memory = None,solver = 'lu',singular = 'pinv',
+                      dtype = np.float64,mask = None,dilation = None,
+                      workspace = None,diagnostics = False):
+    '''
+    This is the main body of DAVE4VM. Here the kernel is built,
+    the convolutions performed and the system solutions are calculated
+    returning the dictionary with the values.
+    
+    chunk_size is the number of pixels solved together in each call to
+    numpy.linalg.solve. It only bounds the memory used by the stacked
+    systems and does not change the results.
+    
+    method chooses how the convolutions are done: 'fft', 'sat' for the
+    summed-area tables, whose cost does not grow with the window size, 
+    or 'direct' (see convolution.py). With 'auto' the fastest one for the
+    shape, window size and dtype is timed once and kept in a tuning 
+    table (see tuning.py).
+    
+    max_memory is a budget, in bytes, for the matrix and the solution of
+    the systems. When given, the field is split into tiles with a halo as
+    wide as the window radius, so the convolutions of the core of each 
+    tile see the same data as in the whole field, and the tiles are
+    solved one at a time. The derivatives in magvm were already computed
+    on the whole field, so the results do not depend on the tiling.
+    
+    solver and singular choose how the systems are solved (see 
+    solve_pixels). With solver = 'cholesky' a few degenerate pixels no 
+    longer raise, they are solved with the pseudo-inverse or set to NaN.
+    
+    dtype is the precision of the products and of their forward FFTs.
+    With np.float32 they take half the memory and the FFTs are faster,
+    while the convolutions are accumulated in float64 (see 
+    convolution.py), the matrix is float64 and the systems are solved in
+    float64.
+    
+    mask is an optional boolean region of interest, e.g. from the HARP
+    bitmap (see do_dave4vm.roi_mask). It is dilated by dilation pixels,
+    the window radius by default, and only the pixels of the dilated 
+    mask are solved, the others being NaN. The matrix is only assembled
+    over the bounding box of the dilated mask plus the window halo, so 
+    the work shrinks with the filling factor of the active region.
+    
+    workspace is an optional Dave4vmWorkspace whose buffers are used 
+    instead of new arrays.
+    
+    With diagnostics the dictionary also has, for every pixel, the 
+    'condition' estimate of its system and the 'chi2' residual of the 
+    fit (see solve_pixels), NaN where it was not solved, and 'valid', 
+    True where the system was solved, is well conditioned and gave 
+    finite coefficients.
+    
+    The work is done by calculate_dave4vm_multi with a single window size.
+    '''
+    
+    vel4vm = calculate_dave4vm_multi(magvm, [wsize], chunk_size = chunk_size,
+                                     method = method, 
+                                     max_memory = max_memory,
+                                     solver = solver, 
+                                     singular = singular, 
+                                     dtype = dtype, mask = mask,
+                                     dilation = dilation,
+                                     workspace = workspace,
+                                     diagnostics = diagnostics)[0]
+    
+    return(vel4vm)
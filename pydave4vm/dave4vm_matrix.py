@@ -12,161 +12,183 @@ https://www.pythoncentral.io/introduction-to-sqlite-in-python/
 ###importing packages###
 
 import numpy as np
-from scipy import signal
+from pydave4vm.convolution import make_engine
 
 def the_matrix(bx, bxx, bxy, by, byx, byy, bz, bzx, bzy,
-               bzt, psf, psfx, psfy, psfxx, psfyy, psfxy):
+               bzt, psf, psfx, psfy, psfxx, psfyy, psfxy, engine = None,
+               method = 'fft'):
     '''
     This function will be used to perform the convolutions and construct
     the matrix from which the solutions will be calculated.
+    
+    The convolutions are done by a convolution engine (see convolution.py)
+    that transforms each kernel and each product image only once. One can
+    be given through engine, otherwise it is built from the kernels with
+    the convolution method: 'fft', 'sat', 'direct' or 'auto' to use the
+    fastest one (see tuning.py). With the FFT engine, the products that 
+    are convolved with several kernels are kept as spectra.
     '''
     
+    # Building the convolution engine if none was given.
+    if engine is None:
+        kernel = {'psf': psf, 'psfx': psfx, 'psfy': psfy, 'psfxx': psfxx,
+                  'psfyy': psfyy, 'psfxy': psfxy}
+        
+        # Picking the fastest backend for the size of the window. tuning
+        # imports this module, so it is only imported here.
+        if method == 'auto':
+            from pydave4vm import tuning
+            method = tuning.resolve_method(method, kernel, bz.shape, 
+                                           psf.shape[0], bz.dtype)
+        
+        engine = make_engine(method, kernel, bz.shape)
+    
     #Constructing the matrix for the LKA algorithm
-    G = signal.convolve(np.multiply(bz,bz),psf, mode='same', method='fft') #1        
-    GGx = np.multiply(bz,bzx)
-    Gx = signal.convolve(GGx,psf, mode='same', method='fft') #2
-    xGx = signal.convolve(GGx,psfx, mode='same', method='fft') #3
-    yGx = signal.convolve(GGx,psfy, mode='same', method='fft') #4
-    GGy = np.multiply(bz,bzy)
-    Gy = signal.convolve(GGy,psf, mode='same', method='fft') #5
-    xGy = signal.convolve(GGy,psfx, mode='same', method='fft') #6
-    yGy = signal.convolve(GGy,psfy, mode='same', method='fft') #7
-    Ht = signal.convolve(np.multiply(bzt,bz),psf, mode='same', method='fft') #8
-    GGxx = np.multiply(bzx,bzx)
-    Gxx = signal.convolve(GGxx,psf, mode='same', method='fft') #9
-    GGyy = np.multiply(bzy,bzy)
-    Gyy = signal.convolve(GGyy,psf, mode='same', method='fft') #10
-    GGxy = np.multiply(bzx,bzy)
-    Gxy = signal.convolve(GGxy,psf, mode='same', method='fft') #11
-    GGtx = np.multiply(bzt,bzx)
-    Gtx = signal.convolve(GGtx,psf, mode='same', method='fft') #12 
-    GGty = np.multiply(bzt,bzy)
-    Gty = signal.convolve(GGty, psf, mode='same', method='fft') #13
-    xGxx = signal.convolve(GGxx,psfx, mode='same', method='fft') #14
-    xGyy = signal.convolve(GGyy,psfx, mode='same', method='fft') #15
-    xGxy = signal.convolve(GGxy,psfx, mode='same', method='fft') #16
-    xGtx = signal.convolve(GGtx,psfx, mode='same', method='fft') #17
-    xGty = signal.convolve(GGty,psfx, mode='same', method='fft') #18
-    yGxx = signal.convolve(GGxx,psfy, mode='same', method='fft') #19
-    yGyy = signal.convolve(GGyy,psfy, mode='same', method='fft') #20
-    yGxy = signal.convolve(GGxy,psfy, mode='same', method='fft') #21
-    yGtx = signal.convolve(GGtx,psfy, mode='same', method='fft') #22
-    yGty = signal.convolve(GGty,psfy, mode='same', method='fft') #23
-    xxGxx = signal.convolve(GGxx,psfxx, mode='same', method='fft') #24
-    xxGxy = signal.convolve(GGxy,psfxx, mode='same', method='fft') #25
-    xxGyy = signal.convolve(GGyy,psfxx, mode='same', method='fft') #26  
-    xyGxx = signal.convolve(GGxx,psfxy, mode='same', method='fft') #27
-    xyGxy = signal.convolve(GGxy,psfxy, mode='same', method='fft') #28
-    xyGyy = signal.convolve(GGyy,psfxy, mode='same', method='fft') #29
-    yyGxx = signal.convolve(GGxx,psfyy, mode='same', method='fft') #30
-    yyGxy = signal.convolve(GGxy,psfyy, mode='same', method='fft') #31
-    yyGyy = signal.convolve(GGyy,psfyy, mode='same', method='fft') #32
-    Gtt = signal.convolve(np.multiply(bzt,bzt),psf, mode='same', method='fft') #33
+    G = engine.convolve(engine.forward(np.multiply(bz,bz)), 'psf') #1        
+    GGx = engine.forward(np.multiply(bz,bzx))
+    Gx = engine.convolve(GGx, 'psf') #2
+    xGx = engine.convolve(GGx, 'psfx') #3
+    yGx = engine.convolve(GGx, 'psfy') #4
+    GGy = engine.forward(np.multiply(bz,bzy))
+    Gy = engine.convolve(GGy, 'psf') #5
+    xGy = engine.convolve(GGy, 'psfx') #6
+    yGy = engine.convolve(GGy, 'psfy') #7
+    Ht = engine.convolve(engine.forward(np.multiply(bzt,bz)), 'psf') #8
+    GGxx = engine.forward(np.multiply(bzx,bzx))
+    Gxx = engine.convolve(GGxx, 'psf') #9
+    GGyy = engine.forward(np.multiply(bzy,bzy))
+    Gyy = engine.convolve(GGyy, 'psf') #10
+    GGxy = engine.forward(np.multiply(bzx,bzy))
+    Gxy = engine.convolve(GGxy, 'psf') #11
+    GGtx = engine.forward(np.multiply(bzt,bzx))
+    Gtx = engine.convolve(GGtx, 'psf') #12 
+    GGty = engine.forward(np.multiply(bzt,bzy))
+    Gty = engine.convolve(GGty, 'psf') #13
+    xGxx = engine.convolve(GGxx, 'psfx') #14
+    xGyy = engine.convolve(GGyy, 'psfx') #15
+    xGxy = engine.convolve(GGxy, 'psfx') #16
+    xGtx = engine.convolve(GGtx, 'psfx') #17
+    xGty = engine.convolve(GGty, 'psfx') #18
+    yGxx = engine.convolve(GGxx, 'psfy') #19
+    yGyy = engine.convolve(GGyy, 'psfy') #20
+    yGxy = engine.convolve(GGxy, 'psfy') #21
+    yGtx = engine.convolve(GGtx, 'psfy') #22
+    yGty = engine.convolve(GGty, 'psfy') #23
+    xxGxx = engine.convolve(GGxx, 'psfxx') #24
+    xxGxy = engine.convolve(GGxy, 'psfxx') #25
+    xxGyy = engine.convolve(GGyy, 'psfxx') #26  
+    xyGxx = engine.convolve(GGxx, 'psfxy') #27
+    xyGxy = engine.convolve(GGxy, 'psfxy') #28
+    xyGyy = engine.convolve(GGyy, 'psfxy') #29
+    yyGxx = engine.convolve(GGxx, 'psfyy') #30
+    yyGxy = engine.convolve(GGxy, 'psfyy') #31
+    yyGyy = engine.convolve(GGyy, 'psfyy') #32
+    Gtt = engine.convolve(engine.forward(np.multiply(bzt,bzt)), 'psf') #33
     ###end-dave###
-    BxBx = signal.convolve(np.multiply(bx,bx),psf, mode='same', method='fft')
-    ByBy = signal.convolve(np.multiply(by,by),psf, mode='same', method='fft')
-    BxBy = signal.convolve(np.multiply(bx,by),psf, mode='same', method='fft')
-    BzBx = signal.convolve(np.multiply(bz,bx),psf, mode='same', method='fft')
-    BzBy = signal.convolve(np.multiply(bz,by),psf, mode='same', method='fft')
-    mbxbxx = np.multiply(bx,bxx)
-    BxBxx = signal.convolve(mbxbxx,psf, mode='same', method='fft')
-    mbxbyy = np.multiply(bx,byy)
-    BxByy = signal.convolve(mbxbyy,psf, mode='same', method='fft')
-    mbxxbxx = np.multiply(bxx,bxx)
-    BxxBxx = signal.convolve(mbxxbxx,psf, mode='same', method='fft')
-    mbyybyy = np.multiply(byy,byy)
-    ByyByy = signal.convolve(mbyybyy,psf, mode='same', method='fft')
-    mbxxbyy = np.multiply(bxx,byy)
-    BxxByy = signal.convolve(mbxxbyy,psf, mode='same', method='fft')
-    mbybxx = np.multiply(by,bxx)
-    ByBxx = signal.convolve(mbybxx,psf, mode='same', method='fft')
-    mbybyy = np.multiply(by,byy)
-    ByByy = signal.convolve(mbybyy,psf, mode='same', method='fft')
-    mbzbxx = np.multiply(bz,bxx)
-    BzBxx = signal.convolve(mbzbxx,psf, mode='same', method='fft')
-    mbzbyy = np.multiply(bz,byy)
-    BzByy = signal.convolve(mbzbyy,psf, mode='same', method='fft')
-    mbztbxx = np.multiply(bzt,bxx)
-    BztBxx = signal.convolve(mbztbxx,psf, mode='same', method='fft')
-    mbztbyy = np.multiply(bzt,byy)
-    BztByy = signal.convolve(mbztbyy,psf, mode='same', method='fft')
-    mbzxbx = np.multiply(bzx,bx)
-    BzxBx = signal.convolve(mbzxbx,psf, mode='same', method='fft')
-    mbzxby = np.multiply(bzx,by)
-    BzxBy = signal.convolve(mbzxby,psf, mode='same', method='fft')
-    mbzxbxx = np.multiply(bzx,bxx)
-    BzxBxx = signal.convolve(mbzxbxx,psf, mode='same', method='fft')
-    mbzxbyy = np.multiply(bzx,byy)
-    BzxByy = signal.convolve(mbzxbyy,psf, mode='same', method='fft')
-    mbzybx = np.multiply(bzy,bx)
-    BzyBx = signal.convolve(mbzybx,psf, mode='same', method='fft')
-    mbzyby = np.multiply(bzy,by)
-    BzyBy = signal.convolve(mbzyby,psf, mode='same', method='fft')
-    mbzybxx = np.multiply(bzy,bxx)
-    BzyBxx = signal.convolve(mbzybxx,psf, mode='same', method='fft')
-    mbzybyy = np.multiply(bzy,byy)
-    BzyByy = signal.convolve(mbzybyy,psf, mode='same', method='fft')
-    BztBx = signal.convolve(np.multiply(bzt,bx),psf, mode='same', method='fft')
-    BztBy = signal.convolve(np.multiply(bzt,by),psf, mode='same', method='fft')   
-    xBzxBx = signal.convolve(mbzxbx,psfx, mode='same', method='fft')
-    xBzxBy = signal.convolve(mbzxby,psfx, mode='same', method='fft')
-    xBzyBx = signal.convolve(mbzybx,psfx, mode='same', method='fft')
-    xBzyBy = signal.convolve(mbzyby,psfx, mode='same', method='fft')
-    yBzyBx = signal.convolve(mbzybx,psfy, mode='same', method='fft')
-    yBzyBy = signal.convolve(mbzyby,psfy, mode='same', method='fft')
-    yBzxBx = signal.convolve(mbzxbx,psfy, mode='same', method='fft')
-    yBzxBy = signal.convolve(mbzxby,psfy, mode='same', method='fft')
-    yBxBxx = signal.convolve(mbxbxx,psfy, mode='same', method='fft')
-    yBxByy = signal.convolve(mbxbyy,psfy, mode='same', method='fft')
-    yByBxx = signal.convolve(mbybxx,psfy, mode='same', method='fft')
-    yByByy = signal.convolve(mbybyy,psfy, mode='same', method='fft')
-    xByBxx = signal.convolve(mbybxx,psfx, mode='same', method='fft')
-    xByByy = signal.convolve(mbybyy,psfx, mode='same', method='fft')
-    xBzxBxx = signal.convolve(mbzxbxx,psfx, mode='same', method='fft')
-    xBzxByy = signal.convolve(mbzxbyy,psfx, mode='same', method='fft')
-    yBzxBxx = signal.convolve(mbzxbxx,psfy, mode='same', method='fft')
-    yBzxByy = signal.convolve(mbzxbyy,psfy, mode='same', method='fft')
-    xBxxBxx = signal.convolve(mbxxbxx,psfx, mode='same', method='fft')
-    xBxxByy = signal.convolve(mbxxbyy,psfx, mode='same', method='fft')
-    xByyByy = signal.convolve(mbyybyy,psfx, mode='same', method='fft')
-    yBxxBxx = signal.convolve(mbxxbxx,psfy, mode='same', method='fft')
-    yBxxByy = signal.convolve(mbxxbyy,psfy, mode='same', method='fft')
-    yByyByy = signal.convolve(mbyybyy,psfy, mode='same', method='fft')
-    xBxBxx = signal.convolve(mbxbxx,psfx, mode='same', method='fft')
-    xBxByy = signal.convolve(mbxbyy,psfx, mode='same', method='fft')
-    xBzBxx = signal.convolve(mbzbxx,psfx, mode='same', method='fft')
-    xBzByy = signal.convolve(mbzbyy,psfx, mode='same', method='fft')
-    xBztBxx = signal.convolve(mbztbxx,psfx, mode='same', method='fft')
-    xBztByy = signal.convolve(mbztbyy,psfx, mode='same', method='fft')
-    yBztBxx = signal.convolve(mbztbxx,psfy, mode='same', method='fft')
-    yBztByy = signal.convolve(mbztbyy,psfy, mode='same', method='fft')
-    xyBxxBxx = signal.convolve(mbxxbxx,psfxy, mode='same', method='fft')
-    xyBxxByy = signal.convolve(mbxxbyy,psfxy, mode='same', method='fft')
-    xyByyByy = signal.convolve(mbyybyy,psfxy, mode='same', method='fft')
-    xyBzxBxx = signal.convolve(mbzxbxx,psfxy, mode='same', method='fft')
-    xyBzxByy = signal.convolve(mbzxbyy,psfxy, mode='same', method='fft')
-    xyBzyBxx = signal.convolve(mbzybxx,psfxy, mode='same', method='fft')
-    xyBzyByy = signal.convolve(mbzybyy,psfxy, mode='same', method='fft')
-    yBzBxx = signal.convolve(mbzbxx,psfy, mode='same', method='fft')
-    yBzByy = signal.convolve(mbzbyy,psfy, mode='same', method='fft')
-    xBzyBxx = signal.convolve(mbzybxx,psfx, mode='same', method='fft')
-    xBzyByy = signal.convolve(mbzybyy,psfx, mode='same', method='fft')
-    yBzyBxx = signal.convolve(mbzybxx,psfy, mode='same', method='fft')
-    yBzyByy = signal.convolve(mbzybyy,psfy, mode='same', method='fft')
-    xxBxxBxx = signal.convolve(mbxxbxx,psfxx, mode='same', method='fft')
-    xxBxxByy = signal.convolve(mbxxbyy,psfxx, mode='same', method='fft')
-    xxByyByy = signal.convolve(mbyybyy,psfxx, mode='same', method='fft')
-    xxBzxBxx = signal.convolve(mbzxbxx,psfxx, mode='same', method='fft')
-    xxBzyBxx = signal.convolve(mbzybxx,psfxx, mode='same', method='fft')
-    xxBzxByy = signal.convolve(mbzxbyy,psfxx, mode='same', method='fft')
-    xxBzyByy = signal.convolve(mbzybyy,psfxx, mode='same', method='fft')
-    yyBxxBxx = signal.convolve(mbxxbxx,psfyy, mode='same', method='fft')
-    yyBxxByy = signal.convolve(mbxxbyy,psfyy, mode='same', method='fft')
-    yyByyByy = signal.convolve(mbyybyy,psfyy, mode='same', method='fft')
-    yyBzyBxx = signal.convolve(mbzybxx,psfyy, mode='same', method='fft')
-    yyBzyByy = signal.convolve(mbzybyy,psfyy, mode='same', method='fft')
-    yyBzxBxx = signal.convolve(mbzxbxx,psfyy, mode='same', method='fft')
-    yyBzxByy = signal.convolve(mbzxbyy,psfyy, mode='same', method='fft')    
+    BxBx = engine.convolve(engine.forward(np.multiply(bx,bx)), 'psf')
+    ByBy = engine.convolve(engine.forward(np.multiply(by,by)), 'psf')
+    BxBy = engine.convolve(engine.forward(np.multiply(bx,by)), 'psf')
+    BzBx = engine.convolve(engine.forward(np.multiply(bz,bx)), 'psf')
+    BzBy = engine.convolve(engine.forward(np.multiply(bz,by)), 'psf')
+    mbxbxx = engine.forward(np.multiply(bx,bxx))
+    BxBxx = engine.convolve(mbxbxx, 'psf')
+    mbxbyy = engine.forward(np.multiply(bx,byy))
+    BxByy = engine.convolve(mbxbyy, 'psf')
+    mbxxbxx = engine.forward(np.multiply(bxx,bxx))
+    BxxBxx = engine.convolve(mbxxbxx, 'psf')
+    mbyybyy = engine.forward(np.multiply(byy,byy))
+    ByyByy = engine.convolve(mbyybyy, 'psf')
+    mbxxbyy = engine.forward(np.multiply(bxx,byy))
+    BxxByy = engine.convolve(mbxxbyy, 'psf')
+    mbybxx = engine.forward(np.multiply(by,bxx))
+    ByBxx = engine.convolve(mbybxx, 'psf')
+    mbybyy = engine.forward(np.multiply(by,byy))
+    ByByy = engine.convolve(mbybyy, 'psf')
+    mbzbxx = engine.forward(np.multiply(bz,bxx))
+    BzBxx = engine.convolve(mbzbxx, 'psf')
+    mbzbyy = engine.forward(np.multiply(bz,byy))
+    BzByy = engine.convolve(mbzbyy, 'psf')
+    mbztbxx = engine.forward(np.multiply(bzt,bxx))
+    BztBxx = engine.convolve(mbztbxx, 'psf')
+    mbztbyy = engine.forward(np.multiply(bzt,byy))
+    BztByy = engine.convolve(mbztbyy, 'psf')
+    mbzxbx = engine.forward(np.multiply(bzx,bx))
+    BzxBx = engine.convolve(mbzxbx, 'psf')
+    mbzxby = engine.forward(np.multiply(bzx,by))
+    BzxBy = engine.convolve(mbzxby, 'psf')
+    mbzxbxx = engine.forward(np.multiply(bzx,bxx))
+    BzxBxx = engine.convolve(mbzxbxx, 'psf')
+    mbzxbyy = engine.forward(np.multiply(bzx,byy))
+    BzxByy = engine.convolve(mbzxbyy, 'psf')
+    mbzybx = engine.forward(np.multiply(bzy,bx))
+    BzyBx = engine.convolve(mbzybx, 'psf')
+    mbzyby = engine.forward(np.multiply(bzy,by))
+    BzyBy = engine.convolve(mbzyby, 'psf')
+    mbzybxx = engine.forward(np.multiply(bzy,bxx))
+    BzyBxx = engine.convolve(mbzybxx, 'psf')
+    mbzybyy = engine.forward(np.multiply(bzy,byy))
+    BzyByy = engine.convolve(mbzybyy, 'psf')
+    BztBx = engine.convolve(engine.forward(np.multiply(bzt,bx)), 'psf')
+    BztBy = engine.convolve(engine.forward(np.multiply(bzt,by)), 'psf')   
+    xBzxBx = engine.convolve(mbzxbx, 'psfx')
+    xBzxBy = engine.convolve(mbzxby, 'psfx')
+    xBzyBx = engine.convolve(mbzybx, 'psfx')
+    xBzyBy = engine.convolve(mbzyby, 'psfx')
+    yBzyBx = engine.convolve(mbzybx, 'psfy')
+    yBzyBy = engine.convolve(mbzyby, 'psfy')
+    yBzxBx = engine.convolve(mbzxbx, 'psfy')
+    yBzxBy = engine.convolve(mbzxby, 'psfy')
+    yBxBxx = engine.convolve(mbxbxx, 'psfy')
+    yBxByy = engine.convolve(mbxbyy, 'psfy')
+    yByBxx = engine.convolve(mbybxx, 'psfy')
+    yByByy = engine.convolve(mbybyy, 'psfy')
+    xByBxx = engine.convolve(mbybxx, 'psfx')
+    xByByy = engine.convolve(mbybyy, 'psfx')
+    xBzxBxx = engine.convolve(mbzxbxx, 'psfx')
+    xBzxByy = engine.convolve(mbzxbyy, 'psfx')
+    yBzxBxx = engine.convolve(mbzxbxx, 'psfy')
+    yBzxByy = engine.convolve(mbzxbyy, 'psfy')
+    xBxxBxx = engine.convolve(mbxxbxx, 'psfx')
+    xBxxByy = engine.convolve(mbxxbyy, 'psfx')
+    xByyByy = engine.convolve(mbyybyy, 'psfx')
+    yBxxBxx = engine.convolve(mbxxbxx, 'psfy')
+    yBxxByy = engine.convolve(mbxxbyy, 'psfy')
+    yByyByy = engine.convolve(mbyybyy, 'psfy')
+    xBxBxx = engine.convolve(mbxbxx, 'psfx')
+    xBxByy = engine.convolve(mbxbyy, 'psfx')
+    xBzBxx = engine.convolve(mbzbxx, 'psfx')
+    xBzByy = engine.convolve(mbzbyy, 'psfx')
+    xBztBxx = engine.convolve(mbztbxx, 'psfx')
+    xBztByy = engine.convolve(mbztbyy, 'psfx')
+    yBztBxx = engine.convolve(mbztbxx, 'psfy')
+    yBztByy = engine.convolve(mbztbyy, 'psfy')
+    xyBxxBxx = engine.convolve(mbxxbxx, 'psfxy')
+    xyBxxByy = engine.convolve(mbxxbyy, 'psfxy')
+    xyByyByy = engine.convolve(mbyybyy, 'psfxy')
+    xyBzxBxx = engine.convolve(mbzxbxx, 'psfxy')
+    xyBzxByy = engine.convolve(mbzxbyy, 'psfxy')
+    xyBzyBxx = engine.convolve(mbzybxx, 'psfxy')
+    xyBzyByy = engine.convolve(mbzybyy, 'psfxy')
+    yBzBxx = engine.convolve(mbzbxx, 'psfy')
+    yBzByy = engine.convolve(mbzbyy, 'psfy')
+    xBzyBxx = engine.convolve(mbzybxx, 'psfx')
+    xBzyByy = engine.convolve(mbzybyy, 'psfx')
+    yBzyBxx = engine.convolve(mbzybxx, 'psfy')
+    yBzyByy = engine.convolve(mbzybyy, 'psfy')
+    xxBxxBxx = engine.convolve(mbxxbxx, 'psfxx')
+    xxBxxByy = engine.convolve(mbxxbyy, 'psfxx')
+    xxByyByy = engine.convolve(mbyybyy, 'psfxx')
+    xxBzxBxx = engine.convolve(mbzxbxx, 'psfxx')
+    xxBzyBxx = engine.convolve(mbzybxx, 'psfxx')
+    xxBzxByy = engine.convolve(mbzxbyy, 'psfxx')
+    xxBzyByy = engine.convolve(mbzybyy, 'psfxx')
+    yyBxxBxx = engine.convolve(mbxxbxx, 'psfyy')
+    yyBxxByy = engine.convolve(mbxxbyy, 'psfyy')
+    yyByyByy = engine.convolve(mbyybyy, 'psfyy')
+    yyBzyBxx = engine.convolve(mbzybxx, 'psfyy')
+    yyBzyByy = engine.convolve(mbzybyy, 'psfyy')
+    yyBzxBxx = engine.convolve(mbzxbxx, 'psfyy')
+    yyBzxByy = engine.convolve(mbzxbyy, 'psfyy')    
 
     #stacking terms
     A = np.stack((Gxx, Gxy, Gx + xGxx, Gx + yGxy, yGxx, xGxy, -BzxBxx - BzxByy, 
@@ -208,3 +230,183 @@ def the_matrix(bx, bxx, bxy, by, byx, byy, bz, bzx, bzy,
   Gtt), axis = 0)
     
     return(A)
+
+
+# Inside the window, the equation of each pixel has, for every unknown
+# (U0, V0, UX, VY, UY, VX, W0, WX, WY and the time term bzt), a coefficient
+# of the form a + x*b + y*c, where x and y are the positions in the window.
+# The matrix is the windowed sum of the products of these coefficients, so
+# each entry is a sum of convolutions of products of a, b and c with the
+# kernels psf (a*a), psfx (a*b), psfy (a*c), psfxx (b*b), psfyy (c*c) and
+# psfxy (b*c). Each term is written as (sign, field) and 'bd' stands for
+# the divergence bxx + byy.
+REGRESSORS = (((1,'bzx'), None, None),           # U0
+              ((1,'bzy'), None, None),           # V0
+              ((1,'bz'), (1,'bzx'), None),       # UX
+              ((1,'bz'), None, (1,'bzy')),       # VY
+              (None, None, (1,'bzx')),           # UY
+              (None, (1,'bzy'), None),           # VX
+              ((-1,'bd'), None, None),           # W0
+              ((-1,'bx'), (-1,'bd'), None),      # WX
+              ((-1,'by'), None, (-1,'bd')),      # WY
+              ((1,'bzt'), None, None))           # bzt
+
+# Which of a (0), b (1) and c (2) are paired by each kernel.
+KERNEL_MOMENTS = (('psf', 0, 0), ('psfx', 0, 1), ('psfy', 0, 2),
+                  ('psfxx', 1, 1), ('psfyy', 2, 2), ('psfxy', 1, 2))
+
+
+def fusion_plan():
+    '''
+    Works out the minimal set of convolutions needed by the matrix.
+    Since the convolution is linear, the products of the original terms
+    are regrouped: the derivatives only appear through the divergence 
+    bd = bxx + byy, so terms like BzxBxx + BzxByy become a single product,
+    and each distinct product of two fields is computed only once.
+    Returns the list of products, each one a tuple (field, field), and 
+    for each of the 55 entries of the upper triangle a tuple (i, j, terms)
+    with terms being a list of (coefficient, product index, kernel name).
+    '''
+    
+    products = []
+    entries = []
+    
+    for i in range(10):
+        for j in range(i,10):
+            terms = {}
+            
+            for name, u, v in KERNEL_MOMENTS:
+                # Collecting the products of this kernel in the entry.
+                pairs = [(REGRESSORS[i][u], REGRESSORS[j][v])]
+                if u != v:
+                    pairs.append((REGRESSORS[i][v], REGRESSORS[j][u]))
+                
+                for first, second in pairs:
+                    if first is None or second is None:
+                        continue
+                    
+                    # Registering the product if it is a new one.
+                    factors = tuple(sorted((first[1], second[1])))
+                    if factors not in products:
+                        products.append(factors)
+                    
+                    # Summing the terms sharing product and kernel.
+                    key = (products.index(factors), name)
+                    terms[key] = terms.get(key, 0) + first[0]*second[0]
+                    
+            entries.append((i, j, [(coef, index, name) for (index, name), 
+                                   coef in terms.items() if coef != 0]))
+            
+    return(products, entries)
+
+
+PRODUCTS, ENTRIES = fusion_plan()
+
+
+# The matrix is symmetric, so only its upper triangle is stored. The
+# entries are packed row by row, in the order of np.triu_indices(10) and
+# of ENTRIES. PACKED maps each (i,j) of the full matrix to its position 
+# in the packed array and DIAGONAL lists the positions of the diagonal.
+UPPER = np.triu_indices(10)
+PACKED = np.zeros((10,10), dtype = int)
+PACKED[UPPER] = np.arange(55)
+PACKED[UPPER[1],UPPER[0]] = np.arange(55)
+DIAGONAL = PACKED[np.arange(10),np.arange(10)]
+
+
+def matrix_products(magvm, out = None, work = None):
+    '''
+    Returns the list of product images of PRODUCTS, computed from the
+    fields of the dictionary made by do_dave4vm. out is an optional 
+    (28,ny,nx) array where the products are written and work an optional
+    (ny,nx) array for the divergence term bd.
+    '''
+    
+    # The fields used by the products.
+    fields = {name: magvm[name] for name in ('bx','by','bz','bzx',
+                                             'bzy','bzt')}
+    fields['bd'] = np.add(magvm['bxx'], magvm['byy'], out = work)
+    
+    if out is None:
+        return([np.multiply(fields[first], fields[second]) 
+                for first, second in PRODUCTS])
+    
+    return([np.multiply(fields[first], fields[second], out = out[n])
+            for n, (first, second) in enumerate(PRODUCTS)])
+
+
+def assemble_matrix(handles, engine, pixel_major = False, crop = None, 
+                    out = None):
+    '''
+    Fills the packed (55,ny,nx) matrix with each entry from the handles
+    (the spectra, for the FFT engine) of the products.
+    With pixel_major the matrix is written as (ny,nx,55) instead, so that
+    the 55 entries of each pixel are contiguous and solve_pixels gathers
+    them as rows, without transposing them. crop is an optional tuple of slices keeping 
+    only a part of the images and out an optional array to write into.
+    The matrix is float64, like the convolutions of every engine, even 
+    when the products are float32. If the handles are of 
+    stacks of images, (K,ny,nx), the matrix is (55,K,ny,nx) or 
+    (K,ny,nx,55).
+    '''
+    
+    # The part of the images that is kept.
+    if crop is None:
+        crop = (slice(None), slice(None))
+    crop = (Ellipsis,) + tuple(crop)
+    
+    for k, (i, j, terms) in enumerate(ENTRIES):
+        entry = engine.combine([(coef, handles[index], name)
+                                for coef, index, name in terms])[crop]
+        
+        # Creating the matrix from the shape of the first entry.
+        if out is None:
+            out = np.empty(entry.shape + (55,) if pixel_major else 
+                           (55,) + entry.shape, dtype = np.float64)
+        
+        if pixel_major:
+            out[...,k] = entry
+        else:
+            out[k] = entry
+    
+    return(out)
+
+
+def packed_matrix(magvm, kernel, engine = None, method = 'fft'):
+    '''
+    Builds the upper triangle of the DAVE4VM matrix as a (55,ny,nx) array,
+    only evaluating the convolutions found by fusion_plan. Each product
+    is transformed once and every entry is accumulated in the frequency
+    domain, needing a single inverse transform, and written straight into
+    the packed array.
+    magvm is the dictionary made by do_dave4vm and kernel the dictionary
+    with the kernel arrays. If no engine is given one is built with the
+    convolution method ('fft' or 'sat', see convolution.py).
+    '''
+    
+    # Building the convolution engine if none was given.
+    if engine is None:
+        engine = make_engine(method, kernel, magvm['bz'].shape)
+    
+    # Transforming each of the products.
+    handles = [engine.forward(product) for product in matrix_products(magvm)]
+    
+    return(assemble_matrix(handles, engine))
+
+
+def unpack(A):
+    '''
+    Expands a packed (55,...) matrix into the full (100,...) matrix.
+    '''
+    
+    return(A[PACKED.ravel()])
+
+
+def fused_matrix(magvm, kernel, engine = None, method = 'fft'):
+    '''
+    Builds the same (100,ny,nx) matrix as the_matrix from the packed
+    upper triangle made by packed_matrix.
+    '''
+    
+    return(unpack(packed_matrix(magvm, kernel, engine = engine,
+                                method = method)))
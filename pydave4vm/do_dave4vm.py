@@ -13,68 +13,205 @@ from pydave4vm import odiffxy5
 from pydave4vm import dave4vm
 
     
+# The derivatives used by dave4vm, in the order they are stacked. The
+# cross derivatives bxy and byx are not used by the matrix and are not
+# computed.
+DERIVATIVES = ('bxx', 'bzx', 'byy', 'bzy')
+
+
+def stack_derivatives(fields,dx,dy,out=None,work=None):
+    '''
+    Calculates the spatial derivatives used by dave4vm from a (3,ny,nx)
+    stack with bx, by and bz, already divided by the pixel size. They are
+    returned as a (4,ny,nx) stack in the order of DERIVATIVES, written in 
+    out if given. work is the scratch array of odiffxy5.odiff_stack, with
+    shape (2,ny,nx). The derivatives have the precision of fields.
+    '''
+    
+    if out is None:
+        out = np.empty((4,) + fields.shape[1:], dtype = fields.dtype)
+    
+    #Calculating the differentials of bx and bz along x and of by and bz
+    #along y
+    odiffxy5.odiff_stack(fields[0::2], -1, out = out[0:2], work = work)
+    odiffxy5.odiff_stack(fields[1:3], -2, out = out[2:4], work = work)
+    
+    #Dividing by the size of the pixels
+    np.divide(out[0:2], dx, out = out[0:2])
+    np.divide(out[2:4], dy, out = out[2:4])
+    
+    return(out)
+
+
+def frame_derivatives(bx,by,bz,dx,dy,out=None,dtype=np.float64):
+    '''
+    Calculates the spatial derivatives of a single frame (see 
+    stack_derivatives). Since the odiffxy5 stencil is linear, the 
+    derivatives of the average of two frames are the average of the 
+    derivatives of each frame, so these can be computed once per frame 
+    and reused by the two pairs that share it.
+    '''
+    
+    return(stack_derivatives(np.stack((bx,by,bz)).astype(dtype,copy=False),
+                             dx,dy,out=out))
+
+
+# Lowest value of the HARP bitmap segment inside the active region, the 
+# values below it being the quiet surroundings of the patch.
+BITMAP_LEVEL = 30
+
+
+def roi_mask(bitmap=None,bx=None,by=None,bz=None,threshold=None):
+    '''
+    Builds the region of interest used by the mask option of do_dave4vm:
+    the pixels where the HARP bitmap is at least BITMAP_LEVEL and/or 
+    where |B| is above threshold (in G). When both are given the pixels
+    must satisfy both.
+    '''
+    
+    mask = None
+    
+    if bitmap is not None:
+        mask = np.asarray(bitmap) >= BITMAP_LEVEL
+    
+    if threshold is not None:
+        strong = bx*bx + by*by + bz*bz > threshold*threshold
+        mask = strong if mask is None else mask & strong
+    
+    if mask is None:
+        raise ValueError('Either the bitmap or a threshold are needed to '
+                         'build the mask.')
+    
+    return(mask)
+
+
 def do_dave4vm(dt,bx_stop,bx_start,by_stop,by_start,bz_stop,bz_start,
-               dx,dy,wsize):
+               dx,dy,wsize,method='fft',max_memory=None,derivatives=None,
+               out=None,solver='lu',singular='pinv',dtype=np.float64,
+               mask=None,workspace=None,diagnostics=False):
     '''
     Here the variables to execute pydave4vm are going to be
     prepared.
+    The method option selects the convolution backend used by dave4vm,
+    'fft' or 'sat' (see convolution.py). max_memory is the budget in
+    bytes used by dave4vm to split the field into tiles. solver and 
+    singular choose how the systems of each pixel are solved (see 
+    dave4vm.solve_pixels).
+    derivatives is an optional tuple with the frame_derivatives of the
+    start and stop frames. When given, their average is used instead of
+    differentiating the average of the frames. out is an optional 
+    (4,ny,nx) array where the derivatives are written.
+    dtype is the precision of the fields, of the derivatives and of the
+    products transformed by dave4vm. np.float32 halves their memory and 
+    speeds up the forward FFTs, the convolutions being still accumulated
+    and the systems solved in float64.
+    mask is an optional region of interest (see roi_mask); only the 
+    pixels around it are solved, the others being NaN.
+    workspace is an optional dave4vm.Dave4vmWorkspace made for the shape
+    and dtype of the pair, holding all the buffers, so that a series of
+    pairs does not allocate new images. The arrays in magvm and vel4vm 
+    are then overwritten by the next pair using the same workspace.
+    With diagnostics vel4vm also has the 'condition', 'chi2' and 'valid'
+    images of each pixel (see dave4vm.calculate_dave4vm).
     '''
     
-    #taking the average change on bz over the time interval dt
-    bzt = (bz_stop - bz_start)/dt
+    #Taking the buffers from the workspace
+    if workspace is not None:
+        workspace.check(np.shape(bz_stop), dtype)
+        fields, bzt, work = workspace.fields, workspace.bzt, workspace.work
+        if out is None:
+            out = workspace.derivatives
+    else:
+        fields = np.empty((3,) + np.shape(bz_stop), dtype = dtype)
+        bzt = np.empty(np.shape(bz_stop), dtype = dtype)
+        work = None
     
+    #taking the average change on bz over the time interval dt
+    np.subtract(bz_stop, bz_start, out = bzt)
+    np.divide(bzt, dt, out = bzt)
     
-    #Taking the average value of the images
+    #Taking the average value of the images, stacked in a single array
     #Those average values will be entries for the odiffxy5 function
-    bx = (bx_stop + bx_start)/2
-    by = (by_stop + by_start)/2
-    bz = (bz_stop + bz_start)/2
+    for n, (stop, start) in enumerate(((bx_stop, bx_start), 
+                                       (by_stop, by_start),
+                                       (bz_stop, bz_start))):
+        np.add(stop, start, out = fields[n])
+    np.multiply(fields, 0.5, out = fields)
+    bx, by, bz = fields
     
     #Calculating the differentials
-    bxx,bxy = odiffxy5.odiff(bx)
-    byx,byy = odiffxy5.odiff(by)
-    bzx,bzy = odiffxy5.odiff(bz)
+    if derivatives is None:
+        stack = stack_derivatives(fields,dx,dy,out=out,work=work)
+    
+    #Or averaging the ones of each frame
+    else:
+        start, stop = derivatives
+        stack = np.add(start, stop, out = out)
+        np.multiply(stack, 0.5, out = stack)
     
     #Defining the dictionary that will take all the information necessary
     #to the calculation performed by dave4vm
-    magvm = {'bzt': bzt, 'bx': bx, 'bxx': np.divide(bxx,dx), 
-             'bxy': np.divide(bxy,dy), 'by': by, 'byx': np.divide(byx,dx),
-             'byy': np.divide(byy,dy), 'bz': bz, 'bzx': np.divide(bzx,dx), 
-             'bzy': np.divide(bzy,dy), 'dx': dx, 'dy': dy, 'dt': dt}
+    magvm = {'bzt': bzt, 'bx': bx, 'by': by, 'bz': bz, 
+             'dx': dx, 'dy': dy, 'dt': dt}
+    magvm.update(zip(DERIVATIVES, stack))
     
     #Call!
-    vel4vm = dave4vm.calculate_dave4vm(magvm, wsize)
+    vel4vm = dave4vm.calculate_dave4vm(magvm, wsize, method=method,
+                                       max_memory=max_memory, solver=solver,
+                                       singular=singular, dtype=dtype,
+                                       mask=mask, workspace=workspace,
+                                       diagnostics=diagnostics)
     
     return(magvm, vel4vm)
 
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+def stream_dave4vm(frames,dx,dy,wsize,method='fft',max_memory=None,
+                   solver='lu',singular='pinv',dtype=np.float64,
+                   workspace=None):
+    '''
+    Streaming version of do_dave4vm for a time series. frames is an 
+    iterable yielding (t, bx, by, bz) for each frame in time order, t 
+    being a datetime or a time in seconds. For each pair of consecutive
+    frames (magvm, vel4vm) is yielded, like do_dave4vm.
+    
+    The derivatives of each frame are computed only once and kept for the
+    next pair, halving the work of the stencil, and their averages are 
+    written in the same buffers for the whole series. All the other 
+    buffers are also kept in a dave4vm.Dave4vmWorkspace, made for the
+    first frame unless one is given. The arrays in magvm and vel4vm are 
+    therefore overwritten by the next pair and should be copied if they
+    are needed after it.
+    '''
+    
+    previous = None
+    spare = None
+    
+    for t, bx, by, bz in frames:
+        # Differentiating the new frame only, in the buffer of the frame 
+        # that is no longer needed.
+        current = (t, bx, by, bz, frame_derivatives(bx,by,bz,dx,dy,
+                                                    out=spare,dtype=dtype))
+        
+        if previous is not None:
+            t1, bx_start, by_start, bz_start, start = previous
+            
+            # Calculating the time between the frames in seconds.
+            dt = t - t1
+            if hasattr(dt, 'total_seconds'):
+                dt = dt.total_seconds()
+            
+            # Creating the buffers once.
+            if workspace is None:
+                workspace = dave4vm.Dave4vmWorkspace(np.shape(bz), dtype)
+            
+            yield(do_dave4vm(dt,bx,bx_start,by,by_start,bz,bz_start,
+                             dx,dy,wsize,method=method,
+                             max_memory=max_memory,solver=solver,
+                             singular=singular,dtype=dtype,
+                             derivatives=(start, current[4]), 
+                             workspace=workspace))
+            
+            # The derivatives of the start frame can be overwritten now.
+            spare = start
+        
+        previous = current
@@ -56,9 +56,9 @@ import numpy as np
 from datetime import datetime
 import logging
 import fnmatch
-import sunpy
-import sunpy.map
 import json
+import functools
+from concurrent.futures import ProcessPoolExecutor
 
 # Importing system related packages.
 import glob
@@ -67,10 +67,10 @@ import sys
 import os
 
 # Calling the package that will execute PyDAVE4VM.
-from pydave4vm import do_dave4vm
+from pydave4vm import do_dave4vm, concurrency
 
 # Importing the addons for PyDAVE4VM.
-from pydave4vm.addons import myconfig, stdconfig, neutralline, cubitos3, check_fits, swpc_db, swpcparser, downloaddata
+from pydave4vm.addons import myconfig, stdconfig, neutralline, cubitos3, check_fits, swpc_db, swpcparser, downloaddata, ingest
 from pydave4vm.addons.poyntingflux import poyntingflux
 
 # Importing the packages to operate with the database.
@@ -89,7 +89,241 @@ def ajuste(data):
     return(data.tostring())
 
 
-def prepare(config_path, os_, downloaded = None, delete_files = None):
+def pair_times(meta):
+    '''
+    Returns (t1, t2, date_obs) with the times of the two observations of a
+    pair, meta being their metadata from sunpy or their rows of the 
+    cubitos3.scan_headers table. DATE-OBS is used and date_obs is True 
+    unless it is missing or in another format, T_REC being used instead.
+    '''
+    try:
+        # Testing if the registers are on the correct format.
+        t1 = datetime.strptime(meta[0]['date-obs'], "%Y-%m-%dT%H:%M:%S.%f")
+        t2 = datetime.strptime(meta[1]['date-obs'], "%Y-%m-%dT%H:%M:%S.%f")
+        
+    except (ValueError, TypeError):
+        # Use t_rec if a value error is encountered.
+        t1 = datetime.strptime(meta[0]['t_rec'], "%Y.%m.%d_%H:%M:%S_TAI")
+        t2 = datetime.strptime(meta[1]['t_rec'], "%Y.%m.%d_%H:%M:%S_TAI")
+        return(t1, t2, False)
+    
+    return(t1, t2, True)
+
+
+def check_pair(i, times, done = ()):
+    '''
+    Starts the result dictionary of the pair i from its pair_times. If the
+    pair is not to be processed its 'status' is set: 'timedelta' if the
+    time interval is off by more than 2 minutes or 'exists' if the later
+    timestamp is in done.
+    '''
+    t1, t2, date_obs = times
+    result = {'i': i, 't1': t1, 't2': t2, 'date_obs': date_obs, 
+              'meta': None}
+    
+    # Checking if the timedelta is consistent.
+    if abs((t2-t1).seconds-720) > 120:
+        result['status'] = 'timedelta'
+        
+    # Checking if the timestamp already exists.
+    elif int(t2.strftime('%Y%m%d%H%M%S')) in done:
+        result['status'] = 'exists'
+    
+    return(result)
+
+
+def frame_metas(headers, table = None):
+    '''
+    The rows of the cubitos3.scan_headers table of the observations that 
+    the pairs refer to: all of them, or those of the ingested cube whose 
+    sidecar is table, which leaves out the observations of another shape.
+    '''
+    if table is None:
+        return([cubitos3.header_row(headers, n) 
+                for n in range(len(headers['frame']))])
+    
+    # Finding the rows of the T_RECs of the cube.
+    position = {t_rec: n for n, t_rec in enumerate(headers['frame'])}
+    return([cubitos3.header_row(headers, position[t_rec]) 
+            for t_rec in table['frame']])
+
+
+def merge_results(checked, processed):
+    '''
+    Yields the results of check_pair in order, replacing those of the 
+    pairs to be processed, without a status, by the next of processed.
+    '''
+    processed = iter(processed)
+    for result in checked:
+        yield(result if 'status' in result else next(processed))
+
+
+def process_pair(path, i, dx, dy, window_size, done = (), use_bitmap = False,
+                 threshold = None, index = None, frames = None,
+                 use_cube = False):
+    '''
+    Processes the pair of observations i and i+1 of the directory path:
+    the datacubes are made, the time interval and shapes are checked and,
+    if the later timestamp is not in done (the timestamps already in the
+    database), the velocities are calculated with PyDAVE4VM together with
+    the Poynting flux and its integrals around the PILs.
+    Each pair is independent from the others, so this function can be 
+    run by the workers of a process pool. The database is not touched 
+    here, the results are returned in a dictionary whose 'status' tells
+    what happened: 'timedelta', 'shape', 'exists' or 'processed' (see 
+    check_pair, which prepare runs on the headers before reading a pair).
+    With use_bitmap and/or threshold (|B| in G) only the pixels around the
+    active region (see do_dave4vm.roi_mask) are solved, the others being 
+    NaN and left out of the integrals.
+    index is the cubitos3.FrameIndex of path, so that the directory is not
+    listed again for every pair. frames is an optional (start, stop) pair
+    of observations already decoded by cubitos3.stream_pairs, which are 
+    then not read again. With use_cube they are read from the cube of the
+    directory made by ingest.ingest instead of the FITS files, the 
+    bitmaps still coming from their FITS files.
+    '''
+    #######################################################################
+    # Data preparation.
+    ###################
+    #Taking the observations from the ingested cube.
+    if frames is None and use_cube:
+        if use_bitmap and index is None:
+            index = cubitos3.FrameIndex(path)
+        frames = ingest.cube_frames(path, i, index if use_bitmap else None)
+    
+    #Calling the function to make the datacubes.
+    if frames is None:
+        data_cube_Br, data_cube_Bp, data_cube_Bt,\
+        meta_cube_Bp = cubitos3.create_cube(path, i, index=index)
+    
+    #Or taking the observations already decoded.
+    else:
+        data_cube_Br, data_cube_Bp, data_cube_Bt, meta_cube_Bp = (
+            [frame[key] for frame in frames] 
+            for key in ('Br', 'Bp', 'Bt', 'meta'))
+
+    # Defining the start and end points based on the datacubes.
+    # This should later be included in a for structure depending on the objective.
+    bx_start = data_cube_Bp[0]
+    by_start = np.multiply(-1,data_cube_Bt[0])
+    bz_start = data_cube_Br[0]
+    bx_stop = data_cube_Bp[1]
+    by_stop = np.multiply(-1,data_cube_Bt[1])
+    bz_stop = data_cube_Br[1]
+    
+    # Starting the dictionary with the results, checking the time 
+    # interval and whether the timestamp already exists.
+    result = check_pair(i, pair_times(meta_cube_Bp), done)
+    result['meta'] = meta_cube_Bp
+    if 'status' in result:
+        return(result)
+        
+    # Checking if the shape is consistent among the observations.
+    if np.shape(bx_start) != np.shape(bx_stop):
+        result['status'] = 'shape'
+        result['shapes'] = (np.shape(bx_start), np.shape(bx_stop))
+        return(result)
+    
+    t1, t2 = result['t1'], result['t2']
+    
+    ###########################################################################
+    # Obtaining the velocities with PyDAVE4VM.
+    ##########################################
+    # Calculating the time between the images in seconds.
+    dt = (t2-t1).total_seconds()        
+    
+    # Building the region of interest, from the bitmaps of both frames
+    # and/or the strength of the average field.
+    mask = None
+    if use_bitmap or threshold is not None:
+        bitmap = None
+        if use_bitmap:
+            if frames is None:
+                bitmaps = cubitos3.create_bitmaps(path, i, index=index)
+            else:
+                bitmaps = [frame['bitmap'] for frame in frames]
+            if all(item is not None for item in bitmaps):
+                bitmap = np.maximum(*bitmaps)
+        
+        if bitmap is not None or threshold is not None:
+            mask = do_dave4vm.roi_mask(bitmap, (bx_start + bx_stop)/2,
+                                       (by_start + by_stop)/2,
+                                       (bz_start + bz_stop)/2, threshold)
+    
+    # Calling do_dave4vm, which prepares pyDAVE4VM to be executed.
+    magvm, vel4vm = do_dave4vm.do_dave4vm(dt,bx_stop, bx_start, by_stop,
+                                              by_start, bz_stop, bz_start,dx,
+                                              dy, window_size, mask=mask)
+    
+    # Defaulting the Poynting flux and the PIL integrals.
+    Sn = St = Ss = int_Sn = int_St = int_Ss = logR = None
+    int_PIL_Sn = int_PIL_pos_Sn = int_PIL_neg_Sn = None
+    int_PIL_St = int_PIL_pos_St = int_PIL_neg_St = None
+    int_PIL_Ss = int_PIL_pos_Ss = int_PIL_neg_Ss = None
+    
+    # Checking if dave4vm was able to produce results.
+    if vel4vm['solved'] is True:
+        # Calculating the Poynting flux        
+        Sn, St, Ss, int_Sn, int_St, int_Ss = poyntingflux(dx,
+                                                          magvm['bx'],
+                                                          magvm['by'],
+                                                          magvm['bz'],
+                                                          vel4vm['U0'],
+                                                          vel4vm['V0'],
+                                                          vel4vm['W0'])
+        
+        ###############################################################
+        # Integration around the PILS.
+        ##############################
+        # Creating the PIL gaussian broadening mask.
+        pil_gb_map = neutralline.PIL(magvm['bz'], gaussian=True)
+        
+        # Testing if the PIL actually exists.
+        if np.sum(pil_gb_map) > 0.1:
+            # Integrating the Poynting flux components along the PIL.
+            int_PIL_Sn = np.nansum(np.multiply(Sn,pil_gb_map))
+            int_PIL_pos_Sn = np.nansum(np.multiply(np.multiply(Sn,(Sn > 0).astype(float)),
+                                                pil_gb_map))
+            int_PIL_neg_Sn = np.nansum(np.multiply(np.multiply(Sn,(Sn < 0).astype(float)),
+                                                pil_gb_map))
+            
+            int_PIL_St = np.nansum(np.multiply(St,pil_gb_map))
+            int_PIL_pos_St = np.nansum(np.multiply(np.multiply(St,(St > 0).astype(float)),
+                                                pil_gb_map))
+            int_PIL_neg_St = np.nansum(np.multiply(np.multiply(St,(St < 0).astype(float)),
+                                                pil_gb_map))
+            
+            int_PIL_Ss = np.nansum(np.multiply(Ss,pil_gb_map))
+            int_PIL_pos_Ss = np.nansum(np.multiply(np.multiply(Ss,(Ss > 0).astype(float)),
+                                                pil_gb_map))
+            int_PIL_neg_Ss = np.nansum(np.multiply(np.multiply(Ss,(Ss < 0).astype(float)),
+                                                pil_gb_map))
+            
+            # Calculating Schrijver's R.
+            logR = np.log10(np.sum(np.absolute(np.multiply(magvm['bz'],
+                                                           pil_gb_map))))
+    
+    # Keeping only what goes into the database.
+    result.update({'status': 'processed', 'dt': dt,
+                   'solved': vel4vm['solved'],
+                   'U0': vel4vm['U0'], 'V0': vel4vm['V0'],
+                   'W0': vel4vm['W0'], 'bx': magvm['bx'],
+                   'by': magvm['by'], 'bz': magvm['bz'],
+                   'Sn': Sn, 'St': St, 'Ss': Ss, 'int_Sn': int_Sn,
+                   'int_St': int_St, 'int_Ss': int_Ss,
+                   'int_PIL_Sn': int_PIL_Sn, 'int_PIL_pos_Sn': int_PIL_pos_Sn,
+                   'int_PIL_neg_Sn': int_PIL_neg_Sn, 'int_PIL_St': int_PIL_St,
+                   'int_PIL_pos_St': int_PIL_pos_St,
+                   'int_PIL_neg_St': int_PIL_neg_St, 'int_PIL_Ss': int_PIL_Ss,
+                   'int_PIL_pos_Ss': int_PIL_pos_Ss,
+                   'int_PIL_neg_Ss': int_PIL_neg_Ss, 'logR': logR})
+    
+    return(result)
+
+
+def prepare(config_path, os_, downloaded = None, delete_files = None,
+            workers = None, use_bitmap = False, threshold = None,
+            cores = None, prefetch = 2):
     '''
     This is the pre-routine to execute pydave4vm.
     Here the following steps are taken:
@@ -100,7 +334,18 @@ def prepare(config_path, os_, downloaded = None, delete_files = None):
         - Data is inserted into the do_dave4vm module;
         - Updates on the database;
         - Log production.
-        
+    
+    workers is the number of processes used to work on the pairs of 
+    observations at the same time. The results are still written to the
+    database by this process, one pair at a time and in timestamp order.
+    cores is the budget of cores shared by the processes and by the FFT
+    and BLAS threads inside each of them (see concurrency.split_budget),
+    all the cores by default, and is never exceeded.
+    use_bitmap and threshold restrict the calculation to the active 
+    region (see process_pair).
+    prefetch is the number of pairs read ahead by a background thread
+    while the current one is processed (see concurrency.prefetch), when
+    the pairs are processed in a single process. 0 reads them in turn.
     '''
     
     # Creating a timestamp for the analysis start.
@@ -212,19 +457,23 @@ def prepare(config_path, os_, downloaded = None, delete_files = None):
     # Deleting those lists.
     del Br_unique, Bt_unique, Bp_unique
     
-    # Checking the number of observations.
-    number_of_obs = int(len(fnmatch.filter(os.listdir(path),'*.fits'))/3)
+    # Listing the observations once, after check_fits removed the 
+    # incomplete ones.
+    index = cubitos3.FrameIndex(path)
     
-    # Taking the header information from one of the files.
-    meta = sunpy.map.Map(path + os.listdir(path)[0]).meta
+    # Reading only the headers of the observations, or taking them from
+    # the sidecar file of a previous run.
+    headers = cubitos3.scan_headers(path, index, 
+                                    workers=concurrency.core_budget(cores))
+    meta = cubitos3.header_row(headers, 0)
     
     # Defining a dx and dy in km based on HMI resolution.
-    dx = (2*np.pi*6.955e8*meta['CDELT2']/360)/1000
+    dx = (2*np.pi*6.955e8*meta['cdelt2']/360)/1000
     dy = dx
     
     # Checking the length of the image in the y-axis.
-    columnshape = np.shape(sunpy.map.Map(path + os.listdir(path)[0]).data)[0]
-    rowshape = np.shape(sunpy.map.Map(path + os.listdir(path)[0]).data)[1]
+    columnshape = meta['naxis2']
+    rowshape = meta['naxis1']
     
     ###########################################################################
     # Starting the database session.
@@ -326,131 +575,143 @@ def prepare(config_path, os_, downloaded = None, delete_files = None):
     ###########################################################################
     # Looping over all the datacubes. Note that all of them should have the 
     # same dimensions which is already standard for the cea data.
-    for i in range(len(glob.glob(path+'*.Bp.fits'))-1):
-        #######################################################################
-        # Data preparation.
-        ###################
-        #Calling the function to make the datacubes.
-        data_cube_Br, data_cube_Bp, data_cube_Bt,\
-        meta_cube_Bp = cubitos3.create_cube(path, i)
-    
-        # Defining the start and end points based on the datacubes.
-        # This should later be included in a for structure depending on the objective.
-        bx_start = data_cube_Bp[0]
-        by_start = np.multiply(-1,data_cube_Bt[0])
-        bz_start = data_cube_Br[0]
-        bx_stop = data_cube_Bp[1]
-        by_stop = np.multiply(-1,data_cube_Bt[1])
-        bz_stop = data_cube_Br[1]
-        
-        # Defining two variables to take initial and final time.
-        try:
-            # Testing if the registers are on the correct format.
-            t1 = datetime.strptime(meta_cube_Bp[0]['date-obs'], "%Y-%m-%dT%H:%M:%S.%f")
-            t2 = datetime.strptime(meta_cube_Bp[1]['date-obs'], "%Y-%m-%dT%H:%M:%S.%f")
-            
-        except ValueError:
-            # Use t_rec if a value error is encountered.
-            t1 = datetime.strptime(meta_cube_Bp[0]['t_rec'], "%Y.%m.%d_%H:%M:%S_TAI")
-            t2 = datetime.strptime(meta_cube_Bp[1]['t_rec'], "%Y.%m.%d_%H:%M:%S_TAI")
-            print('Value Error on date-obs, t_rec used instead of date-obs.')
-            logger.debug('Value Error on date-obs, t_rec used instead of date-obs.')
-            
-        # Checking if the timedelta is consistent.
-        if abs((t2-t1).seconds-720) > 120:
-            print('Time delta deviated by more than 2 minutes. \n ',
-                  f't1: {t1} \n',
-                  f't2: {t2} \n',
-                  f'Deltat: {(t2-t1).seconds} \n')
-            logger.debug('Time delta deviated by more than 2 minutes. \n ',
-                          f't1: {t1} \n',
-                          f't2: {t2} \n',
-                          f'Deltat: {(t2-t1).seconds} \n')
-            continue
-            
-        # Checking if the shape is consistent among the observations.
-        if np.shape(bx_start) != np.shape(bx_stop):
-            print(f'Shape not consistent. bx_start({t1}): {np.shape(bx_start)}, bx_stop({t2}): {np.shape(bx_stop)}')
-            logger.debug(f'Shape not consistent. bx_start({t1}): {np.shape(bx_start)}, bx_stop({t2}): {np.shape(bx_stop)}')
-            # Go to the next step.
-            continue
-            
-        # Checking if the timestamp already exists.
-        check = session.query(sql.exists().where(sql.and_(Observations.ar_id == ar_id,
-                                                          Observations.timestamp_int == int(t2.strftime('%Y%m%d%H%M%S'))))).scalar()
+    # The pairs are processed by process_pair, in a process pool when 
+    # workers is given, and their results written here in timestamp order.
+    #######################################################################
+    # Taking the timestamps that are already in the database so that the
+    # workers can skip them.
+    done = set(item[0] for item in 
+               session.query(Observations.timestamp_int).filter(
+                       Observations.ar_id == ar_id))
+    
+    # Reading the observations from the cube made by ingest.ingest if it
+    # is current, skipping the FITS files.
+    cube = ingest.open_cube(path, index)
+    use_cube = cube is not None
+    if use_cube:
+        logger.info('Reading the observations from the ingested cube.')
+        if use_bitmap:
+            logger.info('Reading the bitmaps from their FITS files, they '
+                        'are not in the cube.')
+    
+    # Defining the work of each pair.
+    if use_cube:
+        pairs = range(cube[0].shape[0] - 1)
+    else:
+        pairs = [i for i, start, stop in index.pairs()]
+    
+    # The metadata of the observations, from their headers, in the order
+    # of the pairs.
+    metas = frame_metas(headers, cube[1] if use_cube else None)
+    
+    # Counting the observations the pairs refer to.
+    number_of_obs = len(metas)
+    
+    # Checking the time interval and the database from the headers, so
+    # that the pairs that are skipped are never read.
+    checked = [check_pair(i, pair_times(metas[i:i+2]), done) for i in pairs]
+    pairs = [result['i'] for result in checked if 'status' not in result]
+    work = functools.partial(process_pair, path, dx=dx, dy=dy,
+                             window_size=window_size, done=done,
+                             use_bitmap=use_bitmap, threshold=threshold,
+                             index=index, use_cube=use_cube)
+    
+    # Dividing the cores between the processes and their threads, one
+    # process unless more workers were requested.
+    processes, threads = concurrency.split_budget(cores, tasks=len(pairs),
+                                                  processes=workers or 1)
+    
+    # Counting the time spent reading and processing the pairs.
+    counters = {}
+    
+    # Starting the pool if more than one process fits the budget.
+    if processes > 1:
+        pool = ProcessPoolExecutor(max_workers=processes,
+                                   initializer=concurrency.limit_threads,
+                                   initargs=(threads,))
         
-        #######################################################################
-        # Obtaining the velocities with PyDAVE4VM.
-        ##########################################
-        # Work on a new timestamp if the result is not yet on the database
-        if check is False:
+        # Keeping only a couple of pairs per process in flight, so that
+        # the results waiting for the database stay bounded.
+        processed = concurrency.bounded_map(pool, work, pairs, 
+                                            window=2*processes)
+        
+    # Otherwise the observations are read in sequence, each one decoded
+    # only once for the two pairs it belongs to.
+    else:
+        concurrency.limit_threads(threads)
+        pool = None
+        if use_cube:
+            frames = ingest.cube_pairs(path, pairs=pairs,
+                                       index=index if use_bitmap else None)
+        else:
+            frames = cubitos3.stream_pairs(path, index, bitmap=use_bitmap,
+                                           pairs=pairs)
+        
+        # Reading the next pairs while this one is processed.
+        if prefetch and not use_cube:
+            frames = concurrency.prefetch(frames, depth=prefetch,
+                                          counters=counters)
         
-            # Calculating the time between the images in seconds.
-            dt = (t2-t1).total_seconds()        
+        processed = (work(i, frames=(start, stop)) 
+                     for i, start, stop in frames)
+    
+    # Putting the skipped pairs back in order.
+    results = merge_results(checked, processed)
+    
+    # Writing the results, closing the pool even if this fails.
+    try:
+        for result in results:
+            # Taking the variables back from the results.
+            i = result['i']
+            t1 = result['t1']
+            t2 = result['t2']
+            meta_cube_Bp = result['meta']
+        
+            if result['date_obs'] is False:
+                print('Value Error on date-obs, t_rec used instead of date-obs.')
+                logger.debug('Value Error on date-obs, t_rec used instead of date-obs.')
             
-            # Calling do_dave4vm, which prepares pyDAVE4VM to be executed.
-            magvm, vel4vm = do_dave4vm.do_dave4vm(dt,bx_stop, bx_start, by_stop,
-                                                      by_start, bz_stop, bz_start,dx,
-                                                      dy, window_size)
+            # Checking if the timedelta is consistent.
+            if result['status'] == 'timedelta':
+                print('Time delta deviated by more than 2 minutes. \n ',
+                      f't1: {t1} \n',
+                      f't2: {t2} \n',
+                      f'Deltat: {(t2-t1).seconds} \n')
+                logger.debug('Time delta deviated by more than 2 minutes. \n ' +
+                              f't1: {t1} \n' +
+                              f't2: {t2} \n' +
+                              f'Deltat: {(t2-t1).seconds} \n')
+                continue
             
+            # Checking if the shape is consistent among the observations.
+            if result['status'] == 'shape':
+                shape_start, shape_stop = result['shapes']
+                print(f'Shape not consistent. bx_start({t1}): {shape_start}, bx_stop({t2}): {shape_stop}')
+                logger.debug(f'Shape not consistent. bx_start({t1}): {shape_start}, bx_stop({t2}): {shape_stop}')
+                # Go to the next step.
+                continue
+        
+            # Checking if the timestamp already exists.
+            if result['status'] == 'exists':
+                logger.info('Timestamp ' + str(t2) + 
+                             ' was already in the database.')
+                print('Timestamp ' + str(t2) + 
+                      ' was already in the database.')
+                continue
+        
             # Checking if dave4vm was able to produce results.
-            if vel4vm['solved'] is True:
-                # Calculating the Poynting flux        
-                Sn, St, Ss, int_Sn, int_St, int_Ss = poyntingflux(dx,
-                                                                  magvm['bx'],
-                                                                  magvm['by'],
-                                                                  magvm['bz'],
-                                                                  vel4vm['U0'],
-                                                                  vel4vm['V0'],
-                                                                  vel4vm['W0'])
-                
-                columnshape = np.shape(vel4vm['U0'])[0]
-                
-                ###############################################################
-                # Integration around the PILS.
-                ##############################
-                # Creating the PIL gaussian broadening mask.
-                pil_gb_map = neutralline.PIL(magvm['bz'], gaussian=True)
-                
-                # Testing if the PIL actually exists.
-                if np.sum(pil_gb_map) > 0.1:
-                    # Integrating the Poynting flux components along the PIL.
-                    int_PIL_Sn = np.sum(np.multiply(Sn,pil_gb_map))
-                    int_PIL_pos_Sn = np.sum(np.multiply(np.multiply(Sn,(Sn > 0).astype(float)),
-                                                        pil_gb_map))
-                    int_PIL_neg_Sn = np.sum(np.multiply(np.multiply(Sn,(Sn < 0).astype(float)),
-                                                        pil_gb_map))
-                    
-                    int_PIL_St = np.sum(np.multiply(St,pil_gb_map))
-                    int_PIL_pos_St = np.sum(np.multiply(np.multiply(St,(St > 0).astype(float)),
-                                                        pil_gb_map))
-                    int_PIL_neg_St = np.sum(np.multiply(np.multiply(St,(St < 0).astype(float)),
-                                                        pil_gb_map))
-                    
-                    int_PIL_Ss = np.sum(np.multiply(Ss,pil_gb_map))
-                    int_PIL_pos_Ss = np.sum(np.multiply(np.multiply(Ss,(Ss > 0).astype(float)),
-                                                        pil_gb_map))
-                    int_PIL_neg_Ss = np.sum(np.multiply(np.multiply(Ss,(Ss < 0).astype(float)),
-                                                        pil_gb_map))
-                    
-                    # Calculating Schrijver's R.
-                    logR = np.log10(np.sum(np.absolute(np.multiply(magvm['bz'],
-                                                                   pil_gb_map))))
+            if result['solved'] is True:
+                columnshape = np.shape(result['U0'])[0]
+            
                 # logger.
                 logger.info('The apperture problem could be solved, data processed.')
                 # Prints to state progress.
                 print('The apperture problem could be solved, data processed.')
-            
+        
             else:
-                ###############################################################
-                # Poynting flux calculation.
-                ############################
-                # Defaulting the Poynting flux and columnshape.
-                Sn = St = Ss = int_Sn = int_St = int_Ss = columnshape = logR = None
-                int_PIL_Sn = int_PIL_pos_Sn = int_PIL_neg_Sn = None
-                int_PIL_St = int_PIL_pos_St = int_PIL_neg_St = None
-                int_PIL_Ss = int_PIL_pos_Ss = int_PIL_neg_Ss = None
-                
+                # Defaulting the columnshape.
+                columnshape = None
+            
                 # logger.
                 logger.info('The apperture problem could not be solved. ' +
                              f'({i}/{number_of_obs})')
@@ -462,17 +723,17 @@ def prepare(config_path, os_, downloaded = None, delete_files = None):
             #################################################
             # Calling the function that does it and placing the NOAA numbers
             # in numerical order.
-            noaa_number = sorted(swpc_db.find_noaa_number(meta_cube_Bp[1]))
-            
+            noaa_number = sorted(swpc_db.find_noaa_number(metas[i+1]))
+        
             # Appending the NOAA numbers to the overall list.
             for thing in noaa_number:
                 if thing not in noaa_numbers:
                     noaa_numbers.append(thing)
-            
+        
             # Filling all the available slots.
             while len(noaa_number) < 3:
                 noaa_number.append(None)
-            
+        
             ###################################################################
             # Data insertion.
             #################
@@ -481,60 +742,63 @@ def prepare(config_path, os_, downloaded = None, delete_files = None):
             try:
                 new_obs = Observations(timestamp_dt=t2,
                                        timestamp_int=int(t2.strftime('%Y%m%d%H%M%S')),
-                                       deltat=dt,
+                                       deltat=result['dt'],
                                        ar_id=ar_id,
-                                       d4vm_vx=ajuste(vel4vm['U0']),
-                                       d4vm_vy=ajuste(vel4vm['V0']),
-                                       d4vm_vz=ajuste(vel4vm['W0']), 
-                                       mean_bx=ajuste(magvm['bx']),
-                                       mean_by=ajuste(magvm['by']), 
-                                       mean_bz=ajuste(magvm['bz']),
-                                       poyn_Sn=ajuste(Sn), 
-                                       poyn_St=ajuste(St), 
-                                       poyn_Ss=ajuste(Ss),
-                                       int_Sn=int_Sn,
-                                       int_St=int_St,
-                                       int_Ss=int_Ss,
-                                       int_PIL_Sn=int_PIL_Sn,
-                                       int_PIL_pos_Sn=int_PIL_pos_Sn,
-                                       int_PIL_neg_Sn=int_PIL_neg_Sn,
-                                       int_PIL_St=int_PIL_St,
-                                       int_PIL_pos_St=int_PIL_pos_St,
-                                       int_PIL_neg_St=int_PIL_neg_St,
-                                       int_PIL_Ss=int_PIL_Ss,
-                                       int_PIL_pos_Ss=int_PIL_pos_Ss,
-                                       int_PIL_neg_Ss=int_PIL_neg_Ss,
-                                       logR=logR,
+                                       d4vm_vx=ajuste(result['U0']),
+                                       d4vm_vy=ajuste(result['V0']),
+                                       d4vm_vz=ajuste(result['W0']), 
+                                       mean_bx=ajuste(result['bx']),
+                                       mean_by=ajuste(result['by']), 
+                                       mean_bz=ajuste(result['bz']),
+                                       poyn_Sn=ajuste(result['Sn']), 
+                                       poyn_St=ajuste(result['St']), 
+                                       poyn_Ss=ajuste(result['Ss']),
+                                       int_Sn=result['int_Sn'],
+                                       int_St=result['int_St'],
+                                       int_Ss=result['int_Ss'],
+                                       int_PIL_Sn=result['int_PIL_Sn'],
+                                       int_PIL_pos_Sn=result['int_PIL_pos_Sn'],
+                                       int_PIL_neg_Sn=result['int_PIL_neg_Sn'],
+                                       int_PIL_St=result['int_PIL_St'],
+                                       int_PIL_pos_St=result['int_PIL_pos_St'],
+                                       int_PIL_neg_St=result['int_PIL_neg_St'],
+                                       int_PIL_Ss=result['int_PIL_Ss'],
+                                       int_PIL_pos_Ss=result['int_PIL_pos_Ss'],
+                                       int_PIL_neg_Ss=result['int_PIL_neg_Ss'],
+                                       logR=result['logR'],
                                        hmi_meta_data=json.dumps(meta_cube_Bp[1]),
                                        noaa_number1=noaa_number[0],
                                        noaa_number2=noaa_number[1],
                                        noaa_number3=noaa_number[2])
-                
+            
                 session.add(new_obs)
                 session.commit()
-                
+            
             except AttributeError:
                 session.rollback()
                 logger.debug('Timestamp ' + str(t2) + ' not created.')
                 print('Timestamp ' + str(t2) + ' not created.')
-                
+            
             else:
                 logger.info('Timestamp ' + str(t2) + ' created. '  + 
                             f'({i}/{number_of_obs})')
                 print('Timestamp ' + str(t2) + ' created. '  + 
                      f'({i}/{number_of_obs})')
-                
+            
             # Feedback.
             print(meta_cube_Bp[0]['t_obs'], ' Processed! ' + 
                   f'({i}/{number_of_obs})')
-            
-        else:
-            logger.info('Timestamp ' + str(t2) + 
-                         ' was already in the database.')
-            print('Timestamp ' + str(t2) + 
-                  ' was already in the database.')
-            continue
-    ###########################################################################
+    finally:
+        # Closing the pool, cancelling the pairs not started.
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    
+    # Reporting whether the pairs waited for the disk.
+    if counters:
+        logger.info(f"Pairs read ahead: {counters['items']}, reading: "
+                    f"{counters['read']:.1f} s, waiting on reads: "
+                    f"{counters['wait']:.1f} s, processing: "
+                    f"{counters['compute']:.1f} s")
     # Creating a timestamp for the analysis end.
     observations_end = datetime.now()
     
@@ -711,11 +975,12 @@ def prepare(config_path, os_, downloaded = None, delete_files = None):
     
     return
     
-def execute_configs(os_='linux',path=None):
+def execute_configs(os_='linux',path=None,workers=None,cores=None):
     '''
     This code will read multiple config files and execute the 'prepare' 
     routine for each one of those files which will then make the analysis for 
-    each region featured on the file.
+    each region featured on the file. workers and cores are passed on to 
+    prepare.
     '''
     # Checking if path to configs exists.
     if path is None:
@@ -730,7 +995,7 @@ def execute_configs(os_='linux',path=None):
     # Iterating for each congif file.
     for config in path:
         print(f'Initiating the analysis for the file located ar: {config}')
-        prepare(config_path=config, os_=os_)
+        prepare(config_path=config, os_=os_, workers=workers, cores=cores)
         # Moving the config file to the used section.
         # rsplit will separate what is after and before the last slash.
         shutil.move(config, path_to_move + config.rsplit('/',1)[-1])
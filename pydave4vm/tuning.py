@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module chooses the fastest convolution backend (see convolution.py)
+for the matrix of dave4vm. The cost of 'direct', 'fft' and 'sat' depends
+on the window size and on the shape of the patch, so the first time a
+(shape, wsize, dtype) is seen each backend is timed building the matrix
+of random products and the winner is saved in a small JSON tuning table,
+which is reused by later runs. The shape is that of the images the 
+engines are built for, the tiles with their halo when the field is split,
+and wsize is the width of the kernel, kernel['psf'].shape[0], which is 
+the same for the window sizes 20 and 21.
+
+The table is kept in ~/.pydave4vm/tuning.json, or in the file given by
+the PYDAVE4VM_TUNING environment variable. For reproducible runs the
+backend can be forced by passing it as the method instead of 'auto', or
+for every 'auto' run with the PYDAVE4VM_METHOD environment variable.
+
+@author: andrechicrala
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+from pydave4vm import dave4vm_matrix
+from pydave4vm.convolution import make_engine
+
+
+# Where the tuning table is kept.
+TUNING_PATH = os.path.join(os.path.expanduser('~'), '.pydave4vm',
+                           'tuning.json')
+
+# The tables already read, by path.
+_tables = {}
+
+
+def table_path(path = None):
+    '''
+    Returns the path of the tuning table: path if given, then the
+    PYDAVE4VM_TUNING environment variable and then TUNING_PATH.
+    '''
+
+    if path is None:
+        path = os.environ.get('PYDAVE4VM_TUNING', TUNING_PATH)
+
+    return(path)
+
+
+def tuning_key(shape, wsize, dtype):
+    '''
+    The key of a (shape, wsize, dtype) in the tuning table.
+    '''
+
+    return(f'{shape[0]}x{shape[1]}/{wsize}/{np.dtype(dtype).name}')
+
+
+def load_table(path = None):
+    '''
+    Reads the tuning table, only once per path. A missing or unreadable
+    file gives an empty table.
+    '''
+
+    path = table_path(path)
+
+    if path not in _tables:
+        try:
+            with open(path) as file:
+                _tables[path] = json.load(file)
+        except (OSError, ValueError):
+            _tables[path] = {}
+
+    return(_tables[path])
+
+
+def save_table(table, path = None):
+    '''
+    Writes the tuning table, through a temporary file so that a run
+    reading it at the same time never sees it half written.
+    '''
+
+    path = table_path(path)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok = True)
+
+    temporary = path + '.' + str(os.getpid())
+    with open(temporary, 'w') as file:
+        json.dump(table, file, indent = 1, sort_keys = True)
+    os.replace(temporary, path)
+
+    _tables[path] = table
+
+
+def time_method(method, kernel, shape, dtype = np.float64, limit = None):
+    '''
+    Times a backend building the whole packed matrix of random products 
+    of the given shape, since the backends share their work among the 
+    entries differently (e.g. the FFT transforms each product once). 
+    Returns the time in seconds, or None if it went over limit, in which
+    case the timing is stopped early.
+    '''
+
+    rng = np.random.RandomState(0)
+    images = [rng.standard_normal(shape).astype(dtype)
+              for product in dave4vm_matrix.PRODUCTS]
+
+    start = time.perf_counter()
+    engine = make_engine(method, kernel, shape, dtype = dtype)
+    handles = [engine.forward(image) for image in images]
+
+    for i, j, terms in dave4vm_matrix.ENTRIES:
+        engine.combine([(coef, handles[index], name)
+                        for coef, index, name in terms])
+
+        # Giving up on a backend that is already slower than another.
+        if limit is not None and time.perf_counter() - start > limit:
+            return(None)
+
+    return(time.perf_counter() - start)
+
+
+# The order in which the backends are timed, the usually fastest first so
+# that the slow ones can be stopped early.
+TUNING_ORDER = ('fft', 'sat', 'direct')
+
+
+def select_method(kernel, shape, wsize, dtype = np.float64, path = None,
+                  methods = None):
+    '''
+    Returns the fastest backend for the (shape, wsize, dtype), from the
+    tuning table or, the first time, timing the methods (TUNING_ORDER by
+    default) and saving the winner in the table. The seconds of each
+    method are also saved, None for those stopped early.
+    '''
+
+    # Forcing the backend for every run.
+    forced = os.environ.get('PYDAVE4VM_METHOD')
+    if forced:
+        return(forced)
+
+    table = load_table(path)
+    key = tuning_key(shape, wsize, dtype)
+
+    if key not in table:
+        seconds = {}
+        best = None
+        for method in (methods or TUNING_ORDER):
+            limit = None if best is None else seconds[best]
+            seconds[method] = time_method(method, kernel, shape, dtype,
+                                          limit = limit)
+            if seconds[method] is not None and (best is None or 
+                                                seconds[method] < 
+                                                seconds[best]):
+                best = method
+
+        table = dict(table)
+        table[key] = {'method': best, 'seconds': seconds}
+        save_table(table, path)
+
+    return(table[key]['method'])
+
+
+def resolve_method(method, kernel, shape, wsize, dtype = np.float64):
+    '''
+    Returns method, or the tuned backend if it is 'auto'.
+    '''
+
+    if method == 'auto':
+        return(select_method(kernel, shape, wsize, dtype))
+
+    return(method)
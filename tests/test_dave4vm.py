@@ -0,0 +1,915 @@
+# Tests for the numerical core of pydave4vm using synthetic magnetograms.
+
+import numpy as np
+import pytest
+from numpy.linalg import solve
+from scipy.ndimage import gaussian_filter
+
+from pydave4vm import do_dave4vm, dave4vm, dave4vm_matrix, odiffxy5
+
+
+def synthetic_pair(shape=(48,56), seed=0):
+    '''
+    Smooth random fields standing in for a pair of vector magnetograms.
+    '''
+    rng = np.random.RandomState(seed)
+    
+    fields = [gaussian_filter(rng.standard_normal(shape), 3)*3000
+              for i in range(6)]
+    
+    # Making the stop bz a small evolution of the start bz.
+    fields[5] = fields[4] + 0.05*fields[5]
+    
+    return(fields)
+
+
+def run_pair(wsize=20, **kwargs):
+    bx_start, bx_stop, by_start, by_stop, bz_start, bz_stop = synthetic_pair()
+    
+    return(do_dave4vm.do_dave4vm(720., bx_stop, bx_start, by_stop, by_start,
+                                 bz_stop, bz_start, 364.3, 364.3, wsize,
+                                 **kwargs))
+
+
+def singular_systems(seed):
+    '''
+    Random symmetric systems of a (3,4) patch, as the full (10,10,3,4) 
+    and the packed (55,3,4) matrices, and the index of every pixel. The
+    system of the pixel (2,3) is singular.
+    '''
+    rng = np.random.RandomState(seed)
+    
+    M = rng.standard_normal((3,4,10,12))
+    AM = np.moveaxis(np.einsum('ijkl,ijml->ijkm', M, M), (2,3), (0,1))
+    
+    # Making one pixel singular by repeating a regressor.
+    AM[1,:,2,3] = AM[0,:,2,3]
+    AM[:,1,2,3] = AM[:,0,2,3]
+    
+    return(AM, AM[dave4vm_matrix.UPPER], np.where(np.ones((3,4)) > 0))
+
+
+def fake_maps(monkeypatch, read):
+    '''
+    Replaces sunpy.map.Map by maps whose data and meta are given by 
+    read(path).
+    '''
+    from pydave4vm.addons import cubitos3
+    
+    class FakeMap:
+        def __init__(self, path):
+            self.data, self.meta = read(path)
+    monkeypatch.setattr(cubitos3.sunpy.map, 'Map', FakeMap, raising=False)
+
+
+def test_solve_pixels_matches_loop():
+    rng = np.random.RandomState(1)
+    
+    # Building symmetric positive definite systems for a small patch.
+    M = rng.standard_normal((4,5,10,10))
+    AM = np.moveaxis(np.einsum('ijkl,ijml->ijkm', M, M), (2,3), (0,1))
+    index = np.where(np.ones((4,5)) > 0)
+    
+    # Packing the upper triangle.
+    AP = AM[dave4vm_matrix.UPPER]
+    
+    vector = dave4vm.solve_pixels(AP, index, chunk_size=7)
+    
+    for n,(i,j) in enumerate(zip(*index)):
+        expected = solve(AM[0:9,0:9,i,j], -1*AM[9,0:9,i,j])
+        np.testing.assert_allclose(vector[n], expected, rtol=1e-12)
+    
+    # The chunks can be solved in a given buffer, in both layouts, also 
+    # gathering from a matrix that is not contiguous.
+    work = np.full(dave4vm.SOLVE_WORK*7, np.nan)
+    for matrix, pixel_major in ((AP, False), 
+                                (np.ascontiguousarray(np.moveaxis(AP, 0, -1)),
+                                 True),
+                                (np.moveaxis(AP, 0, -1), True)):
+        for solver in ('lu', 'cholesky'):
+            np.testing.assert_allclose(
+                dave4vm.solve_pixels(matrix, index, chunk_size=7, 
+                                     solver=solver, pixel_major=pixel_major,
+                                     work=work), vector, rtol=1e-10)
+    
+    with pytest.raises(ValueError):
+        dave4vm.solve_pixels(AP, index, chunk_size=8, work=work)
+
+
+def test_pixel_major_layout_matches_planes():
+    from pydave4vm.convolution import FFTConvolver
+    
+    magvm, vel4vm = run_pair()
+    kernel = dave4vm.build_kernel(20, magvm['dx'], magvm['dy'])
+    engine = FFTConvolver(kernel, magvm['bz'].shape)
+    handles = [engine.forward(product)
+               for product in dave4vm_matrix.matrix_products(magvm)]
+    crop = (slice(5, 40), slice(3, 50))
+    
+    planes = dave4vm_matrix.assemble_matrix(handles, engine)
+    pixels = dave4vm_matrix.assemble_matrix(handles, engine, 
+                                            pixel_major=True, crop=crop)
+    
+    np.testing.assert_array_equal(pixels, np.moveaxis(planes, 0, -1)[crop])
+    
+    index = np.where(np.ones(pixels.shape[:2]) > 0)
+    for solver in ('lu', 'cholesky'):
+        np.testing.assert_allclose(
+            dave4vm.solve_pixels(pixels, index, solver=solver, 
+                                 pixel_major=True),
+            dave4vm.solve_pixels(planes[(slice(None),) + crop], index, 
+                                 solver=solver), rtol=1e-12)
+
+
+def test_cholesky_solver_falls_back_on_singular_pixels():
+    AM, AP, index = singular_systems(2)
+    
+    with pytest.raises(np.linalg.LinAlgError):
+        dave4vm.solve_pixels(AP, index)
+    
+    vector = dave4vm.solve_pixels(AP, index, chunk_size=5, solver='cholesky')
+    masked = dave4vm.solve_pixels(AP, index, solver='cholesky', 
+                                  singular='nan')
+    
+    for n,(i,j) in enumerate(zip(*index)):
+        if (i,j) == (2,3):
+            expected = np.linalg.pinv(AM[0:9,0:9,i,j]) @ (-1*AM[9,0:9,i,j])
+            np.testing.assert_allclose(vector[n], expected, rtol=1e-6)
+            assert np.all(np.isnan(masked[n]))
+        else:
+            expected = solve(AM[0:9,0:9,i,j], -1*AM[9,0:9,i,j])
+            np.testing.assert_allclose(vector[n], expected, rtol=1e-9)
+            np.testing.assert_allclose(masked[n], expected, rtol=1e-9)
+
+
+def test_cholesky_solver_matches_lu_on_synthetic_pair():
+    magvm, lu = run_pair()
+    magvm, cholesky = run_pair(solver='cholesky')
+    
+    for key in ('U0','V0','W0','UX','VY','UY','VX','WX','WY'):
+        np.testing.assert_allclose(cholesky[key], lu[key], rtol=1e-7,
+                                   atol=1e-9*np.abs(lu[key]).max())
+
+
+def test_do_dave4vm_solves_synthetic_pair():
+    magvm, vel4vm = run_pair()
+    
+    assert vel4vm['solved'] is True
+    assert vel4vm['U0'].shape == magvm['bz'].shape
+    assert np.all(np.isfinite(vel4vm['U0']))
+
+
+def test_fft_convolver_matches_scipy():
+    from scipy import signal
+    from pydave4vm.convolution import FFTConvolver
+    
+    rng = np.random.RandomState(2)
+    image = rng.standard_normal((37,52))
+    kernel = {'psf': rng.standard_normal((21,21)),
+              'psfx': rng.standard_normal((21,21))}
+    
+    engine = FFTConvolver(kernel, image.shape)
+    spectrum = engine.forward(image)
+    
+    for name in kernel:
+        expected = signal.convolve(image, kernel[name], mode='same',
+                                   method='fft')
+        np.testing.assert_allclose(engine.convolve(spectrum, name), expected,
+                                   atol=1e-12)
+
+
+def test_fft_convolver_combines_in_the_given_accumulator():
+    from pydave4vm.convolution import FFTConvolver, spectrum_shape
+    
+    rng = np.random.RandomState(4)
+    image = rng.standard_normal((37,52)).astype(np.float32)
+    kernel = {'psf': rng.standard_normal((21,21)),
+              'psfx': rng.standard_normal((21,21))}
+    
+    fshape = (64,80)
+    accumulator = np.empty((2,) + spectrum_shape(fshape), 
+                           dtype=np.complex128)
+    engine = FFTConvolver(kernel, image.shape, fshape=fshape, 
+                          dtype=np.float32, accumulator=accumulator)
+    spectrum = engine.forward(image)
+    terms = [(2., spectrum, 'psf'), (-0.5, spectrum, 'psfx'),
+             (3., spectrum, 'psfx')]
+    
+    expected = sum(coef*engine.convolve(handle, name) 
+                   for coef, handle, name in terms)
+    combined = engine.combine(terms)
+    
+    # The sum was made in the given buffer, in float64.
+    assert engine.accumulator is accumulator
+    assert combined.dtype == np.float64
+    np.testing.assert_allclose(combined, expected, atol=1e-12)
+    
+    # A stack of spectra gets an accumulator of its own shape.
+    stack = engine.forward(np.stack([image, 2*image]))
+    combined = engine.combine([(1., stack, 'psf')])
+    assert engine.accumulator.shape == (2, 2) + spectrum_shape(fshape)
+    np.testing.assert_allclose(combined[1], 2*engine.convolve(spectrum, 
+                                                              'psf'),
+                               atol=1e-10)
+
+
+def test_fused_matrix_matches_the_matrix():
+    magvm, vel4vm = run_pair()
+    kernel = dave4vm.build_kernel(20, magvm['dx'], magvm['dy'])
+    
+    expected = dave4vm_matrix.the_matrix(magvm['bx'], magvm['bxx'],
+                                         None, magvm['by'],
+                                         None, magvm['byy'],
+                                         magvm['bz'], magvm['bzx'],
+                                         magvm['bzy'], magvm['bzt'],
+                                         kernel['psf'], kernel['psfx'],
+                                         kernel['psfy'], kernel['psfxx'],
+                                         kernel['psfyy'], kernel['psfxy'])
+    fused = dave4vm_matrix.fused_matrix(magvm, kernel)
+    
+    # Fewer convolutions than the 118 of the_matrix.
+    assert sum(len(terms) for i, j, terms in dave4vm_matrix.ENTRIES) < 118
+    
+    assert fused.shape == expected.shape
+    for entry in range(100):
+        scale = np.abs(expected[entry]).max()
+        np.testing.assert_allclose(fused[entry], expected[entry],
+                                   rtol=0, atol=1e-10*scale)
+
+
+def test_summed_area_convolver_matches_scipy():
+    from scipy import signal
+    from pydave4vm.convolution import make_engine
+    
+    rng = np.random.RandomState(3)
+    image = rng.standard_normal((37,52))
+    
+    for wsize in (10, 20, 31):
+        kernel = dave4vm.build_kernel(wsize, 364.3, 364.3)
+        engine = make_engine('sat', kernel, image.shape)
+        handle = engine.forward(image)
+        
+        for name in kernel:
+            expected = signal.convolve(image, kernel[name], mode='same')
+            np.testing.assert_allclose(engine.convolve(handle, name), 
+                                       expected, rtol=0,
+                                       atol=1e-12*np.abs(expected).max())
+
+
+def test_summed_area_method_matches_fft():
+    magvm, vel4vm = run_pair()
+    sat = dave4vm.calculate_dave4vm(magvm, 20, method='sat')
+    
+    for key in ('U0','V0','W0','UX','VY','UY','VX','WX','WY'):
+        np.testing.assert_allclose(sat[key], vel4vm[key], rtol=0,
+                                   atol=1e-9*np.abs(vel4vm[key]).max())
+
+
+def test_tiled_run_matches_whole_field():
+    magvm, vel4vm = run_pair()
+    
+    # A budget small enough to need square tiles.
+    tiled = dave4vm.calculate_dave4vm(magvm, 20, max_memory=8*100*35**2)
+    
+    for key in ('U0','V0','W0','UX','VY','UY','VX','WX','WY'):
+        np.testing.assert_allclose(tiled[key], vel4vm[key], rtol=0,
+                                   atol=1e-10*np.abs(vel4vm[key]).max())
+
+
+def test_tiles_cover_the_field_once():
+    covered = np.zeros((23,31))
+    
+    for core, region in dave4vm.tiles(covered.shape, 3, max_pixels=200):
+        covered[core] += 1
+        assert all(r.start <= c.start and c.stop <= r.stop
+                   for c, r in zip(core, region))
+    
+    assert np.all(covered == 1)
+
+
+def test_multi_window_matches_single_runs():
+    magvm, vel4vm = run_pair()
+    
+    for method in ('fft', 'sat'):
+        sweep = dave4vm.calculate_dave4vm_multi(magvm, [20, 30], 
+                                                method=method)
+        
+        for wsize, result in zip([20, 30], sweep):
+            single = dave4vm.calculate_dave4vm(magvm, wsize, method=method)
+            for key in ('U0','V0','W0','WX','WY'):
+                np.testing.assert_allclose(result[key], single[key], rtol=0,
+                                           atol=1e-10*np.abs(single[key]).max())
+
+
+def test_stream_matches_pairwise_runs():
+    bx_0, bx_1, by_0, by_1, bz_0, bz_1 = synthetic_pair()
+    frames = [(0., bx_0, by_0, bz_0), (720., bx_1, by_1, bz_1),
+              (1440., bx_0, by_0, bz_0 + 0.1*bz_1)]
+    
+    streamed = [vel4vm['U0'].copy() for magvm, vel4vm in 
+                do_dave4vm.stream_dave4vm(frames, 364.3, 364.3, 20)]
+    
+    assert len(streamed) == 2
+    for (t1, bx1, by1, bz1), (t2, bx2, by2, bz2), U0 in zip(frames[:-1], 
+                                                             frames[1:],
+                                                             streamed):
+        magvm, vel4vm = do_dave4vm.do_dave4vm(t2 - t1, bx2, bx1, by2, by1,
+                                              bz2, bz1, 364.3, 364.3, 20)
+        np.testing.assert_allclose(U0, vel4vm['U0'], rtol=0,
+                                   atol=1e-9*np.abs(vel4vm['U0']).max())
+
+
+def test_odiff_stack_matches_odiff():
+    rng = np.random.RandomState(3)
+    stack = rng.normal(size=(3, 30, 41))
+    
+    dx = odiffxy5.odiff_stack(stack[0::2], -1)
+    dy = odiffxy5.odiff_stack(stack[1:], -2)
+    
+    for image, axis, result in ((stack[0], 0, dx[0]), (stack[2], 0, dx[1]),
+                                (stack[1], 1, dy[0]), (stack[2], 1, dy[1])):
+        np.testing.assert_allclose(result, odiffxy5.odiff(image)[axis],
+                                   atol=1e-13)
+
+
+def test_float32_mode_is_close_to_float64():
+    magvm64, vel64 = run_pair()
+    
+    for method in ('fft', 'sat'):
+        magvm32, vel32 = run_pair(method=method, dtype=np.float32)
+        
+        assert magvm32['bz'].dtype == np.float32
+        assert magvm32['bzx'].dtype == np.float32
+        for key in ('U0', 'V0', 'W0'):
+            assert vel32[key].dtype == np.float64
+            np.testing.assert_allclose(vel32[key], vel64[key], rtol=0,
+                                       atol=1e-4*np.abs(vel64[key]).max())
+
+
+def test_float32_mode_keeps_the_weak_field_precision():
+    from scipy.ndimage import shift
+    
+    # A 3000 G spot on a 30 G quiet Sun, moving by a fraction of a pixel.
+    shape = (80,200)
+    rng = np.random.RandomState(5)
+    y, x = np.indices(shape)
+    spot = np.exp(-((x - 50)**2 + (y - 40)**2)/(2*8.**2))
+    quiet = [gaussian_filter(rng.standard_normal(shape), 4)*430 
+             for i in range(3)]
+    start = [quiet[0] + 1500*spot, quiet[1] - 1500*spot, 
+             quiet[2] + 3000*spot]
+    stop = [shift(field, (0.05, 0.1), order=3, mode='nearest') 
+            for field in start]
+    weak = spot < 1e-3
+    
+    for method, median, largest in (('fft', 5e-4, 1e-2), 
+                                    ('sat', 5e-7, 2e-5)):
+        vel = [do_dave4vm.do_dave4vm(720., stop[0], start[0], stop[1], 
+                                     start[1], stop[2], start[2], 364.3, 
+                                     364.3, 10, method=method, 
+                                     dtype=dtype)[1]
+               for dtype in (np.float64, np.float32)]
+        
+        # The errors in the quiet Sun, relative to its velocities.
+        for key in ('U0', 'V0', 'W0'):
+            error = np.abs(vel[1][key] - vel[0][key])[weak]
+            truth = vel[0][key][weak]
+            assert np.median(error) < median*np.sqrt(np.mean(truth**2))
+            assert error.max() < largest*np.abs(truth).max()
+
+
+def test_masked_run_matches_whole_field_inside_the_mask():
+    magvm, whole = run_pair()
+    
+    # A small bitmap patch, with the quiet Sun values elsewhere.
+    bitmap = np.ones(magvm['bz'].shape)
+    bitmap[20:26,30:35] = 34
+    mask = do_dave4vm.roi_mask(bitmap)
+    
+    roi, bounds = dave4vm.region_of_interest(mask, 3)
+    assert bounds == (slice(17, 29), slice(27, 38))
+    
+    # The mask is dilated by the window radius by default.
+    roi, bounds = dave4vm.region_of_interest(mask, 10)
+    
+    for max_memory in (None, 600000):
+        magvm, masked = run_pair(mask=mask, max_memory=max_memory)
+        
+        assert masked['solved'] is True
+        for key in ('U0', 'V0', 'W0'):
+            assert np.all(np.isnan(masked[key][~roi]))
+            np.testing.assert_allclose(masked[key][roi], whole[key][roi],
+                                       rtol=1e-10, 
+                                       atol=1e-12*np.abs(whole[key]).max())
+
+
+def test_kernel_cache_is_reused_between_pairs():
+    dave4vm.clear_kernel_cache()
+    
+    magvm, first = run_pair()
+    info = dave4vm.kernel_cache_info()
+    assert info['kernels'].misses == 1 and info['spectra'].misses == 1
+    
+    magvm, second = run_pair()
+    info = dave4vm.kernel_cache_info()
+    assert info['kernels'].misses == 1 and info['kernels'].hits >= 1
+    assert info['spectra'].misses == 1 and info['spectra'].hits >= 1
+    np.testing.assert_array_equal(first['U0'], second['U0'])
+    
+    # The cached arrays are shared and can not be modified.
+    kernel = dave4vm.cached_kernel(20, magvm['dx'], magvm['dy'])
+    with pytest.raises(ValueError):
+        kernel['psf'][0,0] = 1
+    
+    # Only the spectra of the last few shapes are kept.
+    for n in range(dave4vm.SPECTRA_CACHE_SIZE + 2):
+        dave4vm.kernel_spectra(20, magvm['dx'], magvm['dy'], (64, 64 + n))
+    info = dave4vm.kernel_cache_info()
+    assert info['spectra'].currsize == dave4vm.SPECTRA_CACHE_SIZE
+
+
+def test_batch_matches_pairwise_runs():
+    magvms, expected = [], []
+    for seed in range(3):
+        fields = synthetic_pair(seed=seed)
+        magvm, vel4vm = do_dave4vm.do_dave4vm(720., fields[1], fields[0],
+                                              fields[3], fields[2],
+                                              fields[5], fields[4],
+                                              364.3, 364.3, 20)
+        magvms.append(magvm)
+        expected.append(vel4vm)
+    
+    # Room for two pairs per batch.
+    max_memory = 2*8*dave4vm.MATRIX_IMAGES['fft']*magvm['bz'].size
+    
+    for results in (dave4vm.calculate_dave4vm_batch(magvms, 20),
+                    dave4vm.calculate_dave4vm_batch(magvms, 20,
+                                                    max_memory=max_memory)):
+        assert len(results) == 3
+        for vel4vm, reference in zip(results, expected):
+            assert vel4vm['solved'] is True
+            for key in ('U0', 'V0', 'W0', 'UX', 'VY', 'WX'):
+                np.testing.assert_allclose(vel4vm[key], reference[key],
+                                           rtol=1e-10, 
+                                           atol=1e-12*np.abs(reference[key]).max())
+
+
+def test_direct_convolver_matches_fft():
+    from pydave4vm.convolution import DirectConvolver, FFTConvolver
+    
+    rng = np.random.RandomState(5)
+    image = rng.standard_normal((30, 37))
+    kernel = dave4vm.build_kernel(10, 2., 3.)
+    
+    direct = DirectConvolver(kernel, image.shape)
+    fft = FFTConvolver(kernel, image.shape)
+    
+    for name in kernel:
+        np.testing.assert_allclose(direct.convolve(direct.forward(image), 
+                                                   name),
+                                   fft.convolve(fft.forward(image), name),
+                                   atol=1e-12)
+
+
+def test_autotuner_persists_and_can_be_forced(tmp_path, monkeypatch):
+    from pydave4vm import tuning
+    
+    path = str(tmp_path/'tuning.json')
+    monkeypatch.setenv('PYDAVE4VM_TUNING', path)
+    monkeypatch.delenv('PYDAVE4VM_METHOD', raising=False)
+    
+    magvm, expected = run_pair()
+    magvm, tuned = run_pair(method='auto')
+    np.testing.assert_allclose(tuned['U0'], expected['U0'], rtol=1e-8,
+                               atol=1e-10*np.abs(expected['U0']).max())
+    
+    # The winner was saved, under the width of the kernel, and is read 
+    # back by a new session.
+    key = tuning.tuning_key(magvm['bz'].shape, 21, np.float64)
+    tuning._tables.clear()
+    table = tuning.load_table()
+    assert table[key]['method'] in ('direct', 'fft', 'sat')
+    assert set(table[key]['seconds']) == {'direct', 'fft', 'sat'}
+    
+    # the_matrix finds the same entry.
+    kernel = dave4vm.build_kernel(20, magvm['dx'], magvm['dy'])
+    dave4vm_matrix.the_matrix(magvm['bx'], magvm['bxx'], None, magvm['by'],
+                              None, magvm['byy'], magvm['bz'], magvm['bzx'],
+                              magvm['bzy'], magvm['bzt'], kernel['psf'], 
+                              kernel['psfx'], kernel['psfy'], 
+                              kernel['psfxx'], kernel['psfyy'], 
+                              kernel['psfxy'], method='auto')
+    assert list(tuning.load_table()) == [key]
+    
+    # A tiled run is tuned for the shape of its tiles.
+    run_pair(method='auto', max_memory=2000000)
+    max_pixels = int(2000000/(8*max(dave4vm.MATRIX_IMAGES.values())))
+    core, region = next(dave4vm.tiles(magvm['bz'].shape, 10, max_pixels))
+    shape = tuple(r.stop - r.start for r in region)
+    assert shape != magvm['bz'].shape
+    assert set(tuning.load_table()) == {key, tuning.tuning_key(shape, 21, 
+                                                               np.float64)}
+    
+    # Forcing a backend skips the table.
+    monkeypatch.setenv('PYDAVE4VM_METHOD', 'sat')
+    kernel = dave4vm.build_kernel(20, magvm['dx'], magvm['dy'])
+    assert tuning.resolve_method('auto', kernel, magvm['bz'].shape, 20) \
+           == 'sat'
+    assert tuning.resolve_method('fft', kernel, magvm['bz'].shape, 20) \
+           == 'fft'
+
+
+def test_core_budget_is_never_oversubscribed():
+    from pydave4vm import concurrency
+    
+    for cores in range(1, 13):
+        for tasks in (1, 3, 50):
+            for processes in (None, 1, 2, 5, 64):
+                p, t = concurrency.split_budget(cores, tasks=tasks,
+                                                processes=processes)
+                assert p >= 1 and t >= 1 and p*t <= cores
+                assert p <= tasks
+    
+    assert concurrency.split_budget(8, tasks=2) == (2, 4)
+    assert concurrency.split_budget(8, processes=1) == (1, 8)
+
+
+def test_threaded_ffts_match_single_thread():
+    from pydave4vm import concurrency
+    
+    magvm, expected = run_pair()
+    try:
+        concurrency.limit_threads(2)
+        assert concurrency.fft_workers() == 2
+        magvm, threaded = run_pair()
+    finally:
+        concurrency.limit_threads(1)
+    
+    np.testing.assert_allclose(threaded['U0'], expected['U0'], rtol=1e-10,
+                               atol=1e-12*np.abs(expected['U0']).max())
+
+
+def test_workspace_runs_match_fresh_runs():
+    magvm, expected = run_pair()
+    magvm, tiled = run_pair(max_memory=600000)
+    workspace = dave4vm.Dave4vmWorkspace(magvm['bz'].shape)
+    
+    for kwargs, reference in (({}, expected), ({}, expected),
+                              ({'max_memory': 600000}, tiled)):
+        magvm, vel4vm = run_pair(workspace=workspace, **kwargs)
+        
+        # The results and the spectra live in the workspace.
+        assert np.shares_memory(magvm['bx'], workspace.fields)
+        assert workspace._spectra.size > 0
+        assert workspace._accumulator.size > 0
+        assert workspace._solve.size == dave4vm.SOLVE_WORK*magvm['bz'].size
+        for key in ('U0', 'V0', 'W0', 'UX', 'VY', 'WX'):
+            np.testing.assert_allclose(vel4vm[key], reference[key], 
+                                       rtol=1e-12,
+                                       atol=1e-14*np.abs(reference[key]).max())
+    
+    with pytest.raises(ValueError):
+        run_pair(workspace=workspace, dtype=np.float32)
+    
+    # The single precision spectra of a float32 workspace.
+    magvm, expected = run_pair(dtype=np.float32)
+    workspace = dave4vm.Dave4vmWorkspace(magvm['bz'].shape, np.float32)
+    magvm, vel4vm = run_pair(workspace=workspace, dtype=np.float32)
+    assert workspace._spectra.dtype == np.complex64
+    np.testing.assert_allclose(vel4vm['U0'], expected['U0'], rtol=1e-12,
+                               atol=1e-14*np.abs(expected['U0']).max())
+
+
+def test_diagnostics_match_per_pixel_fit():
+    AM, AP, index = singular_systems(3)
+    
+    vector, quality = dave4vm.solve_pixels(AP, index, chunk_size=5, 
+                                           solver='cholesky', 
+                                           diagnostics=True)
+    
+    for n,(i,j) in enumerate(zip(*index)):
+        A = AM[:,:,i,j]
+        chi2 = A[9,9] + A[9,0:9] @ vector[n]
+        np.testing.assert_allclose(quality['chi2'][n], chi2, rtol=1e-6,
+                                   atol=1e-9*A[9,9])
+        if (i,j) == (2,3):
+            assert quality['condition'][n] == np.inf
+        else:
+            assert 1 <= quality['condition'][n] < 1e12
+    
+    # The LU solver gives the same diagnostics on regular systems.
+    index = (index[0][:5], index[1][:5])
+    lu = dave4vm.solve_pixels(AP, index, diagnostics=True)[1]
+    cholesky = dave4vm.solve_pixels(AP, index, solver='cholesky', 
+                                    diagnostics=True)[1]
+    np.testing.assert_allclose(lu['condition'], cholesky['condition'])
+    np.testing.assert_allclose(lu['chi2'], cholesky['chi2'], rtol=1e-9)
+    
+    # The pair gets the diagnostics as images, without changing the fit.
+    magvm, plain = run_pair()
+    magvm, vel4vm = run_pair(diagnostics=True)
+    
+    np.testing.assert_array_equal(vel4vm['U0'], plain['U0'])
+    assert vel4vm['valid'].shape == magvm['bz'].shape
+    assert vel4vm['valid'].any()
+    assert np.all(vel4vm['chi2'][vel4vm['valid']] >= 0)
+    assert np.all(np.isfinite(vel4vm['condition'][vel4vm['valid']]))
+
+
+def test_frame_index_groups_the_segments_by_t_rec(tmp_path):
+    pytest.importorskip('sunpy.map')
+    from pydave4vm.addons import cubitos3
+    
+    t_recs = ['20130103_002400_TAI', '20130103_000000_TAI', 
+              '20130103_001200_TAI']
+    for t_rec in t_recs:
+        for segment in ('Br', 'Bp', 'Bt'):
+            (tmp_path / f'hmi.sharp_cea_720s.2587.{t_rec}.{segment}.fits'
+             ).touch()
+    
+    # An incomplete observation, a bitmap and an unrelated file.
+    (tmp_path / 'hmi.sharp_cea_720s.2587.20130103_003600_TAI.Br.fits').touch()
+    (tmp_path / f'hmi.sharp_cea_720s.2587.{t_recs[1]}.bitmap.fits').touch()
+    (tmp_path / 'notes.txt').touch()
+    
+    index = cubitos3.FrameIndex(str(tmp_path) + '/')
+    
+    assert index.t_recs == sorted(t_recs)
+    assert len(index) == 3
+    assert index.paths('Br', 1) == [index[1]['Br'], index[2]['Br']]
+    assert index.paths('bitmap', 0) == [index[0]['bitmap'], None]
+    assert [i for i, start, stop in index.pairs()] == [0, 1]
+    assert index[0]['Bt'].endswith(sorted(t_recs)[0] + '.Bt.fits')
+
+
+def test_stream_pairs_decodes_each_frame_once(tmp_path, monkeypatch):
+    pytest.importorskip('sunpy.map')
+    from pydave4vm.addons import cubitos3
+    
+    t_recs = [f'20130103_00{minute:02d}00_TAI' for minute in (0, 12, 24, 36)]
+    for t_rec in t_recs:
+        for segment in ('Br', 'Bp', 'Bt', 'bitmap'):
+            (tmp_path / f'hmi.sharp_cea_720s.2587.{t_rec}.{segment}.fits'
+             ).touch()
+    
+    # Decoding a file gives its name as data, counting the decodings.
+    decoded = []
+    def read(path):
+        decoded.append(path)
+        return(path, {'path': path})
+    fake_maps(monkeypatch, read)
+    
+    index = cubitos3.FrameIndex(str(tmp_path) + '/')
+    pairs = list(cubitos3.stream_pairs(None, index, bitmap=True))
+    
+    assert [i for i, start, stop in pairs] == [0, 1, 2]
+    assert len(decoded) == len(set(decoded)) == 4*len(t_recs)
+    for i, start, stop in pairs:
+        for key in ('Br', 'Bp', 'Bt', 'bitmap'):
+            assert (start[key], stop[key]) == tuple(index.paths(key, i))
+        assert start['meta'] == {'path': index[i]['Bp']}
+    
+    # Only the observations of the pairs asked for are read.
+    decoded.clear()
+    pairs = list(cubitos3.stream_pairs(None, index, pairs=[0, 2]))
+    assert [i for i, start, stop in pairs] == [0, 2]
+    assert len(decoded) == 3*len(t_recs)
+
+
+def test_prefetch_keeps_order_and_bounds_the_queue():
+    import time
+    from pydave4vm import concurrency
+    
+    produced = []
+    def frames():
+        for n in range(10):
+            produced.append(n)
+            yield n
+    
+    counters = {}
+    stream = concurrency.prefetch(frames(), depth=2, counters=counters)
+    assert next(stream) == 0
+    
+    # The thread runs ahead by the depth of the queue only.
+    time.sleep(0.3)
+    assert len(produced) <= 4
+    
+    assert list(stream) == list(range(1, 10))
+    assert counters['items'] == 10
+    assert counters['compute'] >= 0.3
+    
+    # Errors of the reading reach the caller.
+    def failing():
+        yield 0
+        raise OSError('corrupt file')
+    
+    with pytest.raises(OSError):
+        list(concurrency.prefetch(failing()))
+
+
+def test_scan_headers_reads_the_sidecar_until_the_frames_change(tmp_path,
+                                                                monkeypatch):
+    pytest.importorskip('sunpy.map')
+    fits = pytest.importorskip('astropy.io.fits')
+    from pydave4vm.addons import cubitos3
+    
+    def write_frame(t_rec, harpnum=2587):
+        for segment in ('Br', 'Bp', 'Bt'):
+            header = fits.Header({'T_REC': t_rec, 'CDELT1': 0.03,
+                                  'CDELT2': 0.03, 'HARPNUM': harpnum,
+                                  'LAT_MIN': -20.5, 'LON_MAX': 31.})
+            fits.writeto(tmp_path / f'hmi.sharp_cea_720s.2587.{t_rec}.'
+                                    f'{segment}.fits', 
+                         np.zeros((6,9), dtype=np.float32), header)
+    
+    for t_rec in ('20130103_001200_TAI', '20130103_000000_TAI'):
+        write_frame(t_rec)
+    path = str(tmp_path) + '/'
+    
+    table = cubitos3.scan_headers(path, workers=2)
+    
+    assert table['frame'] == ['20130103_000000_TAI', '20130103_001200_TAI']
+    assert table['t_rec'] == table['frame']
+    assert table['naxis1'] == [9, 9] and table['naxis2'] == [6, 6]
+    assert table['lat_max'] == [None, None]
+    row = cubitos3.header_row(table, 1)
+    assert row['cdelt2'] == 0.03 and row['lon_max'] == 31.
+    
+    # The next scan only reads the sidecar file.
+    monkeypatch.setattr(cubitos3, 'read_header', None)
+    assert cubitos3.scan_headers(path) == table
+    monkeypatch.undo()
+    
+    # A new observation makes it scan again.
+    write_frame('20130103_002400_TAI', harpnum=1)
+    table = cubitos3.scan_headers(path)
+    assert table['harpnum'] == [2587, 2587, 1]
+
+
+def test_ingested_cube_matches_the_fits_frames(tmp_path, monkeypatch):
+    pytest.importorskip('sunpy.map')
+    fits = pytest.importorskip('astropy.io.fits')
+    from pydave4vm.addons import cubitos3, ingest
+    
+    rng = np.random.RandomState(4)
+    t_recs = [f'20130103_00{minute:02d}00_TAI' for minute in (0, 12, 24, 36)]
+    for n, t_rec in enumerate(t_recs):
+        # The third observation has another shape.
+        shape = (7,9) if n == 2 else (6,9)
+        for segment in ('Br', 'Bp', 'Bt'):
+            fits.writeto(tmp_path / f'hmi.sharp_cea_720s.2587.{t_rec}.'
+                                    f'{segment}.fits',
+                         rng.standard_normal(shape).astype(np.float32),
+                         fits.Header({'T_REC': t_rec}))
+    
+    # The bitmaps of the first and last observations, with their number.
+    for n in (0, 3):
+        fits.writeto(tmp_path / f'hmi.sharp_cea_720s.2587.{t_recs[n]}.'
+                                f'bitmap.fits', np.full((6,9), n, np.int16))
+    
+    # Decoding the files with astropy, as sunpy would.
+    fake_maps(monkeypatch, lambda path: (fits.getdata(path), 
+                                         {key.lower(): value for key, value 
+                                          in fits.getheader(path).items()}))
+    
+    path = str(tmp_path) + '/'
+    index = cubitos3.FrameIndex(path)
+    assert ingest.open_cube(path, index) is None
+    
+    cube, table = ingest.ingest(path, index)
+    
+    assert cube.shape == (3,3,6,9) and cube.dtype == np.float32
+    assert table['skipped'] == [t_recs[2]]
+    assert ingest.open_cube(path, index)[0] is cube
+    
+    # The pairs are views of the cube with the data of the FITS files.
+    pairs = list(ingest.cube_pairs(path))
+    assert [i for i, start, stop in pairs] == [0, 1]
+    i, start, stop = pairs[1]
+    assert np.shares_memory(start['Br'], cube)
+    expected = cubitos3.read_frame(index[3])
+    for key in ('Br', 'Bp', 'Bt'):
+        np.testing.assert_array_equal(stop[key], expected[key])
+    assert stop['meta']['t_rec'] == t_recs[3]
+    assert stop['bitmap'] is None
+    
+    # The bitmaps are read from the FITS files of the same T_REC.
+    bitmaps = [(start['bitmap'], stop['bitmap']) for i, start, stop in
+               ingest.cube_pairs(path, index=index)]
+    assert bitmaps[0][1] is None and bitmaps[1][0] is None
+    assert bitmaps[0][0].max() == 0 and bitmaps[1][1].min() == 3
+    start, stop = ingest.cube_frames(path, 1, index)
+    assert stop['bitmap'].min() == 3
+    
+    # A new observation makes the cube out of date.
+    for segment in ('Br', 'Bp', 'Bt'):
+        (tmp_path / f'hmi.sharp_cea_720s.2587.20130103_004800_TAI.'
+                    f'{segment}.fits').touch()
+    assert ingest.open_cube(path, cubitos3.FrameIndex(path)) is None
+    
+    # An interrupted ingestion leaves no sidecar, so no cube is used.
+    def interrupt(frame, bitmap=False):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(cubitos3, 'read_frame', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        ingest.ingest(path, index)
+    assert ingest.open_cube(path) is None
+
+
+def test_pairs_are_checked_from_the_header_rows():
+    execute = pytest.importorskip('pydave4vm.execute')
+    from datetime import datetime
+    
+    # The second observation has no DATE-OBS.
+    rows = [{'date-obs': f'2013-01-03T{time}:04.50', 
+             't_rec': f'2013.01.03_{time}:00_TAI'} 
+            for time in ('00:00', '00:12', '00:24', '01:00')]
+    rows[1]['date-obs'] = None
+    
+    t1, t2, date_obs = execute.pair_times(rows[0:2])
+    assert date_obs is False
+    assert (t1, t2) == (datetime(2013,1,3,0,0), datetime(2013,1,3,0,12))
+    
+    done = {20130103002400}
+    checked = [execute.check_pair(i, execute.pair_times(rows[i:i+2]), done)
+               for i in range(3)]
+    assert 'status' not in checked[0]
+    assert checked[1]['status'] == 'exists'
+    assert checked[2]['status'] == 'timedelta'
+    
+    # The processed pairs are put back in order.
+    merged = execute.merge_results(checked, [{'i': 0, 'status': 'processed'}])
+    assert [result['status'] for result in merged] == ['processed', 'exists',
+                                                       'timedelta']
+
+
+def test_cube_pairs_take_the_metadata_of_their_own_frames():
+    execute = pytest.importorskip('pydave4vm.execute')
+    
+    # The third observation was left out of the cube.
+    headers = {'frame': ['a', 'b', 'c', 'd'], 'lat_min': [0, 1, 2, 3]}
+    table = {'frame': ['a', 'b', 'd'], 'skipped': ['c']}
+    
+    assert [row['lat_min'] for row in execute.frame_metas(headers)] == \
+           [0, 1, 2, 3]
+    assert [row['lat_min'] for row in execute.frame_metas(headers, table)] \
+           == [0, 1, 3]
+
+
+def test_bounded_map_keeps_a_window_of_futures():
+    from concurrent.futures import ThreadPoolExecutor
+    from pydave4vm import concurrency
+    
+    submitted = []
+    class CountingPool(ThreadPoolExecutor):
+        def submit(self, function, item):
+            submitted.append(item)
+            return(super().submit(function, item))
+    
+    with CountingPool(max_workers=2) as pool:
+        results = concurrency.bounded_map(pool, lambda n: n*n, range(20), 
+                                          window=4)
+        assert next(results) == 0
+        assert len(submitted) == 4
+        assert list(results) == [n*n for n in range(1, 20)]
+
+
+def test_process_pair_reports_each_status():
+    execute = pytest.importorskip('pydave4vm.execute')
+    
+    bx_start, bx_stop, by_start, by_stop, bz_start, bz_stop = synthetic_pair()
+    
+    def frames(date_start='2013-01-03T00:00:04.50', 
+               date_stop='2013-01-03T00:12:04.50', shape=None):
+        stop = {'Br': bz_stop, 'Bp': bx_stop, 'Bt': -by_stop,
+                'meta': {'date-obs': date_stop}, 'bitmap': None}
+        if shape is not None:
+            stop = {key: value[:shape[0],:shape[1]] if key in ('Br','Bp','Bt')
+                    else value for key, value in stop.items()}
+        start = {'Br': bz_start, 'Bp': bx_start, 'Bt': -by_start,
+                 'meta': {'date-obs': date_start}, 'bitmap': None}
+        return(start, stop)
+    
+    def run(**kwargs):
+        return(execute.process_pair(None, 5, 364.3, 364.3, 20, 
+                                    frames=frames(**kwargs.pop('frames', {})),
+                                    **kwargs))
+    
+    result = run()
+    assert result['status'] == 'processed' and result['i'] == 5
+    assert result['dt'] == 720.
+    magvm, vel4vm = run_pair()
+    np.testing.assert_allclose(result['U0'], vel4vm['U0'])
+    assert np.isfinite(result['int_Sn'])
+    
+    assert run(done={20130103001204})['status'] == 'exists'
+    assert run(frames={'date_stop': '2013-01-03T00:30:04.50'}
+               )['status'] == 'timedelta'
+    result = run(frames={'shape': (40,56)})
+    assert result['status'] == 'shape'
+    assert result['shapes'] == ((48,56), (40,56))
+    
+    # Only the pixels around the strong field are solved.
+    result = run(threshold=1000.)
+    assert result['status'] == 'processed'
+    assert np.isnan(result['U0']).any() and np.isfinite(result['U0']).any()